@@ -1,16 +1,41 @@
 """ReproEnv is a generic generator of Dockerfiles and Singularity files."""
 
-from reproenv.renderers import DockerRenderer  # noqa: F401
-from reproenv.renderers import SingularityRenderer  # noqa: F401
-from reproenv.state import _TemplateRegistry
-from reproenv.template import Template  # noqa: F401
-from reproenv._version import get_versions
+import importlib
+import typing as ty
 
-__version__ = get_versions()["version"]
-del get_versions
+# Public names, and the module and attributes that define them. They are imported on
+# first use, because importing the renderers is slow (see `reproenv._lazy`).
+_lazy_attributes: ty.Dict[str, ty.Tuple[str, ...]] = {
+    "DockerRenderer": ("reproenv.renderers", "DockerRenderer"),
+    "render": ("reproenv.renderers", "render"),
+    "SingularityRenderer": ("reproenv.renderers", "SingularityRenderer"),
+    "Template": ("reproenv.template", "Template"),
+    "TemplateRegistry": ("reproenv.state", "TemplateRegistry"),
+    "use_registry": ("reproenv.state", "use_registry"),
+    "register_template": ("reproenv.state", "_TemplateRegistry", "register"),
+    "unregister_template": ("reproenv.state", "_TemplateRegistry", "unregister"),
+    "registered_templates": ("reproenv.state", "_TemplateRegistry", "keys"),
+    "get_template": ("reproenv.state", "_TemplateRegistry", "get"),
+}
 
-register_template = _TemplateRegistry.register
-registered_templates = _TemplateRegistry.keys
-get_template = _TemplateRegistry.get
 
-del _TemplateRegistry
+def __getattr__(name: str) -> ty.Any:
+    if name == "__version__":
+        # In source trees, this asks git for the version, so only do it when asked.
+        # Installed builds have a static version.
+        from reproenv._version import get_versions
+
+        value = get_versions()["version"]
+    elif name in _lazy_attributes:
+        module, *attrs = _lazy_attributes[name]
+        value = importlib.import_module(module)
+        for attr in attrs:
+            value = getattr(value, attr)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> ty.List[str]:
+    return sorted(set(globals()) | set(_lazy_attributes) | {"__version__"})
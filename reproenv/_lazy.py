@@ -0,0 +1,28 @@
+"""Import modules when they are first used.
+
+Importing the renderers pulls in jinja2, jsonschema, and PyYAML, and registering
+templates loads the JSON schemas. Commands like `reproenv --version` do not need
+any of these, so they are imported on first use instead of at startup.
+"""
+
+import importlib.util
+import sys
+import types
+
+
+def lazy_import(name: str) -> types.ModuleType:
+    """Return a module that is imported when one of its attributes is first used.
+
+    The module is imported immediately if it is already imported or cannot be found.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None or spec.loader is None:
+        return importlib.import_module(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
@@ -0,0 +1,151 @@
+"""Write `docker buildx bake` files for generated Dockerfiles.
+
+A bake file lists build targets, so BuildKit can build many of them concurrently and
+share layers between them. Each target is tagged `<repository>:<variant name>`, and
+the variant name is made of the base image and the names and versions of templates.
+Targets use an external registry cache if `cache` is given, and the inline cache of
+their own tag otherwise.
+"""
+
+import json
+import os
+import re
+import typing as ty
+
+import jsonschema
+
+from reproenv.batch import BatchResult
+from reproenv.exceptions import RendererError
+from reproenv.matrix import MatrixResult
+from reproenv.matrix import variant_name
+from reproenv.state import _load_schema
+
+
+def validate_bake(d: ty.Mapping) -> None:
+    """Validate a bake file against the JSON schema. Raise exception if invalid."""
+    try:
+        jsonschema.validate(d, schema=_load_schema("bake.json"))
+    except jsonschema.exceptions.ValidationError as e:
+        raise RendererError(f"Invalid bake file: {e.message}.") from e
+
+
+def _target_name(name: str) -> str:
+    """Return a valid bake target name."""
+    return re.sub(r"[^a-zA-Z0-9_-]", "_", name)
+
+
+def _target(
+    name: str,
+    dockerfile: str,
+    context: str,
+    repository: str,
+    cache: ty.Optional[str],
+    stage: ty.Optional[str] = None,
+) -> ty.Dict[str, ty.Any]:
+    tag = f"{repository}:{name}"
+    target: ty.Dict[str, ty.Any] = {"context": context, "dockerfile": dockerfile}
+    if stage is not None:
+        target["target"] = stage
+    target["tags"] = [tag]
+    if cache is None:
+        target["cache-from"] = [tag]
+        target["cache-to"] = ["type=inline"]
+    else:
+        ref = f"{cache}:{name}"
+        target["cache-from"] = [f"type=registry,ref={ref}"]
+        target["cache-to"] = [f"type=registry,ref={ref},mode=max"]
+    return target
+
+
+def bake_for_matrix(
+    result: MatrixResult,
+    dockerfile: str = "Dockerfile",
+    context: str = ".",
+    repository: str = "reproenv",
+    cache: ty.Optional[str] = None,
+) -> ty.Dict[str, ty.Any]:
+    """Return a bake file for the variants of a matrix.
+
+    The `default` group has all variants. Each shared stage also has a group of the
+    variants that extend it.
+
+    Parameters
+    ----------
+    result : MatrixResult
+        The rendered matrix.
+    dockerfile : str
+        Path of the multi-stage Dockerfile, relative to `context`.
+    context : str
+        Build context.
+    repository : str
+        Repository of the image tags.
+    cache : str
+        Registry repository for the build cache (e.g., "registry/cache"). Each target
+        uses the tag of its name.
+    """
+    targets = {
+        _target_name(name): _target(
+            name, dockerfile, context, repository, cache, stage=stage
+        )
+        for name, stage in result.targets.items()
+    }
+    groups: ty.Dict[str, ty.Dict[str, ty.List[str]]] = {
+        "default": {"targets": list(targets)}
+    }
+    for name, stage in result.targets.items():
+        # Add the variant to the groups of all shared stages it extends.
+        parent = result.stages[stage]
+        while parent is not None:
+            if parent not in result.targets.values():
+                group = groups.setdefault(_target_name(parent), {"targets": []})
+                group["targets"].append(_target_name(name))
+            parent = result.stages[parent]
+    d = {"group": groups, "target": targets}
+    validate_bake(d)
+    return d
+
+
+def bake_for_batch(
+    specs: ty.Sequence[ty.Mapping],
+    results: ty.Iterable[BatchResult],
+    context: str = ".",
+    repository: str = "reproenv",
+    cache: ty.Optional[str] = None,
+) -> ty.Dict[str, ty.Any]:
+    """Return a bake file for the Dockerfiles of a batch.
+
+    Specs that failed or that do not have a Dockerfile are skipped. Target names are
+    made unique by appending the position of the spec.
+
+    Parameters
+    ----------
+    specs : list of dict
+        The renderer dictionaries of the batch.
+    results : iterable of BatchResult
+        Results of `render_many` with an output directory.
+    context, repository, cache
+        See `bake_for_matrix`.
+    """
+    targets: ty.Dict[str, ty.Any] = {}
+    for result in results:
+        dockerfile = result.paths.get("docker")
+        if result.error is not None or dockerfile is None:
+            continue
+        name = variant_name(specs[result.position])
+        if _target_name(name) in targets:
+            name = f"{name}-{result.position}"
+        targets[_target_name(name)] = _target(
+            name, os.path.relpath(dockerfile, context), context, repository, cache
+        )
+    if not targets:
+        raise RendererError("No Dockerfiles to build.")
+    d = {"group": {"default": {"targets": list(targets)}}, "target": targets}
+    validate_bake(d)
+    return d
+
+
+def write_bake(d: ty.Mapping, path: ty.Union[str, os.PathLike]) -> None:
+    """Write a bake file as JSON (e.g., `docker-bake.json`)."""
+    with open(path, "w") as f:
+        json.dump(d, f, indent=2)
+        f.write("\n")
@@ -0,0 +1,256 @@
+"""Render many renderer dictionaries in parallel.
+
+Workers are processes that each load the template registry once, and compile each
+template string once, so the cost of starting up is not paid for every spec.
+"""
+
+import concurrent.futures
+import hashlib
+import json
+import os
+from pathlib import Path
+import time
+import typing as ty
+
+import yaml
+
+from reproenv._lazy import lazy_import
+from reproenv.state import _TemplateRegistry
+from reproenv.state import SafeLoader
+from reproenv.types import TemplateType
+
+# Imported when used, because `reproenv.cache` imports this module.
+_cache = lazy_import("reproenv.cache")
+
+# File names of rendered specifications, by target.
+_output_names = {"docker": "Dockerfile", "singularity": "Singularity"}
+
+# Rendered specifications of this process. Batches often repeat the same spec (e.g.,
+# the base spec of all images of a project), which is then only rendered once.
+_render_cache = None
+
+
+class BatchResult(ty.NamedTuple):
+    """Result of rendering one renderer dictionary."""
+
+    # Position of the dictionary in the input.
+    position: int
+    # SHA256 digest of the canonical form of the dictionary.
+    digest: str
+    # Paths of the rendered specifications, by target, if an output directory was
+    # given.
+    paths: ty.Dict[str, str]
+    # Rendered specifications, by target, if no output directory was given.
+    rendered: ty.Dict[str, str]
+    # Error message, or `None` if rendering succeeded.
+    error: ty.Optional[str]
+    # Time spent rendering, in seconds.
+    seconds: float
+
+
+def spec_digest(d: ty.Mapping) -> str:
+    """Return the SHA256 digest of the canonical JSON form of a renderer dictionary.
+
+    The digest does not depend on the order of keys or on whitespace.
+    """
+    canonical = json.dumps(
+        d, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def in_shard(digest: str, shard: ty.Tuple[int, int]) -> bool:
+    """Return true if a spec with this digest belongs to a shard.
+
+    `shard` is `(index, count)`, where `index` starts at 1. Every digest belongs to
+    exactly one of the `count` shards, so machines can each render a disjoint part of
+    the same specs without coordination.
+    """
+    index, count = shard
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError(f"invalid shard {index}/{count}")
+    return int(digest, 16) % count == index - 1
+
+
+def load_manifest(path: ty.Union[str, os.PathLike]) -> ty.List[ty.Mapping]:
+    """Load renderer dictionaries from a JSON Lines file (`.jsonl` or `.ndjson`), or
+    from a YAML or JSON file with a list of dictionaries.
+    """
+    path = Path(path)
+    with path.open() as f:
+        if path.suffix in {".jsonl", ".ndjson"}:
+            return [json.loads(line) for line in f if line.strip()]
+        specs = yaml.load(f, Loader=SafeLoader)
+    if not isinstance(specs, list):
+        raise ValueError(f"expected a list of renderer dictionaries in {path}")
+    return specs
+
+
+def write_manifest(
+    results: ty.Iterable[BatchResult], path: ty.Union[str, os.PathLike]
+) -> None:
+    """Write results as JSON Lines. Rendered specifications are not included."""
+    with open(path, "w") as f:
+        for result in results:
+            d = result._asdict()
+            del d["rendered"]
+            f.write(json.dumps(d) + "\n")
+
+
+def read_manifest(path: ty.Union[str, os.PathLike]) -> ty.List[BatchResult]:
+    """Read results written by `write_manifest`."""
+    with open(path) as f:
+        return [
+            BatchResult(**json.loads(line), rendered={}) for line in f if line.strip()
+        ]
+
+
+class Coverage(ty.NamedTuple):
+    """Coverage of specs by merged results."""
+
+    # Positions of specs without a result.
+    missing: ty.List[int]
+    # Positions of specs with more than one result.
+    duplicated: ty.List[int]
+    # Positions of specs whose result has a different digest, i.e., results that were
+    # rendered from a different version of the specs.
+    mismatched: ty.List[int]
+
+    @property
+    def complete(self) -> bool:
+        return not (self.missing or self.duplicated or self.mismatched)
+
+
+def merge_results(
+    results: ty.Iterable[BatchResult], specs: ty.Sequence[ty.Mapping]
+) -> ty.Tuple[ty.List[BatchResult], Coverage]:
+    """Merge results of shards, and check that they cover every spec once.
+
+    Returns the merged results in the order of the specs, and the coverage.
+    """
+    by_index: ty.Dict[int, BatchResult] = {}
+    duplicated = set()
+    for result in results:
+        if result.position in by_index:
+            duplicated.add(result.position)
+        by_index[result.position] = result
+    missing = [i for i in range(len(specs)) if i not in by_index]
+    mismatched = [
+        i
+        for i, result in sorted(by_index.items())
+        if i >= len(specs) or result.digest != spec_digest(specs[i])
+    ]
+    coverage = Coverage(
+        missing=missing, duplicated=sorted(duplicated), mismatched=mismatched
+    )
+    return [by_index[i] for i in sorted(by_index)], coverage
+
+
+def _init_worker(templates: ty.Dict[str, TemplateType]) -> None:
+    """Register templates in a worker process."""
+    # Workers that are forked already have the registry of the parent.
+    if _TemplateRegistry.keys() == templates.keys():
+        return
+    _TemplateRegistry._reset()
+    _TemplateRegistry.register_many(templates)
+
+
+def _cached_render(d: ty.Mapping, targets: ty.Tuple[str, ...]) -> ty.Dict[str, str]:
+    global _render_cache
+    if _render_cache is None:
+        _render_cache = _cache.RenderCache(maxsize=256)
+    return _render_cache.render(d, targets=targets)
+
+
+def _render_one(
+    index: int,
+    d: ty.Mapping,
+    targets: ty.Tuple[str, ...],
+    output_dir: ty.Optional[str],
+) -> BatchResult:
+    start = time.perf_counter()
+    paths: ty.Dict[str, str] = {}
+    rendered: ty.Dict[str, str] = {}
+    error = None
+    try:
+        rendered = _cached_render(d, targets)
+        if output_dir is not None:
+            directory = Path(output_dir) / str(index)
+            directory.mkdir(parents=True, exist_ok=True)
+            for target, text in rendered.items():
+                path = directory / _output_names[target]
+                path.write_text(text + "\n")
+                paths[target] = str(path)
+            rendered = {}
+    # One invalid spec should not stop the whole batch.
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    return BatchResult(
+        position=index,
+        digest=spec_digest(d),
+        paths=paths,
+        rendered=rendered,
+        error=error,
+        seconds=time.perf_counter() - start,
+    )
+
+
+def render_many(
+    specs: ty.Iterable[ty.Mapping],
+    output_dir: ty.Union[str, os.PathLike, None] = None,
+    targets: ty.Iterable[str] = ("docker", "singularity"),
+    jobs: ty.Optional[int] = None,
+    shard: ty.Optional[ty.Tuple[int, int]] = None,
+) -> ty.List[BatchResult]:
+    """Render many renderer dictionaries in parallel.
+
+    Failures do not raise an exception. Instead, the `error` field of their result is
+    set.
+
+    Parameters
+    ----------
+    specs : iterable of dict
+        Renderer dictionaries, as accepted by `_Renderer.from_dict`.
+    output_dir : str or Path-like
+        If given, the specifications of the dictionary at position `i` are written to
+        `output_dir/i/Dockerfile` and `output_dir/i/Singularity`. Otherwise, they
+        are returned in the `rendered` field of the results.
+    targets : iterable of str
+        Names of the targets to render. Options are "docker" and "singularity".
+    jobs : int
+        Number of worker processes. Default is the number of processors. If 1,
+        dictionaries are rendered in this process.
+    shard : tuple of (int, int)
+        If given as `(index, count)`, only render the specs in this shard (see
+        `in_shard`). Results keep the positions of specs in `specs`, so results of
+        all shards can be merged with `merge_results`.
+
+    Returns
+    -------
+    List of `BatchResult`, in the same order as `specs`.
+    """
+    indices = []
+    selected = []
+    for index, spec in enumerate(specs):
+        if shard is None or in_shard(spec_digest(spec), shard):
+            indices.append(index)
+            selected.append(spec)
+    targets = tuple(targets)
+    out = None if output_dir is None else str(output_dir)
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if jobs < 1:
+        raise ValueError("jobs must be at least 1")
+    n = len(selected)
+    args = (indices, selected, [targets] * n, [out] * n)
+    if jobs == 1 or n < 2:
+        return list(map(_render_one, *args))
+
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs,
+        initializer=_init_worker,
+        initargs=(dict(_TemplateRegistry.items()),),
+    ) as executor:
+        # Send specs in chunks to reduce the overhead of inter-process communication.
+        chunksize = max(1, n // (jobs * 4))
+        return list(executor.map(_render_one, *args, chunksize=chunksize))
@@ -0,0 +1,427 @@
+"""Cache rendered specifications in memory and on disk.
+
+Many callers often render the same renderer dictionary, e.g., a base spec that all
+images of a project share. Entries are keyed by the digest of the canonical form of
+the dictionary, the targets, and the content of the templates that it uses, so
+re-registering a changed template does not return stale specifications. With
+`artifacts_dir`, keys also include the artifact cache in the build context and the
+digests of the artifacts in it.
+
+`RenderCache` lives in memory. Requests for a key that is being rendered wait for
+that rendering instead of rendering again ("single flight").
+
+`DiskCache` keeps rendered specifications across processes (e.g., CI jobs that
+render the same specs on every commit) in `$XDG_CACHE_HOME/reproenv/renders`. Its
+keys also include the version of reproenv. The least recently used specifications
+are removed when the cache is larger than its maximum size.
+"""
+
+import collections
+import os
+from pathlib import Path
+import tempfile
+import threading
+import time
+import typing as ty
+
+from reproenv.batch import spec_digest
+from reproenv.exceptions import ReproEnvError
+from reproenv.fetch import cached_path
+from reproenv.fetch import urls_for_renderer_dict
+from reproenv.renderers import render
+from reproenv.state import _TemplateRegistry
+
+# Default maximum size of the disk cache, in bytes.
+_DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+RenderFunction = ty.Callable[..., ty.Dict[str, str]]
+
+
+class CacheStats(ty.NamedTuple):
+    """Statistics of a `RenderCache`."""
+
+    # Requests that were answered from the cache.
+    hits: int
+    # Requests that were rendered.
+    misses: int
+    # Requests that waited for a concurrent request of the same key.
+    waits: int
+    # Entries removed because the cache was full, or because they expired.
+    evictions: int
+    expirations: int
+    # Number of entries in the cache.
+    size: int
+
+
+class _Call:
+    """A rendering in progress, which other requests for the same key wait for."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value: ty.Optional[ty.Dict[str, str]] = None
+        self.error: ty.Optional[BaseException] = None
+
+
+def _template_digests(d: ty.Mapping) -> ty.Dict[str, str]:
+    """Return the digests of the registered templates that a renderer dictionary
+    uses, by name.
+    """
+    names: ty.Set[str] = set()
+    if isinstance(d, ty.Mapping):
+        for mapping in d.get("instructions", []):
+            if isinstance(mapping, ty.Mapping):
+                names.add(str(mapping.get("name", "")).lower())
+    return {
+        name: spec_digest(_TemplateRegistry.get(name))
+        for name in sorted(names.intersection(_TemplateRegistry.keys()))
+    }
+
+
+def _artifact_digests(d: ty.Mapping) -> ty.Optional[ty.Dict[str, ty.Any]]:
+    """Return the artifact cache from which a renderer dictionary mounts artifacts,
+    and the digests of the artifacts in it by URL.
+
+    Return an empty dictionary if the renderer dictionary does not use an artifact
+    cache, and `None` if its artifacts are not known (e.g., because it is invalid).
+    """
+    artifacts_dir = d.get("artifacts_dir") if isinstance(d, ty.Mapping) else None
+    if artifacts_dir is None:
+        return {}
+    cache_dir = os.path.join(d.get("build_context") or os.curdir, artifacts_dir)
+    try:
+        urls = urls_for_renderer_dict(d)
+    except ReproEnvError:
+        return None
+    digests = {}
+    for url in urls:
+        path = cached_path(url, cache_dir)
+        digests[url] = None if path is None else path.name
+    return {"cache_dir": os.path.abspath(cache_dir), "digests": digests}
+
+
+def render_key(d: ty.Mapping, targets: ty.Iterable[str]) -> ty.Optional[str]:
+    """Return the cache key of a renderer dictionary and targets, or `None` if the
+    rendered specifications must not be cached.
+    """
+    artifacts = _artifact_digests(d)
+    if artifacts is None:
+        return None
+    return spec_digest(
+        {
+            "spec": d,
+            "targets": sorted(targets),
+            "templates": _template_digests(d),
+            "artifacts": artifacts,
+        }
+    )
+
+
+class RenderCache:
+    """Thread-safe cache of rendered specifications.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of entries. The least recently used entry is evicted when the
+        cache is full. If 0, nothing is stored, but concurrent requests for the same
+        key are still rendered once.
+    ttl : float
+        Seconds after which entries expire. Default is to never expire.
+    render_fn : callable
+        Function that renders, with the signature of `reproenv.render`.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 1024,
+        ttl: ty.Optional[float] = None,
+        render_fn: RenderFunction = render,
+    ):
+        if maxsize < 0:
+            raise ValueError("maxsize must be at least 0")
+        if ttl is not None and ttl <= 0:
+            raise ValueError("ttl must be positive")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._render_fn = render_fn
+        self._lock = threading.Lock()
+        # Values and the time at which they expire, by key, least recently used first.
+        self._entries: ty.MutableMapping[str, ty.Tuple[float, ty.Dict[str, str]]]
+        self._entries = collections.OrderedDict()
+        self._calls: ty.Dict[str, _Call] = {}
+        self._hits = self._misses = self._waits = 0
+        self._evictions = self._expirations = 0
+
+    def render(
+        self, d: ty.Mapping, targets: ty.Iterable[str] = ("docker", "singularity")
+    ) -> ty.Dict[str, str]:
+        """Return the rendered specifications of a renderer dictionary, by target.
+
+        Errors are raised in every request that waited for the rendering, and are
+        not cached.
+        """
+        targets = tuple(targets)
+        key = render_key(d, targets)
+        if key is None:
+            return self._render_fn(d, targets=targets)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if time.monotonic() < expires:
+                    self._entries.move_to_end(key)  # type: ignore
+                    self._hits += 1
+                    return dict(value)
+                del self._entries[key]
+                self._expirations += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if call is None:
+                call = self._calls[key] = _Call()
+                self._misses += 1
+            else:
+                self._waits += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return dict(ty.cast(ty.Dict[str, str], call.value))
+
+        try:
+            call.value = self._render_fn(d, targets=targets)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                if call.value is not None and self.maxsize:
+                    expires = float("inf") if self.ttl is None else self.ttl
+                    if self.ttl is not None:
+                        expires += time.monotonic()
+                    self._entries[key] = (expires, call.value)
+                    while len(self._entries) > self.maxsize:
+                        self._entries.popitem(last=False)  # type: ignore
+                        self._evictions += 1
+            call.done.set()
+        return dict(call.value)
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(
+                hits=self._hits,
+                misses=self._misses,
+                waits=self._waits,
+                evictions=self._evictions,
+                expirations=self._expirations,
+                size=len(self._entries),
+            )
+
+    def clear(self) -> None:
+        """Remove all entries. Statistics are kept."""
+        with self._lock:
+            self._entries.clear()
+
+
+class DiskCacheStats(ty.NamedTuple):
+    """Statistics of a `DiskCache`."""
+
+    path: str
+    # Number of cached specifications, and their total size in bytes.
+    entries: int
+    size: int
+    max_size: int
+    # Specifications that were read from, and written to, the cache by this object.
+    hits: int
+    misses: int
+
+
+def default_render_cache_dir() -> Path:
+    cache_home = os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")
+    return Path(cache_home) / "reproenv" / "renders"
+
+
+def _version() -> str:
+    import reproenv
+
+    return reproenv.__version__
+
+
+class DiskCache:
+    """Cache of rendered specifications on disk, shared by processes.
+
+    Each specification is stored in `<cache_dir>/<key[:2]>/<key>`, where the key is
+    the digest of the target, the renderer dictionary, the digests of the templates
+    and artifacts it uses, and the version of reproenv. Reading a specification
+    updates its modification time, which orders specifications for eviction. The
+    size of the cache is read from disk on the first write and then tracked, so it
+    is only pruned when writes make it larger than its maximum size.
+
+    Parameters
+    ----------
+    cache_dir : str or Path-like
+        Directory of the cache. Default is `$XDG_CACHE_HOME/reproenv/renders`.
+    max_size : int
+        Maximum total size of cached specifications, in bytes.
+    """
+
+    def __init__(
+        self,
+        cache_dir: ty.Union[str, os.PathLike, None] = None,
+        max_size: int = _DEFAULT_MAX_BYTES,
+    ):
+        if max_size < 0:
+            raise ValueError("max_size must be at least 0")
+        self.cache_dir = (
+            default_render_cache_dir() if cache_dir is None else Path(cache_dir)
+        )
+        self.max_size = max_size
+        self._hits = self._misses = 0
+        # Total size of cached specifications, or None if not read yet.
+        self._size: ty.Optional[int] = None
+
+    def _path(
+        self, d: ty.Mapping, target: str, templates: ty.Mapping, artifacts: ty.Mapping
+    ) -> Path:
+        key = spec_digest(
+            {
+                "renderer": target,
+                "spec": d,
+                "templates": templates,
+                "artifacts": artifacts,
+                "version": _version(),
+            }
+        )
+        return self.cache_dir / key[:2] / key
+
+    def render(
+        self,
+        d: ty.Mapping,
+        targets: ty.Iterable[str] = ("docker", "singularity"),
+        render_fn: RenderFunction = render,
+    ) -> ty.Dict[str, str]:
+        """Return the rendered specifications of a renderer dictionary, by target.
+
+        Only the targets that are not in the cache are rendered, with `render_fn`.
+        """
+        artifacts = _artifact_digests(d)
+        if artifacts is None:
+            return render_fn(d, targets=list(targets))
+        templates = _template_digests(d)
+        paths = {
+            target: self._path(d, target, templates, artifacts) for target in targets
+        }
+        rendered: ty.Dict[str, str] = {}
+        for target, path in paths.items():
+            try:
+                rendered[target] = path.read_text()
+            except FileNotFoundError:
+                continue
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                pass  # evicted by another process
+        self._hits += len(rendered)
+        missing = [target for target in paths if target not in rendered]
+        if not missing:
+            return rendered
+        self._misses += len(missing)
+        new = render_fn(d, targets=missing)
+        if self._size is None:
+            self._size = self.stats().size
+        for target in missing:
+            self._size += self._write(paths[target], new[target])
+        if self._size > self.max_size:
+            self.prune()
+        rendered.update(new)
+        return {target: rendered[target] for target in paths}
+
+    def _write(self, path: Path, text: str) -> int:
+        """Write a specification. Return the change in the size of the cache."""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            old_size = path.stat().st_size
+        except FileNotFoundError:
+            old_size = 0
+        # Write to a temporary file first, so other processes never read a partial
+        # specification.
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(text)
+            new_size = os.stat(tmp).st_size
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        return new_size - old_size
+
+    def _entries(self) -> ty.List[os.DirEntry]:
+        entries: ty.List[os.DirEntry] = []
+        try:
+            directories = list(os.scandir(self.cache_dir))
+        except FileNotFoundError:
+            return entries
+        for directory in directories:
+            if directory.is_dir():
+                entries.extend(
+                    entry
+                    for entry in os.scandir(directory.path)
+                    if entry.is_file() and not entry.name.startswith(".tmp-")
+                )
+        return entries
+
+    def prune(self) -> int:
+        """Remove the least recently used specifications until the cache is not
+        larger than its maximum size. Return the number of removed specifications.
+        """
+        files = []
+        for entry in self._entries():
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        size = sum(file_size for _, file_size, _ in files)
+        removed = 0
+        for _, file_size, path in sorted(files):
+            if size <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+            size -= file_size
+        self._size = size
+        return removed
+
+    def stats(self) -> DiskCacheStats:
+        entries = sizes = 0
+        for entry in self._entries():
+            try:
+                sizes += entry.stat().st_size
+                entries += 1
+            except FileNotFoundError:
+                pass
+        return DiskCacheStats(
+            path=str(self.cache_dir),
+            entries=entries,
+            size=sizes,
+            max_size=self.max_size,
+            hits=self._hits,
+            misses=self._misses,
+        )
+
+    def clear(self) -> int:
+        """Remove all specifications. Return the number of removed specifications."""
+        self._size = None
+        removed = 0
+        for entry in self._entries():
+            try:
+                os.unlink(entry.path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
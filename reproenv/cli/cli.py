@@ -6,17 +6,34 @@
 # TODO: add a dedicated class for key=value in the eat-all class.
 
 from pathlib import Path
+import copy
+import hashlib
+import json
+import os
+import tempfile
+import time
 import typing as ty
 
 import click
 
-from reproenv import __version__
-from reproenv.renderers import DockerRenderer
-from reproenv.renderers import SingularityRenderer
-from reproenv.state import _TemplateRegistry
-from reproenv.template import Template
+from reproenv._lazy import lazy_import
+from reproenv.exceptions import ReproEnvError
 from reproenv.types import allowed_pkg_managers
 
+# Modules that are slow to import are imported on first use, so that commands like
+# `reproenv --version` start quickly.
+yaml = lazy_import("yaml")
+_bake = lazy_import("reproenv.bake")
+_batch = lazy_import("reproenv.batch")
+_cache = lazy_import("reproenv.cache")
+_diff = lazy_import("reproenv.diff")
+_fetch = lazy_import("reproenv.fetch")
+_matrix = lazy_import("reproenv.matrix")
+_renderers = lazy_import("reproenv.renderers")
+_serve = lazy_import("reproenv.serve")
+_state = lazy_import("reproenv.state")
+_template = lazy_import("reproenv.template")
+
 
 class GroupAddCommonParamsAndRegisteredTemplates(click.Group):
     """Subclass of `click.Group` that adds parameters common to `reproenv generate`
@@ -36,9 +53,23 @@ class GroupAddCommonParamsAndRegisteredTemplates(click.Group):
                 show_envvar=True,
                 help="Path to directories with templates to register",
                 type=click.Path(exists=True, file_okay=False, dir_okay=True),
-            )
+            ),
+            click.Option(
+                ["--render-cache/--no-render-cache"],
+                envvar="REPROENV_RENDER_CACHE",
+                show_envvar=True,
+                help=(
+                    "Reuse specifications rendered before, from"
+                    " $XDG_CACHE_HOME/reproenv/renders (see `reproenv cache`)"
+                ),
+            ),
         ]
 
+    def resolve_command(self, ctx: click.Context, args: ty.List[str]):
+        # Keep the arguments of the subcommand for `.get_command()`.
+        ctx.meta["reproenv.args"] = args
+        return super().resolve_command(ctx, args)
+
     def get_command(self, ctx: click.Context, name: str) -> ty.Optional[click.Command]:
         command = self.commands.get(name)
         if command is None:
@@ -47,14 +78,11 @@ class GroupAddCommonParamsAndRegisteredTemplates(click.Group):
         # This is only set if a subcommand is called. Calling --help on the group
         # does not set --template-path.
         template_path: ty.Tuple[str] = ctx.params.get("template_path", tuple())
-        yamls: ty.List[Path] = []
-        for p in template_path:
-            path = Path(p)
-            for pattern in ("*.yaml", "*.yml"):
-                yamls.extend(path.glob(pattern))
-        # TODO: log warning if no yamls are found?
-        for path in yamls:
-            _TemplateRegistry.register(path)
+        ctx.meta["reproenv.template_path"] = template_path
+        # Commands that do not take instructions as options, like `batch`.
+        if not isinstance(command, OrderedParamsCommand):
+            _ensure_templates_registered(ctx)
+            return command
 
         params: ty.List[click.Parameter] = [
             click.Option(
@@ -66,83 +94,213 @@ class GroupAddCommonParamsAndRegisteredTemplates(click.Group):
             ),
         ]
         params = _get_common_renderer_params()
-        params += _get_params_for_registered_templates()
-        command.params += params
+        # Only add options for the templates that are used, because building options
+        # for every registered template is slow when many are registered. Help lists
+        # all of them.
+        args = ctx.meta.get("reproenv.args", [])
+        if set(ctx.help_option_names).intersection(args):
+            _ensure_templates_registered(ctx)
+            params += _get_params_for_registered_templates()
+        else:
+            # If `reproenv serve` renders, it knows the templates, so they are only
+            # registered here if rendering falls back to this process.
+            if not ctx.params.get("render_cache"):
+                server_names = _server_template_names(template_path)
+                if server_names is not None:
+                    ctx.meta["reproenv.templates"] = server_names
+            names = _template_names_in_args(args, _template_names(ctx))
+            params += _get_params_for_registered_templates(names, with_help=False)
+        # Do not modify the command, because its options depend on the arguments.
+        command = copy.copy(command)
+        command.params = command.params + params
         return command
 
 
-# https://stackoverflow.com/a/65744803/5666087
+def _register_templates(template_path: ty.Iterable[str]):
+    """Register all YAML templates in the given directories."""
+    yamls: ty.List[Path] = []
+    for p in template_path:
+        path = Path(p)
+        for pattern in ("*.yaml", "*.yml"):
+            yamls.extend(path.glob(pattern))
+    # TODO: log warning if no yamls are found?
+    _state._TemplateRegistry.register_many(yamls)
+
+
+def _ensure_templates_registered(ctx: click.Context):
+    """Register the templates of --template-path if they are not registered yet."""
+    if not ctx.meta.get("reproenv.registered"):
+        _register_templates(ctx.meta.get("reproenv.template_path", ()))
+        ctx.meta["reproenv.registered"] = True
+
+
+def _server_template_names(
+    template_path: ty.Iterable[str],
+) -> ty.Optional[ty.List[str]]:
+    """Return the names of the templates of `reproenv serve`, or None if no server
+    with the same template path is listening on a trusted socket.
+    """
+    socket_path = _serve.default_socket()
+    if not _serve.is_trusted_socket(socket_path):
+        return None
+    try:
+        return _serve.request_templates(socket_path, template_path=template_path)
+    except _serve.ServerUnavailable:
+        return None
+
+
+def _template_names(ctx: click.Context) -> ty.Collection[str]:
+    """Return the names of the templates of the server, or of registered templates."""
+    names = ctx.meta.get("reproenv.templates")
+    if names is None:
+        _ensure_templates_registered(ctx)
+        return _state._TemplateRegistry.keys()
+    return names
+
+
+def _load_spec(f: ty.IO) -> ty.Any:
+    """Load a JSON or YAML document (e.g., a renderer dictionary) from a file."""
+    text = f.read()
+    # JSON is a subset of YAML, so the YAML loader handles both, but the JSON parser
+    # is much faster for large machine-generated documents.
+    if text.lstrip().startswith(("{", "[")):
+        try:
+            return json.loads(text)
+        except ValueError:
+            pass
+    try:
+        return yaml.load(text, Loader=_state.SafeLoader)
+    except yaml.YAMLError as e:
+        raise click.BadParameter(f"cannot parse {f.name}: {e}")
+
+
+def _file_digest(path: Path) -> ty.Optional[str]:
+    """Return the SHA256 digest of a file, or `None` if it does not exist."""
+    hasher = hashlib.sha256()
+    try:
+        with path.open("rb") as f:
+            for chunk in iter(lambda: f.read(1 << 16), b""):
+                hasher.update(chunk)
+    except FileNotFoundError:
+        return None
+    return hasher.hexdigest()
+
+
+def _write_output(path: str, text: str) -> bool:
+    """Write `text` to `path` ('-' for stdout). Return true if the file changed.
+
+    Files are only replaced if their content changes, so tools that compare
+    modification times do not rebuild unchanged outputs. The file is replaced
+    atomically, so readers never see a partial file. Raises `click.FileError` if the
+    file cannot be written (e.g., because its directory does not exist).
+    """
+    if path == "-":
+        click.echo(text, nl=False)
+        return True
+    try:
+        return _replace_file(Path(path), text.encode())
+    except OSError as e:
+        raise click.FileError(path, hint=e.strerror or str(e))
+
+
+def _replace_file(target: Path, data: bytes) -> bool:
+    if _file_digest(target) == hashlib.sha256(data).hexdigest():
+        return False
+    fd, tmp = tempfile.mkstemp(dir=target.parent, prefix=f".{target.name}.tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        # `mkstemp` creates files that only the owner can read.
+        try:
+            mode = target.stat().st_mode
+        except FileNotFoundError:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+        os.chmod(tmp, mode)
+        os.replace(tmp, target)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return True
+
+
+class _EatAllParserOption(click.parser.Option):
+    """Option of the parser that takes every argument up to the next option."""
+
+    def process(self, value, state):
+        values = [value]
+        while state.rargs and not state.rargs[0].startswith(tuple(self.prefixes)):
+            values.append(state.rargs.pop(0))
+        super().process(tuple(values), state)
+
+
+class _OrderedOptionParser(click.parser.OptionParser):
+    """Parser that keeps the order of parameters, and that supports `OptionEatAll`."""
+
+    def __init__(self, ctx=None):
+        super().__init__(ctx)
+        self.order: ty.List[click.Parameter] = []
+
+    def add_option(self, opts, dest, action=None, nargs=1, const=None, obj=None):
+        if not isinstance(obj, OptionEatAll):
+            super().add_option(opts, dest, action, nargs=nargs, const=const, obj=obj)
+            return
+        opts = [click.parser.normalize_opt(opt, self.ctx) for opt in opts]
+        option = _EatAllParserOption(
+            opts, dest, action=action, nargs=nargs, const=const, obj=obj
+        )
+        self._opt_prefixes.update(option.prefixes)
+        self._short_opt.update(dict.fromkeys(option._short_opts, option))
+        self._long_opt.update(dict.fromkeys(option._long_opts, option))
+
+    def parse_args(self, args):
+        opts, largs, self.order = super().parse_args(args)
+        return opts, largs, self.order
+
+
 class OrderedParamsCommand(click.Command):
     """Subclass of `click.Command` that maintains the order of user-provided
     parameters.
+
+    After parsing, `._options` is a list of `(parameter, value)` in the order of the
+    command line. A parameter that is given more than once appears once for each
+    value. Arguments are parsed and converted once.
     """
 
+    def make_parser(self, ctx: click.Context) -> _OrderedOptionParser:
+        parser = _OrderedOptionParser(ctx)
+        for param in self.get_params(ctx):
+            param.add_to_parser(parser, ctx)
+        self._parser = parser
+        return parser
+
     def parse_args(self, ctx: click.Context, args: ty.List[str]):
+        args = super().parse_args(ctx, args)
+        # Match the values that click converted to the order of parameters.
         self._options: ty.List[ty.Tuple[click.Parameter, ty.Any]] = []
-        # run the parser for ourselves to preserve the passed order
-        parser = self.make_parser(ctx)
-        param_order: ty.List[click.Parameter]
-        opts, _, param_order = parser.parse_args(args=list(args))
-        for param in param_order:
-            value = opts[param.name]
-            # If we have multiple values, take the first one. We do this before type
-            # casting, because type casting for some reason brings all of the given
-            # values for a parameter into the container. Not sure why, but perhaps it
-            # has to do with the click.Context object.
-            if isinstance(value, list):
-                value = value.pop(0)
+        seen: ty.Dict[str, int] = {}
+        for param in self._parser.order:
+            value = ctx.params.get(param.name)
             if param.multiple:
-                # If the value is supposed to be in a tuple, put it back in a tuple.
-                value = (value,)
-            value = param.type_cast_value(ctx, value)
-            if isinstance(value, tuple):
-                value = value[0]
+                i = seen.get(param.name, 0)
+                seen[param.name] = i + 1
+                value = value[i]
             self._options.append((param, value))
-
-        # return "normal" parse results
-        return super().parse_args(ctx, args)
+        return args
 
 
-# https://stackoverflow.com/a/48394004/5666087
 class OptionEatAll(click.Option):
     """Subclass of `click.Option` that allows for an arbitrary number of options.
 
-    The behavior is similar to `nargs="*"` in argparse.
+    The behavior is similar to `nargs="*"` in argparse. Only commands that are
+    `OrderedParamsCommand` can parse these options.
     """
 
     def __init__(self, *args, **kwargs):
         nargs = kwargs.pop("nargs", -1)
         assert nargs == -1, "nargs, if set, must be -1 not {}".format(nargs)
         super(OptionEatAll, self).__init__(*args, **kwargs)
-        self._previous_parser_process = None
-        self._eat_all_parser = None
-
-    def add_to_parser(self, parser, ctx):
-        def parser_process(value, state):
-            # method to hook to the parser.process
-            done = False
-            value = [value]
-            # grab everything up to the next option
-            while state.rargs and not done:
-                for prefix in self._eat_all_parser.prefixes:
-                    if state.rargs[0].startswith(prefix):
-                        done = True
-                if not done:
-                    value.append(state.rargs.pop(0))
-            value = tuple(value)
-
-            # call the actual process
-            self._previous_parser_process(value, state)
-
-        retval = super(OptionEatAll, self).add_to_parser(parser, ctx)
-        for name in self.opts:
-            our_parser = parser._long_opt.get(name) or parser._short_opt.get(name)
-            if our_parser:
-                self._eat_all_parser = our_parser
-                self._previous_parser_process = our_parser.process
-                our_parser.process = parser_process
-                break
-        return retval
 
 
 class KeyValuePair(click.ParamType):
@@ -167,20 +325,104 @@ class KeyValuePair(click.ParamType):
             return fn(value)
 
 
+class BuildJobs(click.ParamType):
+    """Type that accepts a positive integer or 'auto'."""
+
+    name = "integer|auto"
+
+    def convert(self, value, param, ctx):
+        if value == "auto" or isinstance(value, int):
+            return value
+        try:
+            jobs = int(value)
+        except ValueError:
+            jobs = 0
+        if jobs < 1:
+            self.fail("expected a positive integer or 'auto'", param, ctx)
+        return jobs
+
+
+class Shard(click.ParamType):
+    """Type that accepts INDEX/COUNT, where 1 <= INDEX <= COUNT."""
+
+    name = "index/count"
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, tuple):
+            return value
+        try:
+            index, count = map(int, value.split("/"))
+        except ValueError:
+            index = count = 0
+        if not 1 <= index <= count:
+            self.fail(f"expected INDEX/COUNT with 1 <= INDEX <= COUNT, got '{value}'")
+        return index, count
+
+
 def _get_common_renderer_params() -> ty.List[click.Parameter]:
     params: ty.List[click.Parameter] = [
+        click.Option(
+            ["--spec"],
+            type=click.File("r"),
+            help=(
+                "Read a renderer dictionary (JSON or YAML) from this file ('-' for"
+                " stdin) instead of instruction options"
+            ),
+        ),
+        # The package manager and base image are only required without --spec.
         click.Option(
             ["-p", "--pkg-manager"],
             type=click.Choice(allowed_pkg_managers, case_sensitive=False),
-            required=True,
             multiple=False,
-            help="System package manager",
+            help="System package manager  [required without --spec]",
+        ),
+        click.Option(
+            ["--package-proxy"],
+            multiple=False,
+            help="URL of caching proxy for system package installs",
+        ),
+        click.Option(
+            ["--artifacts-dir"],
+            multiple=False,
+            help=(
+                "Mount template downloads from this artifact cache (populated by"
+                " `reproenv fetch`, relative to the build context)"
+            ),
+        ),
+        click.Option(
+            ["--build-context"],
+            type=click.Path(exists=True, file_okay=False),
+            multiple=False,
+            help=(
+                "Build context in which to find --artifacts-dir  [default: current"
+                " directory]"
+            ),
+        ),
+        click.Option(
+            ["--build-jobs"],
+            type=BuildJobs(),
+            multiple=False,
+            help="Number of parallel jobs when installing templates from source",
+        ),
+        click.Option(
+            ["--ccache"],
+            is_flag=True,
+            default=None,
+            help="Cache compilation when installing templates from source",
+        ),
+        click.Option(
+            ["--template-arg", "template_args"],
+            multiple=True,
+            default=None,
+            help=(
+                "Set this keyword argument of templates (e.g., version) at build time"
+                " with a build argument (repeatable)"
+            ),
         ),
         click.Option(
             ["-b", "--base-image", "from_"],
-            required=True,
             multiple=True,
-            help="Base image",
+            help="Base image  [required without --spec]",
         ),
         click.Option(
             ["--arg"],
@@ -257,11 +499,41 @@ def _create_help_for_template(template):
     return h
 
 
-def _get_params_for_registered_templates() -> ty.List[click.Parameter]:
-    """Return list of click parameters for registered templates."""
+def _template_names_in_args(
+    args: ty.Iterable[str], template_names: ty.Collection[str]
+) -> ty.Set[str]:
+    """Return names of templates in `template_names` whose options are in `args`."""
+    names = set()
+    for arg in args:
+        if arg == "--":
+            break
+        name = arg[2:].split("=", 1)[0]
+        if arg.startswith("--") and name in template_names:
+            names.add(name)
+    return names
+
+
+def _get_params_for_registered_templates(
+    names: ty.Optional[ty.Iterable[str]] = None, with_help: bool = True
+) -> ty.List[click.Parameter]:
+    """Return list of click parameters for registered templates.
+
+    Parameters
+    ----------
+    names : iterable of str
+        Names of the templates. Default is all registered templates.
+    with_help : bool
+        If false, do not create help for the parameters. Creating help instantiates
+        (and validates) each template.
+    """
     params: ty.List[click.Parameter] = []
-    for name, tmpl in _TemplateRegistry.items():
-        hlp = _create_help_for_template(Template(tmpl))
+    if names is None:
+        names = _state._TemplateRegistry.keys()
+    for name in sorted(names):
+        hlp = None
+        if with_help:
+            tmpl = _state._TemplateRegistry.get(name)
+            hlp = _create_help_for_template(_template.Template(tmpl))
         param = OptionEatAll(
             [f"--{name.lower()}"],
             type=KeyValuePair(),
@@ -272,20 +544,58 @@ def _get_params_for_registered_templates() -> ty.List[click.Parameter]:
     return params
 
 
+# Parameters that set options of the renderer instead of adding instructions.
+_renderer_option_names = (
+    "package_proxy",
+    "artifacts_dir",
+    "build_context",
+    "build_jobs",
+    "ccache",
+    "template_args",
+)
+
+
 def _params_to_renderer_dict(ctx: click.Context, pkg_manager) -> dict:
-    """Return dictionary compatible with compatible with `_Renderer.from_dict()`."""
-    renderer_dict = {
-        "pkg_manager": pkg_manager,
-        "instructions": [],
-    }
+    """Return dictionary compatible with compatible with `_Renderer.from_dict()`.
+
+    If `--spec` was given, return the dictionary in that file. Renderer options on
+    the command line (e.g., `--pkg-manager`) override those of the file.
+    """
     cmd = ctx.command
     cmd = ty.cast(OrderedParamsCommand, cmd)
+    instructions = []
     for param, value in cmd._options:
         d = _get_instruction_for_param(ctx=ctx, param=param, value=value)
         # TODO: what happens if `d is None`?
         if d is not None:
-            renderer_dict["instructions"].append(d)
-    if not renderer_dict["instructions"]:
+            instructions.append(d)
+
+    renderer_dict: ty.Dict[str, ty.Any]
+    spec = ctx.params.get("spec")
+    if spec is not None:
+        if instructions:
+            ctx.fail("--spec cannot be combined with options that add instructions")
+        renderer_dict = _load_spec(spec)
+        if not isinstance(renderer_dict, dict):
+            raise click.BadParameter(
+                "expected a renderer dictionary", ctx=ctx, param_hint="'--spec'"
+            )
+        if pkg_manager is not None:
+            renderer_dict["pkg_manager"] = pkg_manager
+    else:
+        for param in cmd.params:
+            if param.name in {"pkg_manager", "from_"} and not ctx.params[param.name]:
+                raise click.MissingParameter(ctx=ctx, param=param)
+        renderer_dict = {"pkg_manager": pkg_manager, "instructions": instructions}
+
+    for name in _renderer_option_names:
+        value = ctx.params.get(name)
+        if isinstance(value, tuple):
+            # Options that can be repeated are empty if not given.
+            value = list(value) or None
+        if value is not None:
+            renderer_dict[name] = value
+    if not renderer_dict.get("instructions"):
         ctx.fail("not enough instructions to generate a container specification")
     return renderer_dict
 
@@ -345,7 +655,7 @@ def _get_instruction_for_param(
         d = {"name": param.name, "kwds": {"path": value}}
     # probably a registered template?
     else:
-        if param.name.lower() in _TemplateRegistry.keys():
+        if param.name.lower() in _template_names(ctx):
             value = dict(value)
             d = {"name": param.name.lower(), "kwds": dict(value)}
         else:
@@ -354,33 +664,620 @@ def _get_instruction_for_param(
     return d
 
 
+def _render(
+    ctx: click.Context, renderer_dict: ty.Mapping, targets: ty.List[str]
+) -> ty.Dict[str, str]:
+    """Render with `reproenv serve` if its socket exists and is trusted (see
+    `reproenv.serve.is_trusted_socket`), and otherwise here.
+
+    With --render-cache, only specifications that are not in the disk cache are
+    rendered.
+    """
+    group_params = ctx.parent.params if ctx.parent else {}
+
+    def render(d: ty.Mapping, targets: ty.List[str]) -> ty.Dict[str, str]:
+        socket_path = _serve.default_socket()
+        if _serve.is_trusted_socket(socket_path):
+            if d.get("artifacts_dir") is not None:
+                # The server would look up artifacts in its own working directory.
+                build_context = os.path.abspath(d.get("build_context") or os.curdir)
+                d = {**d, "build_context": build_context}
+            try:
+                return _serve.request_render(
+                    d,
+                    targets=targets,
+                    socket_path=socket_path,
+                    template_path=group_params.get("template_path", ()),
+                )
+            except _serve.ServerUnavailable:
+                pass
+        _ensure_templates_registered(ctx)
+        return _renderers.render(d, targets=targets)
+
+    if group_params.get("render_cache"):
+        # Keys of the cache include the digests of registered templates.
+        _ensure_templates_registered(ctx)
+        return _cache.DiskCache().render(renderer_dict, targets, render_fn=render)
+    return render(renderer_dict, targets)
+
+
+def _print_version(ctx: click.Context, param: click.Parameter, value: bool) -> None:
+    """Print the version and exit. The version is only computed when asked for."""
+    if not value or ctx.resilient_parsing:
+        return
+    import reproenv
+
+    click.echo(f"{ctx.find_root().info_name} version {reproenv.__version__}")
+    ctx.exit()
+
+
 @click.group()
-@click.version_option(__version__, message="%(prog)s version %(version)s")
+@click.option(
+    "--version",
+    is_flag=True,
+    expose_value=False,
+    is_eager=True,
+    callback=_print_version,
+    help="Show the version and exit.",
+)
 def cli():
     pass
 
 
 @cli.group(cls=GroupAddCommonParamsAndRegisteredTemplates)
-def generate(*, template_path):
+def generate(*, template_path, render_cache):
     """Generate container."""
     pass
 
 
+_output_option = click.option(
+    "-o",
+    "--output",
+    type=click.Path(dir_okay=False, writable=True, allow_dash=True),
+    default="-",
+    help=(
+        "Write to this path  [default: stdout]. The file is only replaced if its"
+        " content changes."
+    ),
+)
+
+
 @generate.command(cls=OrderedParamsCommand)
+@_output_option
+@click.option(
+    "--reorder-for-cache",
+    is_flag=True,
+    help=(
+        "Move volatile instructions (LABEL, ARG, COPY) after independent expensive"
+        " ones. Moves are reported on stderr."
+    ),
+)
 @click.pass_context
-def docker(ctx: click.Context, pkg_manager, **kwds):
+def docker(ctx: click.Context, pkg_manager, output, reorder_for_cache, **kwds):
     """Generate a Dockerfile."""
     renderer_dict = _params_to_renderer_dict(ctx=ctx, pkg_manager=pkg_manager)
-    renderer = DockerRenderer.from_dict(renderer_dict)
-    output = str(renderer)
-    click.echo(output)
+    moves = []
+    try:
+        if reorder_for_cache:
+            _ensure_templates_registered(ctx)
+            renderer = _renderers.DockerRenderer.from_dict(renderer_dict)
+            moves = renderer.reorder_for_cache()
+            rendered = str(renderer)
+        else:
+            rendered = _render(ctx, renderer_dict, ["docker"])["docker"]
+    except ReproEnvError as e:
+        raise click.ClickException(str(e))
+    for move in moves:
+        click.echo(
+            f"moved '{move.instruction}' from position {move.old_index} to"
+            f" {move.new_index}: {move.reason}",
+            err=True,
+        )
+    _write_output(output, rendered + "\n")
 
 
 @generate.command(cls=OrderedParamsCommand)
+@_output_option
 @click.pass_context
-def singularity(ctx: click.Context, pkg_manager, **kwds):
+def singularity(ctx: click.Context, pkg_manager, output, **kwds):
     """Generate a Singularity recipe."""
     renderer_dict = _params_to_renderer_dict(ctx=ctx, pkg_manager=pkg_manager)
-    renderer = SingularityRenderer.from_dict(renderer_dict)
-    output = str(renderer)
-    click.echo(output)
+    try:
+        rendered = _render(ctx, renderer_dict, ["singularity"])
+    except ReproEnvError as e:
+        raise click.ClickException(str(e))
+    _write_output(output, rendered["singularity"] + "\n")
+
+
+@generate.command("all", cls=OrderedParamsCommand)
+@click.option(
+    "--output-docker",
+    type=click.Path(dir_okay=False, writable=True, allow_dash=True),
+    help="Write the Dockerfile to this path ('-' for stdout)",
+)
+@click.option(
+    "--output-singularity",
+    type=click.Path(dir_okay=False, writable=True, allow_dash=True),
+    help="Write the Singularity recipe to this path ('-' for stdout)",
+)
+@click.pass_context
+def all_(ctx: click.Context, pkg_manager, output_docker, output_singularity, **kwds):
+    """Generate a Dockerfile and a Singularity recipe.
+
+    Templates are rendered once for both outputs.
+    """
+    outputs = {"docker": output_docker, "singularity": output_singularity}
+    outputs = {target: path for target, path in outputs.items() if path is not None}
+    if not outputs:
+        ctx.fail("at least one of --output-docker and --output-singularity is required")
+    renderer_dict = _params_to_renderer_dict(ctx=ctx, pkg_manager=pkg_manager)
+    try:
+        rendered = _render(ctx, renderer_dict, list(outputs))
+    except ReproEnvError as e:
+        raise click.ClickException(str(e))
+    for target, path in outputs.items():
+        _write_output(path, rendered[target] + "\n")
+
+
+@generate.command()
+@click.option(
+    "-o",
+    "--output-dir",
+    required=True,
+    type=click.Path(file_okay=False, dir_okay=True, writable=True),
+    help="Write the specifications of the Nth renderer dictionary to OUTPUT_DIR/N/",
+)
+@click.option(
+    "-t",
+    "--target",
+    "targets",
+    multiple=True,
+    type=click.Choice(["docker", "singularity"]),
+    help="Container specification to render (repeatable)  [default: both]",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    help="Number of worker processes  [default: number of processors]",
+)
+@click.option(
+    "--results",
+    type=click.Path(dir_okay=False, writable=True),
+    help="Write results and timings (JSON Lines)  [default: OUTPUT_DIR/results.jsonl]",
+)
+@click.option(
+    "--shard",
+    type=Shard(),
+    help=(
+        "Only render the specs in shard INDEX of COUNT. Specs are assigned to shards"
+        " by the hash of their contents."
+    ),
+)
+@click.option(
+    "--bake",
+    type=click.Path(dir_okay=False, writable=True),
+    help="Also write a `docker buildx bake` file (JSON) to build the Dockerfiles",
+)
+@click.option(
+    "--repository",
+    default="reproenv",
+    show_default=True,
+    help="Repository of image tags in the bake file",
+)
+@click.option(
+    "--cache-ref",
+    help=(
+        "Registry repository for the build cache in the bake file  [default: inline"
+        " cache of each tag]"
+    ),
+)
+@click.argument("manifest", type=click.Path(exists=True, dir_okay=False))
+def batch(
+    output_dir, targets, jobs, results, shard, bake, repository, cache_ref, manifest
+):
+    """Render many renderer dictionaries.
+
+    MANIFEST is a JSON Lines file (.jsonl) with one renderer dictionary per line, or
+    a YAML or JSON file with a list of renderer dictionaries.
+
+    With --shard, several machines can each render part of the same MANIFEST. Use
+    `reproenv generate merge` to combine their results.
+
+    With --bake, build the Dockerfiles concurrently with `docker buildx bake -f BAKE`.
+    """
+    try:
+        specs = _batch.load_manifest(manifest)
+    except (ValueError, yaml.YAMLError) as e:
+        raise click.BadParameter(str(e), param_hint="MANIFEST")
+    start = time.perf_counter()
+    batch_results = _batch.render_many(
+        specs,
+        output_dir=output_dir,
+        targets=targets or ("docker", "singularity"),
+        jobs=jobs,
+        shard=shard,
+    )
+    elapsed = time.perf_counter() - start
+    if results is None:
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+        name = "results.jsonl" if shard is None else "results-{}-of-{}.jsonl"
+        results = str(Path(output_dir) / name.format(*shard or ()))
+    _batch.write_manifest(batch_results, results)
+
+    failed = [r for r in batch_results if r.error is not None]
+    for result in failed:
+        click.echo(f"failed  {result.position}: {result.error}", err=True)
+    click.echo(
+        f"rendered {len(batch_results) - len(failed)} of {len(batch_results)} specs"
+        f" in {elapsed:.1f} s; results in {results}",
+        err=True,
+    )
+    if bake is not None:
+        try:
+            d = _bake.bake_for_batch(
+                specs, batch_results, repository=repository, cache=cache_ref
+            )
+        except ReproEnvError as e:
+            raise click.ClickException(str(e))
+        _bake.write_bake(d, bake)
+    if failed:
+        n = len(batch_results)
+        raise click.ClickException(f"{len(failed)} of {n} specs failed")
+
+
+@generate.command()
+@click.option(
+    "-o",
+    "--output",
+    type=click.Path(dir_okay=False, writable=True, allow_dash=True),
+    default="-",
+    help="Write the Dockerfile to this path  [default: stdout]",
+)
+@click.option(
+    "--shard",
+    type=Shard(),
+    help="Only render the variants in shard INDEX of COUNT",
+)
+@click.option(
+    "--bake",
+    type=click.Path(dir_okay=False, writable=True),
+    help="Also write a `docker buildx bake` file (JSON) to build the variants",
+)
+@click.option(
+    "--repository",
+    default="reproenv",
+    show_default=True,
+    help="Repository of image tags in the bake file",
+)
+@click.option(
+    "--cache-ref",
+    help=(
+        "Registry repository for the build cache in the bake file  [default: inline"
+        " cache of each tag]"
+    ),
+)
+@click.argument("matrix", type=click.File("r"))
+def matrix(output, shard, bake, repository, cache_ref, matrix):
+    """Render variants as one multi-stage Dockerfile.
+
+    MATRIX is a matrix (JSON or YAML) with renderer options and `axes` of
+    alternative instructions, or a list of renderer dictionaries. Instructions that
+    variants share are built once in shared stages. The build stage of each variant
+    is printed on stderr.
+
+    With --bake, build all variants with `docker buildx bake -f BAKE`, or the variants
+    that share a stage with `docker buildx bake -f BAKE shared-N`.
+    """
+    if bake is not None and output == "-":
+        raise click.UsageError("--bake requires the Dockerfile to be written to a file")
+    try:
+        result = _matrix.render_matrix(_load_spec(matrix), shard=shard)
+        if bake is not None:
+            d = _bake.bake_for_matrix(
+                result, dockerfile=output, repository=repository, cache=cache_ref
+            )
+    except ReproEnvError as e:
+        raise click.ClickException(str(e))
+    with click.open_file(output, "w") as f:
+        f.write(result.dockerfile + "\n")
+    if bake is not None:
+        _bake.write_bake(d, bake)
+    for name, stage in result.targets.items():
+        click.echo(f"{name}: --target {stage}", err=True)
+    click.echo(
+        f"{len(result.targets)} variants build {result.n_instructions_built} of"
+        f" {result.n_instructions} instructions",
+        err=True,
+    )
+
+
+@generate.command()
+@click.option(
+    "-o",
+    "--output",
+    required=True,
+    type=click.Path(dir_okay=False, writable=True),
+    help="Write merged results to this path",
+)
+@click.argument("manifest", type=click.Path(exists=True, dir_okay=False))
+@click.argument("results", nargs=-1, required=True, type=click.Path(exists=True))
+def merge(output, manifest, results):
+    """Merge results of `reproenv generate batch --shard` and check coverage.
+
+    MANIFEST is the manifest that was rendered, and RESULTS are the results files
+    of the shards. Fails if a spec was not rendered, was rendered more than once, or
+    has changed since it was rendered.
+    """
+    try:
+        specs = _batch.load_manifest(manifest)
+    except (ValueError, yaml.YAMLError) as e:
+        raise click.BadParameter(str(e), param_hint="MANIFEST")
+    all_results = []
+    for path in results:
+        all_results.extend(_batch.read_manifest(path))
+    merged, coverage = _batch.merge_results(all_results, specs)
+    _batch.write_manifest(merged, output)
+
+    for name in ("missing", "duplicated", "mismatched"):
+        indices = getattr(coverage, name)
+        if indices:
+            shown = ", ".join(map(str, indices[:20]))
+            more = f", ... ({len(indices)} total)" if len(indices) > 20 else ""
+            click.echo(f"{name}: {shown}{more}", err=True)
+    if not coverage.complete:
+        raise click.ClickException("results do not cover the manifest")
+    failed = sum(result.error is not None for result in merged)
+    click.echo(f"merged {len(merged)} results; {failed} failed", err=True)
+
+
+@cli.command()
+@click.option(
+    "--template-path",
+    multiple=True,
+    envvar="REPROENV_TEMPLATE_PATH",
+    show_envvar=True,
+    help="Path to directories with templates to register",
+    type=click.Path(exists=True, file_okay=False, dir_okay=True),
+)
+@click.option(
+    "--socket",
+    "socket_path",
+    type=click.Path(dir_okay=False),
+    help=(
+        "Listen on this Unix socket  [default: $REPROENV_SOCKET, or reproenv.sock in"
+        " $XDG_RUNTIME_DIR]"
+    ),
+)
+@click.option(
+    "--port",
+    type=click.IntRange(min=0, max=65535),
+    help="Listen on this TCP port of 127.0.0.1 instead of a Unix socket",
+)
+@click.option(
+    "--cache-size",
+    type=click.IntRange(min=0),
+    default=1024,
+    show_default=True,
+    help="Maximum number of cached renderings (0 to disable the cache)",
+)
+@click.option(
+    "--cache-ttl",
+    type=float,
+    help="Seconds after which cached renderings expire  [default: never]",
+)
+@click.option("-v", "--verbose", is_flag=True, help="Log every request")
+def serve(template_path, socket_path, port, cache_size, cache_ttl, verbose):
+    """Render renderer dictionaries in a long-running server.
+
+    Templates are registered once, and again when their files change. Requests
+    are rendered concurrently. While the server listens on the default socket,
+    `reproenv generate` sends its renderer dictionaries to the server. Send
+    `POST /render` with `{"spec": ..., "targets": [...]}`, `GET /templates` for
+    the names of the templates, and `GET /health` for the status.
+    """
+    try:
+        server = _serve.make_server(
+            socket_path=socket_path,
+            port=port,
+            template_path=template_path,
+            verbose=verbose,
+            cache_size=cache_size,
+            cache_ttl=cache_ttl,
+        )
+    except (ReproEnvError, OSError, ValueError) as e:
+        raise click.ClickException(str(e))
+    address = server.server_address
+    if isinstance(address, tuple):
+        address = "http://{}:{}".format(*address)
+    click.echo(f"listening on {address}", err=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+@cli.group()
+def cache():
+    """Manage the cache of rendered specifications.
+
+    `reproenv generate --render-cache` stores rendered specifications in
+    $XDG_CACHE_HOME/reproenv/renders, keyed by the renderer dictionary, the content
+    of its templates, and the version of reproenv.
+    """
+    pass
+
+
+@cache.command()
+@click.option("--json", "as_json", is_flag=True, help="Print the result as JSON")
+def stats(as_json):
+    """Show the location and size of the cache."""
+    result = _cache.DiskCache().stats()
+    if as_json:
+        d = result._asdict()
+        del d["hits"], d["misses"]
+        click.echo(json.dumps(d, indent=2))
+        return
+    click.echo(f"path:     {result.path}")
+    click.echo(f"entries:  {result.entries}")
+    click.echo(f"size:     {result.size} bytes")
+    click.echo(f"max size: {result.max_size} bytes")
+
+
+@cache.command()
+@click.option(
+    "--max-size",
+    type=click.IntRange(min=0),
+    help=(
+        "Remove the least recently used specifications until the cache is not"
+        " larger than this many bytes  [default: remove all]"
+    ),
+)
+def clear(max_size):
+    """Remove rendered specifications from the cache."""
+    if max_size is None:
+        removed = _cache.DiskCache().clear()
+    else:
+        removed = _cache.DiskCache(max_size=max_size).prune()
+    click.echo(f"removed {removed} specifications", err=True)
+
+
+@cli.command()
+@click.option(
+    "--template-path",
+    multiple=True,
+    envvar="REPROENV_TEMPLATE_PATH",
+    show_envvar=True,
+    help="Path to directories with templates to register",
+    type=click.Path(exists=True, file_okay=False, dir_okay=True),
+)
+@click.option(
+    "--spec",
+    type=click.File("r"),
+    help="Renderer dictionary (JSON or YAML). Use '-' to read from stdin.",
+)
+@click.option(
+    "--cache-dir",
+    type=click.Path(file_okay=False, dir_okay=True),
+    envvar="REPROENV_ARTIFACT_CACHE",
+    show_envvar=True,
+    help="Cache directory  [default: $XDG_CACHE_HOME/reproenv/artifacts]",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=8,
+    show_default=True,
+    help="Number of concurrent downloads",
+)
+@click.option(
+    "--retries",
+    type=click.IntRange(min=0),
+    default=3,
+    show_default=True,
+    help="Number of times to retry a failed download",
+)
+@click.option("--force", is_flag=True, help="Download even if already cached")
+@click.argument("templates", nargs=-1, metavar="[TEMPLATE:VERSION]...")
+def fetch(template_path, spec, cache_dir, jobs, retries, force, templates):
+    """Download artifacts used by templates into a local cache.
+
+    Artifacts are the binaries URLs and deb packages of the templates in a renderer
+    dictionary (--spec) or of TEMPLATE:VERSION pairs.
+    """
+    _register_templates(template_path)
+    try:
+        urls = _fetch.urls_for_template_versions(templates)
+        if spec is not None:
+            urls += _fetch.urls_for_renderer_dict(_load_spec(spec))
+    except ReproEnvError as e:
+        raise click.ClickException(str(e))
+    if not urls:
+        raise click.UsageError("nothing to fetch")
+
+    results = _fetch.fetch(
+        urls, cache_dir=cache_dir, jobs=jobs, retries=retries, force=force
+    )
+    failed = 0
+    for result in results:
+        if result.error is not None:
+            failed += 1
+            click.echo(f"failed  {result.url}: {result.error}", err=True)
+        else:
+            status = "cached " if result.cached else "fetched"
+            click.echo(f"{status} {result.url} -> {result.path}")
+    if failed:
+        raise click.ClickException(f"{failed} of {len(results)} downloads failed")
+
+
+@cli.command()
+@click.option(
+    "--template-path",
+    multiple=True,
+    envvar="REPROENV_TEMPLATE_PATH",
+    show_envvar=True,
+    help="Path to directories with templates to register",
+    type=click.Path(exists=True, file_okay=False, dir_okay=True),
+)
+@click.option(
+    "--target",
+    type=click.Choice(["docker", "singularity"]),
+    default="docker",
+    show_default=True,
+    help="Container specification to compare",
+)
+@click.option("--json", "as_json", is_flag=True, help="Print the result as JSON")
+@click.argument("old", type=click.File("r"))
+@click.argument("new", type=click.File("r"))
+def diff(template_path, target, as_json, old, new):
+    """Predict which layers a change to a renderer dictionary rebuilds.
+
+    OLD and NEW are renderer dictionaries (JSON or YAML). For Docker, this reports
+    the layers that are reused from the cache and the layers that are rebuilt. For
+    Singularity, which rebuilds the whole image, this reports the sections that
+    changed. Exits with status 1 if there are differences.
+    """
+    _register_templates(template_path)
+    old_dict = _load_spec(old)
+    new_dict = _load_spec(new)
+    try:
+        if target == "docker":
+            result: ty.Union[_diff.DockerDiff, _diff.SingularityDiff]
+            result = _diff.diff_docker(old_dict, new_dict)
+        else:
+            result = _diff.diff_singularity(old_dict, new_dict)
+    except ReproEnvError as e:
+        raise click.ClickException(str(e))
+
+    if as_json:
+        d: ty.Dict[str, ty.Any] = {
+            k: [s._asdict() for s in v] if k != "sections" else v
+            for k, v in result._asdict().items()
+            if k != "cost"
+        }
+        d.update(changed=result.changed, cost=result.cost)
+        click.echo(json.dumps(d, indent=2))
+    elif isinstance(result, _diff.DockerDiff):
+        for step in result.reused:
+            click.echo(f"  cached   {step.instruction}")
+        for step in result.rebuilt:
+            template = f"  [{step.template}]" if step.template else ""
+            click.echo(f"  rebuild  {step.instruction}{template}")
+        click.echo(
+            f"{len(result.reused)} cached, {len(result.rebuilt)} rebuilt, estimated"
+            f" cost {result.cost}"
+        )
+    else:
+        for section in result.sections:
+            click.echo(f"  changed  {section}")
+        for step in result.post_removed:
+            click.echo(f"- %post    {step.instruction}")
+        for step in result.post_changed:
+            template = f"  [{step.template}]" if step.template else ""
+            click.echo(f"+ %post    {step.instruction}{template}")
+        click.echo(f"estimated cost of rebuild {result.cost}")
+    if result.changed:
+        raise SystemExit(1)
@@ -1,9 +1,12 @@
 # TODO: add tests of individual CLI params.
 
+import json
+import os
 from pathlib import Path
 
 from click.testing import CliRunner
 import pytest
+import yaml
 
 from reproenv.cli.cli import generate
 
@@ -113,3 +116,451 @@ def test_render_registered(cmd: str, pkg_manager: str):
     assert result.exit_code == 0, result.output
     assert "jq-1.5/jq-linux64" in result.output
     assert "jq-1.6/jq-linux64" in result.output
+
+
+@pytest.mark.parametrize("cmd", _cmds)
+def test_package_proxy(cmd: str):
+    runner = CliRunner()
+    result = runner.invoke(
+        generate,
+        [
+            cmd,
+            "--pkg-manager",
+            "apt",
+            "--base-image",
+            "debian",
+            "--package-proxy",
+            "http://apt-cache:3142",
+            "--install",
+            "curl",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert (
+        "printf 'Acquire::http::Proxy \"%s\";\\n' http://apt-cache:3142"
+        in result.output
+    )
+    assert "rm -f /etc/apt/apt.conf.d/00reproenv-proxy" in result.output
+
+
+def test_fetch(tmp_path: Path):
+    from reproenv.cli.cli import cli
+
+    # file:// URLs do not need a server.
+    artifact = tmp_path / "foo-1.0"
+    artifact.write_text("foo")
+    (tmp_path / "templates").mkdir()
+    (tmp_path / "templates" / "foo.yaml").write_text(
+        f"""\
+name: foo
+binaries:
+  urls:
+    '1.0': {artifact.as_uri()}
+  instructions: echo {{{{ self.version }}}}
+  arguments:
+    required: [version]
+"""
+    )
+    runner = CliRunner()
+    args = [
+        "fetch",
+        "--template-path",
+        str(tmp_path / "templates"),
+        "--cache-dir",
+        str(tmp_path / "cache"),
+        "foo:1.0",
+    ]
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 0, result.output
+    assert result.output.startswith("fetched")
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 0, result.output
+    assert result.output.startswith("cached")
+
+    result = runner.invoke(cli, args[:-1] + ["foo:2.0"])
+    assert result.exit_code != 0
+
+
+@pytest.mark.parametrize("cmd", _cmds)
+def test_source_build_options(cmd: str):
+    template_path = Path(__file__).parent
+    runner = CliRunner(env={"REPROENV_TEMPLATE_PATH": str(template_path)})
+    args = [cmd, "--pkg-manager", "apt", "--base-image", "debian"]
+    args += ["--build-jobs", "auto", "--ccache"]
+    args += ["--jq", "version=1.6", "method=source"]
+    result = runner.invoke(generate, args)
+    assert result.exit_code == 0, result.output
+    assert 'MAKEFLAGS="-j$(nproc)"' in result.output
+    assert "ccache" in result.output
+
+    result = runner.invoke(generate, args[:5] + ["--build-jobs", "0"])
+    assert result.exit_code != 0
+
+
+@pytest.mark.parametrize("cmd", _cmds)
+def test_template_args(cmd: str):
+    template_path = Path(__file__).parent
+    runner = CliRunner(env={"REPROENV_TEMPLATE_PATH": str(template_path)})
+    args = [cmd, "--pkg-manager", "apt", "--base-image", "debian"]
+    args += ["--template-arg", "version", "--jq", "version=1.6"]
+    result = runner.invoke(generate, args)
+    assert result.exit_code == 0, result.output
+    assert "JQ_VERSION=1.6" in result.output
+    assert 'case "${JQ_VERSION}" in "1.5")' in result.output
+
+
+def test_docker_reorder_for_cache():
+    runner = CliRunner(mix_stderr=False)
+    args = ["docker", "--pkg-manager", "apt", "--base-image", "debian"]
+    args += ["--label", "BUILD=1", "--run", "echo foobar", "--reorder-for-cache"]
+    result = runner.invoke(generate, args)
+    assert result.exit_code == 0, result.output
+    assert result.stdout == 'FROM debian\nRUN echo foobar\nLABEL BUILD="1"\n'
+    assert result.stderr.startswith("moved 'LABEL BUILD=\"1\"' from position 1 to 2")
+
+
+def test_diff(tmp_path: Path):
+    from reproenv.cli.cli import cli
+
+    template_path = str(Path(__file__).parent)
+    spec = """\
+pkg_manager: apt
+instructions:
+- name: from_
+  kwds: {{base_image: debian}}
+- name: run
+  kwds: {{command: echo {}}}
+- name: jq
+  kwds: {{version: '1.6'}}
+"""
+    (tmp_path / "old.yaml").write_text(spec.format("foo"))
+    (tmp_path / "new.yaml").write_text(spec.format("bar"))
+    args = ["diff", "--template-path", template_path, str(tmp_path / "old.yaml")]
+
+    runner = CliRunner()
+    result = runner.invoke(cli, args + [str(tmp_path / "old.yaml")])
+    assert result.exit_code == 0, result.output
+    assert result.output.endswith("4 cached, 0 rebuilt, estimated cost 0\n")
+
+    result = runner.invoke(cli, args + [str(tmp_path / "new.yaml")])
+    assert result.exit_code == 1, result.output
+    assert "  cached   FROM debian\n" in result.output
+    assert "  rebuild  RUN echo bar\n" in result.output
+    assert "[jq (binaries)]" in result.output
+
+    result = runner.invoke(
+        cli, args + ["--target", "singularity", str(tmp_path / "new.yaml")]
+    )
+    assert result.exit_code == 1, result.output
+    assert "- %post    echo foo\n+ %post    echo bar\n" in result.output
+
+
+def test_generate_all(tmp_path: Path):
+    template_path = str(Path(__file__).parent)
+    args = ["--template-path", template_path, "all", "--pkg-manager", "apt"]
+    args += ["--base-image", "debian", "--jq", "version=1.6", "--run", "echo foo"]
+    runner = CliRunner()
+    result = runner.invoke(generate, args)
+    assert result.exit_code != 0
+    assert "at least one of --output-docker" in result.output
+
+    dockerfile = tmp_path / "Dockerfile"
+    recipe = tmp_path / "Singularity"
+    args += ["--output-docker", str(dockerfile), "--output-singularity", str(recipe)]
+    result = runner.invoke(generate, args)
+    assert result.exit_code == 0, result.output
+    for path, cmd in [(dockerfile, "docker"), (recipe, "singularity")]:
+        result = runner.invoke(generate, args[:2] + [cmd] + args[3:-4])
+        assert result.exit_code == 0, result.output
+        assert path.read_text() == result.output
+
+
+def test_generate_batch(tmp_path: Path):
+    template_path = str(Path(__file__).parent)
+    spec = {
+        "pkg_manager": "apt",
+        "instructions": [
+            {"name": "from_", "kwds": {"base_image": "debian"}},
+            {"name": "jq", "kwds": {"version": "1.6"}},
+        ],
+    }
+    manifest = tmp_path / "specs.yaml"
+    manifest.write_text(json.dumps([spec, {"pkg_manager": "apt"}]))
+    runner = CliRunner(mix_stderr=False)
+    args = ["--template-path", template_path, "batch", "-o", str(tmp_path / "out")]
+    args += ["--target", "docker", "--jobs", "1", str(manifest)]
+    result = runner.invoke(generate, args)
+    assert result.exit_code == 1
+    assert "1 of 2 specs failed" in result.stderr
+
+    expected = runner.invoke(
+        generate,
+        ["--template-path", template_path, "docker", "-p", "apt", "-b", "debian"]
+        + ["--jq", "version=1.6"],
+    )
+    assert (tmp_path / "out" / "0" / "Dockerfile").read_text() == expected.stdout
+    results = (tmp_path / "out" / "results.jsonl").read_text().splitlines()
+    assert json.loads(results[0])["error"] is None
+    assert json.loads(results[1])["error"].startswith("RendererError")
+
+
+def test_generate_batch_shards(tmp_path: Path):
+    specs = [
+        {
+            "pkg_manager": "apt",
+            "instructions": [
+                {"name": "from_", "kwds": {"base_image": f"debian:{i}"}},
+                {"name": "run", "kwds": {"command": "echo foo"}},
+            ],
+        }
+        for i in range(6)
+    ]
+    manifest = tmp_path / "specs.jsonl"
+    manifest.write_text("\n".join(map(json.dumps, specs)))
+    out = tmp_path / "out"
+    runner = CliRunner(mix_stderr=False)
+    for index in (1, 2):
+        args = ["batch", "-o", str(out), "-j", "1", "--shard", f"{index}/2"]
+        result = runner.invoke(generate, args + [str(manifest)])
+        assert result.exit_code == 0, result.output
+    assert len(list(out.glob("*/Dockerfile"))) == len(specs)
+
+    result = runner.invoke(generate, ["batch", "-o", str(out), "--shard", "3/2", "x"])
+    assert result.exit_code != 0
+
+    merged = tmp_path / "merged.jsonl"
+    args = ["merge", "-o", str(merged), str(manifest)]
+    args += [str(out / "results-1-of-2.jsonl")]
+    result = runner.invoke(generate, args)
+    assert result.exit_code == 1
+    assert "missing: " in result.stderr
+
+    result = runner.invoke(generate, args + [str(out / "results-2-of-2.jsonl")])
+    assert result.exit_code == 0, result.output
+    lines = merged.read_text().splitlines()
+    assert [json.loads(line)["position"] for line in lines] == list(range(len(specs)))
+
+
+def test_generate_matrix(tmp_path: Path):
+    template_path = str(Path(__file__).parent)
+    (tmp_path / "matrix.yaml").write_text(
+        """\
+pkg_manager: apt
+axes:
+- - {name: from_, kwds: {base_image: debian}}
+- - {name: jq, kwds: {version: '1.5'}}
+  - {name: jq, kwds: {version: '1.6'}}
+"""
+    )
+    runner = CliRunner(mix_stderr=False)
+    args = ["--template-path", template_path, "matrix", str(tmp_path / "matrix.yaml")]
+    result = runner.invoke(generate, args)
+    assert result.exit_code == 0, result.output
+    assert result.stdout.startswith("FROM debian AS shared-1\n")
+    assert "FROM shared-1 AS debian-jq-1.6\n" in result.stdout
+    assert "debian-jq-1.5: --target debian-jq-1.5\n" in result.stderr
+    assert "2 variants build 4 of 6 instructions" in result.stderr
+
+
+def test_generate_matrix_bake(tmp_path: Path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    template_path = str(Path(__file__).parent)
+    Path("matrix.yaml").write_text(
+        """\
+pkg_manager: apt
+axes:
+- - {name: from_, kwds: {base_image: debian}}
+- - {name: jq, kwds: {version: '1.5'}}
+  - {name: jq, kwds: {version: '1.6'}}
+"""
+    )
+    runner = CliRunner(mix_stderr=False)
+    args = ["--template-path", template_path, "matrix", "--bake", "bake.json"]
+    result = runner.invoke(generate, args + ["matrix.yaml"])
+    assert result.exit_code != 0
+    assert "requires the Dockerfile" in result.stderr
+
+    args += ["--output", "Dockerfile", "--cache-ref", "r/cache", "matrix.yaml"]
+    result = runner.invoke(generate, args)
+    assert result.exit_code == 0, result.output
+    d = json.loads(Path("bake.json").read_text())
+    assert d["group"]["shared-1"] == {"targets": ["debian-jq-1_5", "debian-jq-1_6"]}
+    assert d["target"]["debian-jq-1_6"]["target"] == "debian-jq-1.6"
+    assert d["target"]["debian-jq-1_6"]["dockerfile"] == "Dockerfile"
+    assert d["target"]["debian-jq-1_6"]["cache-from"] == [
+        "type=registry,ref=r/cache:debian-jq-1.6"
+    ]
+
+
+def test_version():
+    import reproenv
+    from reproenv.cli.cli import cli
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ["--version"], prog_name="reproenv")
+    assert result.exit_code == 0, result.output
+    assert result.output == f"reproenv version {reproenv.__version__}\n"
+
+
+def test_template_options_only_for_used_templates(tmp_path: Path, monkeypatch):
+    from reproenv.cli import cli as cli_module
+
+    template_path = tmp_path / "templates"
+    template_path.mkdir()
+    for i in range(20):
+        (template_path / f"tool{i}.yaml").write_text(
+            f"name: tool{i}\nsource:\n  instructions: echo tool{i}\n"
+        )
+    helped = []
+    create_help = cli_module._create_help_for_template
+
+    def _create_help(template):
+        helped.append(template.name)
+        return create_help(template)
+
+    monkeypatch.setattr(cli_module, "_create_help_for_template", _create_help)
+    runner = CliRunner()
+    args = ["--template-path", str(template_path), "docker"]
+    args += ["--pkg-manager", "apt", "--base-image", "debian"]
+    result = runner.invoke(generate, args + ["--tool3", "method=source"])
+    assert result.exit_code == 0, result.output
+    assert "RUN echo tool3" in result.output
+    assert helped == []
+
+    # Options of templates that were used before are not kept.
+    result = runner.invoke(generate, args + ["--tool4", "method=source"])
+    assert result.exit_code == 0, result.output
+    assert "tool3" not in result.output
+
+    result = runner.invoke(generate, args[:3] + ["--help"])
+    assert result.exit_code == 0, result.output
+    assert "--tool19" in result.output
+    assert {f"tool{i}" for i in range(20)}.issubset(helped)
+
+
+def test_many_options_keep_order():
+    runner = CliRunner()
+    args = ["docker", "--pkg-manager", "apt", "--base-image", "debian"]
+    for i in range(300):
+        args += ["--run", f"echo {i}", "--env", f"A{i}={i}", f"B{i}={i}"]
+    result = runner.invoke(generate, args)
+    assert result.exit_code == 0, result.output
+    lines = result.output.splitlines()
+    assert lines[1] == "RUN echo 0"
+    assert lines[2] == 'ENV A0="0" \\'
+    assert lines[3] == '    B0="0"'
+    assert lines[-1] == '    B299="299"'
+    assert lines[-3] == "RUN echo 299"
+
+
+@pytest.mark.parametrize("cmd", _cmds)
+def test_spec(cmd: str, tmp_path: Path):
+    template_path = Path(__file__).parent
+    runner = CliRunner(env={"REPROENV_TEMPLATE_PATH": str(template_path)})
+    args = [cmd, "--pkg-manager", "apt", "--base-image", "debian"]
+    args += ["--run", "echo foo", "--jq", "version=1.6"]
+    expected = runner.invoke(generate, args)
+    assert expected.exit_code == 0, expected.output
+
+    d = {
+        "pkg_manager": "apt",
+        "instructions": [
+            {"name": "from_", "kwds": {"base_image": "debian"}},
+            {"name": "run", "kwds": {"command": "echo foo"}},
+            {"name": "jq", "kwds": {"version": "1.6"}},
+        ],
+    }
+    (tmp_path / "spec.json").write_text(json.dumps(d))
+    result = runner.invoke(generate, [cmd, "--spec", str(tmp_path / "spec.json")])
+    assert result.exit_code == 0, result.output
+    assert result.output == expected.output
+
+    # YAML on stdin, and options on the command line override those of the spec.
+    spec = "pkg_manager: yum\n" + yaml.safe_dump({"instructions": d["instructions"]})
+    result = runner.invoke(generate, [cmd, "--spec", "-", "-p", "apt"], input=spec)
+    assert result.exit_code == 0, result.output
+    assert result.output == expected.output
+
+    result = runner.invoke(generate, [cmd, "--spec", "-", "--run", "ls"], input=spec)
+    assert result.exit_code != 0
+    assert "cannot be combined" in result.output
+    result = runner.invoke(generate, [cmd, "--spec", "-"], input="[]")
+    assert result.exit_code != 0
+    assert "expected a renderer dictionary" in result.output
+
+    # Invalid specs are reported without a traceback.
+    spec = yaml.safe_dump({**d, "instructions": [{"name": "bar", "kwds": {}}]})
+    for extra in [[], ["--reorder-for-cache"]] if cmd == "docker" else [[]]:
+        result = runner.invoke(generate, [cmd, "--spec", "-", *extra], input=spec)
+        assert result.exit_code == 1
+        assert isinstance(result.exception, SystemExit)
+        assert result.output.startswith("Error: Invalid renderer dictionary")
+
+    # Errors in templates include their cause.
+    result = runner.invoke(generate, args[:-1] + ["version=0.1"])
+    assert result.exit_code == 1
+    assert result.output == (
+        "Error: Error on template 'jq': Unknown version '0.1'. Allowed versions are"
+        " '1.6', '1.5'.\n"
+    )
+
+
+@pytest.mark.parametrize("cmd", _cmds)
+def test_output_only_written_if_changed(cmd: str, tmp_path: Path):
+    runner = CliRunner()
+    output = tmp_path / "spec"
+    args = [cmd, "--pkg-manager", "apt", "--base-image", "debian", "-o", str(output)]
+    result = runner.invoke(generate, args + ["--run", "echo foo"])
+    assert result.exit_code == 0, result.output
+    assert result.output == ""
+    assert "echo foo" in output.read_text()
+    output.chmod(0o640)
+    os.utime(output, (0, 0))
+
+    result = runner.invoke(generate, args + ["--run", "echo foo"])
+    assert result.exit_code == 0, result.output
+    assert output.stat().st_mtime == 0
+
+    result = runner.invoke(generate, args + ["--run", "echo bar"])
+    assert result.exit_code == 0, result.output
+    assert output.stat().st_mtime != 0
+    assert "echo bar" in output.read_text()
+    assert output.stat().st_mode & 0o777 == 0o640
+    # Temporary files are removed.
+    assert list(tmp_path.iterdir()) == [output]
+
+    # Errors are reported without a traceback.
+    args[-1] = str(tmp_path / "missing" / "spec")
+    result = runner.invoke(generate, args + ["--run", "echo foo"])
+    assert result.exit_code == 1
+    assert isinstance(result.exception, SystemExit)
+    assert "Could not open file" in result.output
+    assert "No such file or directory" in result.output
+
+
+def test_render_cache(tmp_path: Path, monkeypatch):
+    from reproenv.cli.cli import cli
+
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    runner = CliRunner()
+    args = ["generate", "--render-cache", "docker", "-p", "apt", "-b", "debian"]
+    result = runner.invoke(cli, args + ["--run", "echo foo"])
+    assert result.exit_code == 0, result.output
+    assert "echo foo" in result.output
+    cached = list((tmp_path / "reproenv" / "renders").glob("*/*"))
+    assert len(cached) == 1
+    cached[0].write_text("FROM cached")
+    result = runner.invoke(cli, args + ["--run", "echo foo"])
+    assert result.exit_code == 0, result.output
+    assert result.output == "FROM cached\n"
+    # The cache is opt-in.
+    result = runner.invoke(cli, args[:1] + args[2:] + ["--run", "echo foo"])
+    assert "echo foo" in result.output
+
+    result = runner.invoke(cli, ["cache", "stats", "--json"])
+    assert result.exit_code == 0, result.output
+    stats = json.loads(result.output)
+    assert (stats["entries"], stats["size"]) == (1, len("FROM cached"))
+    result = runner.invoke(cli, ["cache", "clear"])
+    assert result.exit_code == 0, result.output
+    assert not list((tmp_path / "reproenv" / "renders").glob("*/*"))
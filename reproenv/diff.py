@@ -0,0 +1,169 @@
+"""Predict which parts of a container build are invalidated by a change.
+
+Docker reuses cached layers until the first instruction that differs, and rebuilds
+every instruction after it. Singularity does not cache, so any change rebuilds the
+image, but it is still useful to know which `%post` sections changed.
+
+Costs are rough estimates in units of one plain `RUN` instruction. Installing a
+template from source is much more expensive than installing its binaries, and
+instructions that only change metadata (e.g., `ENV` and `LABEL`) are nearly free.
+"""
+
+import difflib
+import typing as ty
+
+from reproenv import ir
+from reproenv.renderers import _docker_instruction
+from reproenv.renderers import _Renderer
+from reproenv.renderers import _singularity_post
+from reproenv.renderers import DockerRenderer
+from reproenv.renderers import SingularityRenderer
+
+_TEMPLATE_COSTS = {"binaries": 5, "source": 20}
+_INSTRUCTION_COSTS = {ir.Run: 1, ir.Copy: 1}
+
+_RendererOrDict = ty.Union[_Renderer, ty.Mapping]
+
+
+class Step(ty.NamedTuple):
+    """An instruction in a Dockerfile, or a section of `%post`."""
+
+    # First line of the instruction.
+    instruction: str
+    # Template that added the instruction (e.g., "jq (binaries)"), if known.
+    template: ty.Optional[str]
+    cost: int
+
+
+class DockerDiff(ty.NamedTuple):
+    """Layers of a Dockerfile that are reused from the cache and rebuilt."""
+
+    reused: ty.List[Step]
+    rebuilt: ty.List[Step]
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.rebuilt)
+
+    @property
+    def cost(self) -> int:
+        """Estimated cost of rebuilding the image."""
+        return sum(step.cost for step in self.rebuilt)
+
+
+class SingularityDiff(ty.NamedTuple):
+    """Sections of a Singularity recipe that changed."""
+
+    # Sections other than `%post` that changed, e.g., "%environment".
+    sections: ty.List[str]
+    # Sections of `%post` in the new recipe that are new or changed.
+    post_changed: ty.List[Step]
+    # Sections of `%post` in the old recipe that were removed or changed.
+    post_removed: ty.List[Step]
+    # Singularity rebuilds the whole image after any change, so this is the cost of
+    # all of `%post`, or zero if nothing changed.
+    cost: int
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.sections or self.post_changed or self.post_removed)
+
+
+def _steps(
+    renderer_cls: ty.Type[_Renderer], renderer_or_dict: _RendererOrDict
+) -> ty.Tuple[_Renderer, ty.List[ir.Instruction], ty.List[Step]]:
+    """Return the renderer, its final instructions, and its Dockerfile instructions
+    or `%post` sections.
+    """
+    if isinstance(renderer_or_dict, _Renderer):
+        if not isinstance(renderer_or_dict, renderer_cls):
+            raise TypeError(
+                f"expected '{renderer_cls.__name__}' but got"
+                f" '{type(renderer_or_dict).__name__}'"
+            )
+        renderer = renderer_or_dict
+    else:
+        renderer = renderer_cls.from_dict(renderer_or_dict)
+
+    instructions = renderer._final_ir()
+    steps = []
+    for instruction in instructions:
+        if isinstance(renderer, DockerRenderer):
+            text = _docker_instruction(instruction)
+        elif isinstance(instruction, (ir.Arg, ir.Run, ir.User, ir.Workdir)):
+            text = _singularity_post(instruction)
+        else:
+            # Not part of `%post`.
+            continue
+        cost = _INSTRUCTION_COSTS.get(type(instruction), 0)
+        # Templates are expensive to install, but their environment is not.
+        if instruction.origin is not None and isinstance(instruction, ir.Run):
+            method = instruction.origin.rsplit("(", 1)[1].rstrip(")")
+            cost = _TEMPLATE_COSTS.get(method, cost)
+        steps.append(Step(instruction=text, template=instruction.origin, cost=cost))
+    return renderer, instructions, steps
+
+
+def _first_line(step: Step) -> Step:
+    lines = step.instruction.splitlines()
+    return step._replace(instruction=lines[0] if lines else "")
+
+
+def diff_docker(old: _RendererOrDict, new: _RendererOrDict) -> DockerDiff:
+    """Return the layers of the new Dockerfile that are reused from the cache of the
+    old Dockerfile, and the layers that are rebuilt.
+
+    `old` and `new` are `DockerRenderer` instances or renderer dictionaries.
+
+    Docker also invalidates the cache of `COPY` and `ADD` instructions when the
+    copied files change. That is not taken into account here.
+    """
+    _, _, old_steps = _steps(DockerRenderer, old)
+    _, _, new_steps = _steps(DockerRenderer, new)
+    n_reused = 0
+    for old_step, new_step in zip(old_steps, new_steps):
+        if old_step.instruction != new_step.instruction:
+            break
+        n_reused += 1
+    return DockerDiff(
+        reused=[_first_line(s) for s in new_steps[:n_reused]],
+        rebuilt=[_first_line(s) for s in new_steps[n_reused:]],
+    )
+
+
+def diff_singularity(old: _RendererOrDict, new: _RendererOrDict) -> SingularityDiff:
+    """Return the sections of the new Singularity recipe that changed.
+
+    `old` and `new` are `SingularityRenderer` instances or renderer dictionaries.
+    """
+    old_renderer, old_ir, old_steps = _steps(SingularityRenderer, old)
+    new_renderer, new_ir, new_steps = _steps(SingularityRenderer, new)
+    old_sections = ty.cast(SingularityRenderer, old_renderer)._sections(old_ir)
+    new_sections = ty.cast(SingularityRenderer, new_renderer)._sections(new_ir)
+
+    sections = []
+    if old_sections["header"] != new_sections["header"]:
+        sections.append("header")
+    for name in ("files", "environment", "runscript", "labels"):
+        if old_sections[name] != new_sections[name]:
+            sections.append(f"%{name}")
+
+    post_changed: ty.List[Step] = []
+    post_removed: ty.List[Step] = []
+    matcher = difflib.SequenceMatcher(
+        a=[s.instruction for s in old_steps],
+        b=[s.instruction for s in new_steps],
+        autojunk=False,
+    )
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != "equal":
+            post_removed.extend(_first_line(s) for s in old_steps[i1:i2])
+            post_changed.extend(_first_line(s) for s in new_steps[j1:j2])
+
+    changed = bool(sections or post_changed or post_removed)
+    return SingularityDiff(
+        sections=sections,
+        post_changed=post_changed,
+        post_removed=post_removed,
+        cost=sum(s.cost for s in new_steps) if changed else 0,
+    )
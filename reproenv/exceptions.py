@@ -5,6 +5,10 @@ class ReproEnvError(Exception):
     pass
 
 
+class FetchError(ReproEnvError):
+    pass
+
+
 class RendererError(ReproEnvError):
     pass
 
@@ -0,0 +1,214 @@
+"""Prefetch artifacts that templates download into a local cache.
+
+The cache is content-addressed. Each artifact is stored under
+`<cache_dir>/sha256/<digest>`, and `<cache_dir>/urls/<sha256 of url>` holds the
+digest of the artifact that was downloaded from that URL.
+"""
+
+import concurrent.futures
+import hashlib
+import http.client
+import os
+from pathlib import Path
+import tempfile
+import time
+import typing as ty
+import urllib.error
+import urllib.request
+
+from reproenv.exceptions import FetchError
+from reproenv.state import _TemplateRegistry
+from reproenv.state import _validate_renderer
+from reproenv.template import Template
+
+# Size of chunks read from the network and written to disk.
+_CHUNK_SIZE = 1024 * 1024
+
+
+class FetchResult(ty.NamedTuple):
+    """Result of fetching one URL."""
+
+    url: str
+    # Path to the artifact in the cache, or `None` if the download failed.
+    path: ty.Optional[Path]
+    # `True` if the artifact was already in the cache.
+    cached: bool
+    error: ty.Optional[str] = None
+
+
+def _default_cache_dir() -> Path:
+    cache_home = os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")
+    return Path(cache_home) / "reproenv" / "artifacts"
+
+
+def _url_key(url: str) -> str:
+    return hashlib.sha256(url.encode()).hexdigest()
+
+
+def cached_path(
+    url: str, cache_dir: ty.Union[str, os.PathLike] = None
+) -> ty.Optional[Path]:
+    """Return the path to the cached artifact for `url`, or `None` if the artifact
+    is not in the cache.
+    """
+    cache_dir = _default_cache_dir() if cache_dir is None else Path(cache_dir)
+    index = cache_dir / "urls" / _url_key(url)
+    try:
+        digest = index.read_text().strip()
+    except FileNotFoundError:
+        return None
+    path = cache_dir / "sha256" / digest
+    return path if path.is_file() else None
+
+
+def _urls_for_template(
+    name: str, kwds: ty.Mapping[str, str], pkg_manager: str = "apt"
+) -> ty.List[str]:
+    """Return the URLs that a registered template downloads given its keyword
+    arguments.
+    """
+    template_dict = _TemplateRegistry.get(name)
+    kwds = dict(kwds)
+    # Same default as `_Renderer.add_registered_template`.
+    method = kwds.pop("method", None)
+    if method is None:
+        method = "binaries" if "binaries" in template_dict else "source"
+    if method not in template_dict:
+        raise FetchError(
+            f"Installation method '{method}' not defined for template '{name}'."
+        )
+    template_method = getattr(Template(template_dict), method)
+    urls: ty.List[str] = []
+    if method == "binaries" and kwds.get("version") in template_method.urls:
+        urls.append(template_method.urls[kwds["version"]])
+    if pkg_manager == "apt":
+        urls.extend(template_method.dependencies("debs"))
+    return urls
+
+
+def urls_for_renderer_dict(d: ty.Mapping) -> ty.List[str]:
+    """Return the URLs of artifacts that would be downloaded by the templates in a
+    renderer dictionary. The dictionary is validated first.
+    """
+    _validate_renderer(d)
+    urls: ty.List[str] = []
+    for mapping in d["instructions"]:
+        name = mapping["name"]
+        if name.lower() in _TemplateRegistry.keys():
+            urls.extend(_urls_for_template(name, mapping["kwds"], d["pkg_manager"]))
+    # Remove duplicates but keep the order.
+    return list(dict.fromkeys(urls))
+
+
+def urls_for_template_versions(pairs: ty.Iterable[str]) -> ty.List[str]:
+    """Return the URLs of artifacts for `template:version` pairs."""
+    urls: ty.List[str] = []
+    for pair in pairs:
+        name, sep, version = pair.partition(":")
+        if not sep or not version:
+            raise FetchError(f"Expected 'template:version' but got '{pair}'.")
+        urls.extend(_urls_for_template(name, {"version": version}))
+    return list(dict.fromkeys(urls))
+
+
+def _download(url: str, cache_dir: Path, timeout: float) -> Path:
+    """Download `url` into the cache and return the path to the artifact."""
+    objects = cache_dir / "sha256"
+    objects.mkdir(parents=True, exist_ok=True)
+    hasher = hashlib.sha256()
+    fd, tmp = tempfile.mkstemp(dir=objects, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f, urllib.request.urlopen(
+            url, timeout=timeout
+        ) as response:
+            for chunk in iter(lambda: response.read(_CHUNK_SIZE), b""):
+                hasher.update(chunk)
+                f.write(chunk)
+            # Reading returns fewer bytes instead of raising an error if the server
+            # closes the connection early.
+            remaining = getattr(response, "length", None)
+            if remaining:
+                raise http.client.IncompleteRead(b"", remaining)
+        path = objects / hasher.hexdigest()
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    # Write the index atomically, so concurrent readers never see partial digests.
+    index = cache_dir / "urls"
+    index.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=index, prefix=".tmp-")
+    with os.fdopen(fd, "w") as f:
+        f.write(hasher.hexdigest())
+    os.replace(tmp, index / _url_key(url))
+    return path
+
+
+def _fetch_one(
+    url: str, cache_dir: Path, retries: int, timeout: float, force: bool
+) -> FetchResult:
+    if not force:
+        path = cached_path(url, cache_dir)
+        if path is not None:
+            return FetchResult(url=url, path=path, cached=True)
+    error = ""
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(min(2 ** (attempt - 1), 30))
+        try:
+            path = _download(url, cache_dir, timeout=timeout)
+            return FetchResult(url=url, path=path, cached=False)
+        except urllib.error.HTTPError as e:
+            error = str(e)
+            # Client errors (e.g., 404) do not go away when retrying.
+            if 400 <= e.code < 500 and e.code not in {408, 429}:
+                break
+        except (OSError, ValueError, http.client.HTTPException) as e:
+            # E.g., `http.client.IncompleteRead` if the connection is closed early.
+            error = str(e)
+    return FetchResult(url=url, path=None, cached=False, error=error)
+
+
+def fetch(
+    urls: ty.Iterable[str],
+    cache_dir: ty.Union[str, os.PathLike] = None,
+    jobs: int = 8,
+    retries: int = 3,
+    timeout: float = 60,
+    force: bool = False,
+) -> ty.List[FetchResult]:
+    """Download URLs concurrently into a content-addressed cache.
+
+    URLs that are already in the cache are not downloaded again, unless `force` is
+    true. Failed downloads do not raise an exception. Instead, the `error` field of
+    their result is set.
+
+    Parameters
+    ----------
+    urls : iterable of str
+        URLs to download.
+    cache_dir : str or Path-like
+        Cache directory. Default is `$XDG_CACHE_HOME/reproenv/artifacts`.
+    jobs : int
+        Number of concurrent downloads.
+    retries : int
+        Number of times a failed download is retried.
+    timeout : float
+        Timeout in seconds for network operations.
+    force : bool
+        If true, download artifacts even if they are in the cache.
+
+    Returns
+    -------
+    List of `FetchResult`, in the same order as `urls`.
+    """
+    if jobs < 1:
+        raise ValueError("jobs must be at least 1")
+    cache_dir = _default_cache_dir() if cache_dir is None else Path(cache_dir)
+    urls = list(dict.fromkeys(urls))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(_fetch_one, url, cache_dir, retries, timeout, force)
+            for url in urls
+        ]
+        return [future.result() for future in futures]
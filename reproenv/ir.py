@@ -0,0 +1,94 @@
+"""Typed instructions shared by all renderers.
+
+The builder methods of renderers (e.g., `.run()` and `.add_template()`) append these
+instructions to a list. Renderers emit the list as a Dockerfile or Singularity
+recipe. Passes are functions that take a list of instructions and return a new list.
+They run before a renderer emits its output, so a transformation is written once
+and applies to every target.
+
+Every instruction has an `origin`, which is the template that added it (e.g.,
+"jq (binaries)"), or `None` if it was added directly.
+"""
+
+import typing as ty
+
+
+class Arg(ty.NamedTuple):
+    key: str
+    value: ty.Optional[str] = None
+    origin: ty.Optional[str] = None
+
+
+class Copy(ty.NamedTuple):
+    source: ty.Tuple[str, ...]
+    destination: str
+    # Build stage or image to copy from.
+    from_: ty.Optional[str] = None
+    chown: ty.Optional[str] = None
+    origin: ty.Optional[str] = None
+
+
+class Env(ty.NamedTuple):
+    # Pairs of (key, value), in order.
+    env: ty.Tuple[ty.Tuple[str, str], ...]
+    origin: ty.Optional[str] = None
+
+
+class From(ty.NamedTuple):
+    base_image: str
+    # Name of the build stage.
+    as_: ty.Optional[str] = None
+    origin: ty.Optional[str] = None
+
+
+class Label(ty.NamedTuple):
+    # Pairs of (key, value), in order.
+    labels: ty.Tuple[ty.Tuple[str, str], ...]
+    origin: ty.Optional[str] = None
+
+
+class Mount(ty.NamedTuple):
+    """Mount that exists only while a `Run` instruction runs."""
+
+    # "bind" mounts a file of the build context, "cache" a directory that is kept
+    # across builds.
+    type: str
+    target: str
+    # Path of a bind mount relative to the build context.
+    source: ty.Optional[str] = None
+    # Other options, e.g., (("mode", "0777"),).
+    options: ty.Tuple[ty.Tuple[str, str], ...] = ()
+
+
+class Run(ty.NamedTuple):
+    # Shell commands, one per line.
+    command: str
+    # Build-time mounts. Targets that do not support mounts copy bind mounts into
+    # the container for the command, and remove bind and cache mounts afterwards.
+    mounts: ty.Tuple[Mount, ...] = ()
+    origin: ty.Optional[str] = None
+
+
+class User(ty.NamedTuple):
+    user: str
+    origin: ty.Optional[str] = None
+
+
+class Workdir(ty.NamedTuple):
+    path: str
+    origin: ty.Optional[str] = None
+
+
+Instruction = ty.Union[Arg, Copy, Env, From, Label, Run, User, Workdir]
+
+Pass = ty.Callable[[ty.List[Instruction]], ty.List[Instruction]]
+
+
+def run_passes(
+    instructions: ty.Iterable[Instruction], passes: ty.Iterable[Pass]
+) -> ty.List[Instruction]:
+    """Return the instructions after applying each pass in order."""
+    result = list(instructions)
+    for pass_ in passes:
+        result = list(pass_(result))
+    return result
@@ -0,0 +1,197 @@
+"""Render a matrix of variants as one multi-stage Dockerfile.
+
+Variants of an image (e.g., base images by versions of templates) often share long
+identical prefixes of instructions. This module builds a prefix tree of the
+instructions of all variants. Every shared prefix becomes a build stage that is built
+once, and each variant becomes a named stage that extends the stage of its longest
+shared prefix. Build a variant with `docker build --target <stage>`.
+
+A matrix is a dictionary with the options of a renderer dictionary (e.g.,
+`pkg_manager`) and `axes`. Each axis is a list of alternatives, and each alternative
+is one instruction of a renderer dictionary or a list of them. Variants are all
+combinations of one alternative per axis, with instructions in the order of the axes.
+For example, this matrix has four variants::
+
+    pkg_manager: apt
+    axes:
+    - - {name: from_, kwds: {base_image: "debian:buster"}}
+      - {name: from_, kwds: {base_image: "ubuntu:focal"}}
+    - - {name: install, kwds: {pkgs: [git]}}
+    - - {name: jq, kwds: {version: "1.5"}}
+      - {name: jq, kwds: {version: "1.6"}}
+"""
+
+import itertools
+import re
+import typing as ty
+
+from reproenv import ir
+from reproenv.batch import in_shard
+from reproenv.batch import spec_digest
+from reproenv.exceptions import RendererError
+from reproenv.renderers import _docker_instruction
+from reproenv.renderers import DockerRenderer
+from reproenv.state import _TemplateRegistry
+
+
+class MatrixResult(ty.NamedTuple):
+    """Multi-stage Dockerfile of a matrix."""
+
+    dockerfile: str
+    # Renderer dictionaries of the variants, by variant name.
+    variants: ty.Dict[str, ty.Dict]
+    # Build stage of each variant, by variant name.
+    targets: ty.Dict[str, str]
+    # Parent stage of each stage, or `None` if the stage starts from a base image.
+    stages: ty.Dict[str, ty.Optional[str]]
+    # Number of instructions in all variants, and number of instructions that are
+    # built with the multi-stage Dockerfile.
+    n_instructions: int
+    n_instructions_built: int
+
+
+class _Node:
+    """Node of a prefix tree of instructions."""
+
+    def __init__(self, instruction: ty.Optional[ir.Instruction] = None):
+        self.instruction = instruction
+        # Children by their Dockerfile instruction.
+        self.children: ty.Dict[str, _Node] = {}
+        # Names of variants whose last instruction is this one.
+        self.variants: ty.List[str] = []
+
+
+def expand_matrix(matrix: ty.Mapping) -> ty.List[ty.Dict]:
+    """Return the renderer dictionaries of all variants of a matrix."""
+    options = {k: v for k, v in matrix.items() if k != "axes"}
+    axes = []
+    for axis in matrix.get("axes", []):
+        axes.append([a if isinstance(a, list) else [a] for a in axis])
+    return [
+        {**options, "instructions": [i for alt in combination for i in alt]}
+        for combination in itertools.product(*axes)
+    ]
+
+
+def variant_name(d: ty.Mapping) -> str:
+    """Return a name for a variant that is a valid Docker build stage name, made of
+    its base image and the names and versions of its templates.
+    """
+    parts = []
+    for mapping in d["instructions"]:
+        name = mapping["name"]
+        if name == "from_":
+            parts.append(mapping["kwds"]["base_image"])
+        elif name.lower() in _TemplateRegistry.keys():
+            version = mapping["kwds"].get("version")
+            parts.append(name if version is None else f"{name}-{version}")
+    name = re.sub(r"[^a-z0-9_.-]+", "-", "-".join(parts).lower()).strip("-._")
+    if not name[:1].isalpha():
+        name = f"variant-{name}".rstrip("-")
+    return name
+
+
+def _instructions(name: str, d: ty.Mapping) -> ty.List[ir.Instruction]:
+    instructions = DockerRenderer.from_dict(d)._final_ir()
+    n_from = sum(isinstance(i, ir.From) for i in instructions)
+    if not instructions or not isinstance(instructions[0], ir.From) or n_from > 1:
+        raise RendererError(
+            f"Variant '{name}' must start with a base image and have one build stage."
+        )
+    return instructions
+
+
+def render_matrix(
+    matrix: ty.Union[ty.Mapping, ty.Sequence[ty.Mapping]],
+    shard: ty.Optional[ty.Tuple[int, int]] = None,
+) -> MatrixResult:
+    """Render the variants of a matrix as one multi-stage Dockerfile.
+
+    Parameters
+    ----------
+    matrix : dict or list of dict
+        A matrix (see the module documentation), or a list of renderer dictionaries
+        that are the variants.
+    shard : tuple of (int, int)
+        If given as `(index, count)`, only render the variants in this shard. See
+        `reproenv.batch.in_shard`.
+
+    Returns
+    -------
+    `MatrixResult`
+    """
+    specs = expand_matrix(matrix) if isinstance(matrix, ty.Mapping) else matrix
+    if shard is not None:
+        specs = [d for d in specs if in_shard(spec_digest(d), shard)]
+    if not specs:
+        raise RendererError("Matrix does not have any variants.")
+
+    variants: ty.Dict[str, ty.Dict] = {}
+    root = _Node()
+    n_instructions = 0
+    for d in specs:
+        name = unique = variant_name(d)
+        suffix = 2
+        while unique in variants:
+            unique = f"{name}-{suffix}"
+            suffix += 1
+        name = unique
+        variants[name] = dict(d)
+        node = root
+        for instruction in _instructions(name, d):
+            key = _docker_instruction(instruction)
+            node = node.children.setdefault(key, _Node(instruction))
+            n_instructions += 1
+        node.variants.append(name)
+
+    parts: ty.List[str] = []
+    targets: ty.Dict[str, str] = {}
+    stages: ty.Dict[str, ty.Optional[str]] = {}
+    n_built = 0
+    n_shared_stages = 0
+    # Stack of (first node of a stage, parent stage, build arguments of the parent).
+    todo: ty.List[ty.Tuple[_Node, ty.Optional[str], ty.List[ir.Arg]]]
+    todo = [(child, None, []) for child in reversed(list(root.children.values()))]
+    while todo:
+        first, parent, inherited = todo.pop()
+        node = first
+        body: ty.List[ir.Instruction] = []
+        args = list(inherited)
+        while True:
+            n_built += 1
+            if node is not first or parent is not None:
+                body.append(ty.cast(ir.Instruction, node.instruction))
+            if isinstance(node.instruction, ir.Arg):
+                args.append(node.instruction)
+            if node.variants or len(node.children) != 1:
+                break
+            node = next(iter(node.children.values()))
+        if node.variants:
+            stage = node.variants[0]
+        else:
+            n_shared_stages += 1
+            stage = f"shared-{n_shared_stages}"
+        for name in node.variants:
+            targets[name] = stage
+        stages[stage] = parent
+
+        if parent is None:
+            # The stage starts from the base image of the variants.
+            from_ = ty.cast(ir.From, first.instruction)
+            header = [_docker_instruction(from_._replace(as_=stage))]
+        else:
+            # Build arguments are scoped to build stages, so declare them again.
+            header = [f"FROM {parent} AS {stage}"]
+            header += [_docker_instruction(arg) for arg in inherited]
+        parts.append("\n".join(header + [_docker_instruction(i) for i in body]))
+        for child in reversed(list(node.children.values())):
+            todo.append((child, stage, args))
+
+    return MatrixResult(
+        dockerfile="\n\n".join(parts),
+        variants=variants,
+        targets=targets,
+        stages=stages,
+        n_instructions=n_instructions,
+        n_instructions_built=n_built,
+    )
@@ -14,16 +14,25 @@ General overview of rendering:
 
 from __future__ import annotations
 
+import copy
+import functools
 import os
+import posixpath
+import re
+import shlex
 import typing as ty
+import urllib.parse
 
 import jinja2
 
+from reproenv import ir
+from reproenv._lazy import lazy_import
 from reproenv.exceptions import RendererError
 from reproenv.exceptions import TemplateError
 from reproenv.state import _TemplateRegistry
 from reproenv.state import _validate_renderer
 from reproenv.template import _BaseInstallationTemplate
+from reproenv.template import _BinariesTemplate
 from reproenv.template import Template
 from reproenv.types import _SingularityHeaderType
 from reproenv.types import allowed_pkg_managers
@@ -31,6 +40,9 @@ from reproenv.types import allowed_installation_methods
 from reproenv.types import installation_methods_type
 from reproenv.types import pkg_managers_type
 
+# Only needed for vendored artifacts, and slow to import.
+_fetch = lazy_import("reproenv.fetch")
+
 # All jinja2 templates are instantiated from this environment object. It is
 # configured to dislike undefined attributes. For example, if a template is
 # created with the string '{{ foo.bar }}' and 'foo' does not have a 'bar'
@@ -43,12 +55,77 @@ _jinja_env = jinja2.Environment(undefined=jinja2.StrictUndefined)
 # TODO: add `install` instance method to `_Renderer`.
 
 
+@functools.lru_cache(maxsize=1024)
+def _compile_template(source: str) -> jinja2.Template:
+    """Return a compiled Jinja template. The same template strings are rendered for
+    many renderers, so each one is compiled once per process.
+    """
+    return _jinja_env.from_string(source)
+
+
+def _jinja_computed_kwds(
+    source: str, kwds: ty.Iterable[str], binaries: bool
+) -> ty.Set[str]:
+    """Return the keyword arguments in `kwds` that a Jinja template uses in an
+    expression (e.g., `{% if self.version == "1.6" %}` or a filter) instead of only
+    printing them with `{{ self.version }}`.
+
+    If `binaries` is true, `{{ self.urls[self.version] }}` also only prints. The URL
+    and destination of `download` (see `_download`) are printed too, because it
+    quotes them so that shell variables expand.
+    """
+    kwds = set(kwds)
+    computed: ty.Set[str] = set()
+
+    def is_kwd(node: jinja2.nodes.Node, names: ty.Set[str]) -> bool:
+        return (
+            isinstance(node, jinja2.nodes.Getattr)
+            and isinstance(node.node, jinja2.nodes.Name)
+            and node.node.name == "self"
+            and node.attr in names
+        )
+
+    def visit(node: jinja2.nodes.Node, printed: bool) -> None:
+        if is_kwd(node, kwds):
+            if not printed:
+                computed.add(node.attr)
+            return
+        if (
+            binaries
+            and printed
+            and isinstance(node, jinja2.nodes.Getitem)
+            and is_kwd(node.node, {"urls"})
+            and is_kwd(node.arg, {"version"})
+        ):
+            return
+        if (
+            printed
+            and isinstance(node, jinja2.nodes.Call)
+            and isinstance(node.node, jinja2.nodes.Name)
+            and node.node.name == "download"
+        ):
+            for i, arg in enumerate(node.args):
+                visit(arg, i < 2)
+            for keyword in node.kwargs:
+                visit(keyword.value, keyword.key in {"url", "destination"})
+            for child in (node.dyn_args, node.dyn_kwargs):
+                if child is not None:
+                    visit(child, False)
+            return
+        for child in node.iter_child_nodes():
+            # Expressions that are direct children of output nodes are printed.
+            visit(child, isinstance(node, jinja2.nodes.Output))
+
+    visit(_jinja_env.parse(source), printed=False)
+    return computed
+
+
 def _render_string_from_template(
     source: str, template: _BaseInstallationTemplate
 ) -> str:
     """Take a string from a template and render """
     source = source.replace("self.", "template.")
-    tmpl = _jinja_env.from_string(source)
+    tmpl = _compile_template(source)
     err = (
         "A template included in this renderer raised an error. Please check the"
         " template definition. A required argument might not be included in the"
@@ -62,8 +139,55 @@ def _render_string_from_template(
 
 
 class _Renderer:
+    """Base class for container specification renderers.
+
+    Parameters
+    ----------
+    pkg_manager : str
+        The system package manager used in the container.
+    users : set of str
+        Users that exist in the base image. Default is `{"root"}`.
+    package_proxy : str
+        URL of a caching proxy (e.g., "http://apt-cache:3142") to use for system
+        package installs. The proxy is configured before the first package install
+        and removed at the end of the build, so it does not persist in the image.
+    artifacts_dir : str
+        Artifact cache directory populated by `reproenv fetch`, relative to the build
+        context. If set, template downloads (binaries URLs and debs) are mounted from
+        this directory while the template's instructions run instead of being
+        downloaded, and `self.urls[self.version]` in templates renders as a
+        `file://` URL. Docker builds use BuildKit bind mounts, so the artifacts never
+        become part of a layer.
+    build_context : str
+        Directory of the build context, in which `artifacts_dir` is looked up when
+        rendering. Default is the current working directory.
+    build_jobs : int or "auto"
+        Number of parallel jobs for templates installed from source. This sets
+        `MAKEFLAGS` and `CMAKE_BUILD_PARALLEL_LEVEL`. "auto" uses all processors.
+    ccache : bool
+        If true, install ccache and use it to compile templates installed from source.
+        Docker builds keep the compiler cache in a BuildKit cache mount.
+    template_args : list of str
+        Keyword arguments of templates (e.g., "version") to set at build time. Each
+        becomes a build argument named after the template and the keyword (e.g.,
+        `JQ_VERSION`), whose default is the value that was passed. For binaries
+        templates, the URL of the version is selected when the image is built, so one
+        Dockerfile builds every version with `--build-arg JQ_VERSION=...`.
+        Templates that use these keyword arguments in Jinja expressions (e.g., in
+        `{% if %}`) instead of only printing them are rejected, except as the URL or
+        destination of `download`.
+    """
+
     def __init__(
-        self, pkg_manager: pkg_managers_type, users: ty.Optional[ty.Set[str]] = None
+        self,
+        pkg_manager: pkg_managers_type,
+        users: ty.Optional[ty.Set[str]] = None,
+        package_proxy: ty.Optional[str] = None,
+        artifacts_dir: ty.Optional[str] = None,
+        build_context: ty.Optional[str] = None,
+        build_jobs: ty.Union[int, str, None] = None,
+        ccache: bool = False,
+        template_args: ty.Optional[ty.Sequence[str]] = None,
     ) -> None:
         if pkg_manager not in allowed_pkg_managers:
             raise RendererError(
@@ -73,6 +197,29 @@ class _Renderer:
 
         self.pkg_manager = pkg_manager
         self._users = {"root"} if users is None else users
+        self.package_proxy = package_proxy
+        # Build stages, counted by `FROM` instructions, in which the package proxy
+        # has been configured. A stage that starts from an earlier stage inherits its
+        # files, so the proxy is removed at the end of every stage that configured it.
+        self._stage = 0
+        self._proxy_stages: ty.Set[int] = set()
+        self.artifacts_dir = artifacts_dir
+        self.build_context = build_context
+        if build_jobs is not None and build_jobs != "auto":
+            if not isinstance(build_jobs, int) or build_jobs < 1:
+                raise RendererError(
+                    "build_jobs must be a positive integer or 'auto' but got"
+                    f" '{build_jobs}'."
+                )
+        self.build_jobs = build_jobs
+        self.ccache = ccache
+        self.template_args = [] if template_args is None else list(template_args)
+        # Instructions added by the builder methods, and passes applied to them
+        # before rendering.
+        self._ir: ty.List[ir.Instruction] = []
+        self._passes: ty.List[ir.Pass] = []
+        # Template that is being added, recorded as the origin of instructions.
+        self._origin: ty.Optional[str] = None
 
     def __eq__(self, other: object) -> bool:
         if not isinstance(other, (_Renderer, str)):
@@ -88,46 +235,132 @@ class _Renderer:
         # Empty lines and commented lines do not affect container definitions.
         return rm_empty_lines(self) == rm_empty_lines(other)
 
+    def __str__(self) -> str:
+        raise NotImplementedError()
+
     @property
     def users(self) -> ty.Set[str]:
         return self._users
 
+    def add_pass(self, pass_: ir.Pass) -> _Renderer:
+        """Add a pass that transforms the instructions before they are rendered.
+
+        A pass is a function that takes a list of instructions (see `reproenv.ir`)
+        and returns a new list. Passes run in the order they are added, every time
+        the renderer is converted to a string.
+        """
+        self._passes.append(pass_)
+        return self
+
+    def _add(self, instruction: ir.Instruction) -> _Renderer:
+        if self._origin is not None and instruction.origin is None:
+            instruction = instruction._replace(origin=self._origin)
+        self._ir.append(instruction)
+        return self
+
+    def _final_ir(self) -> ty.List[ir.Instruction]:
+        """Return the instructions after passes, including the ones that are added
+        at the end of the build.
+        """
+        instructions = ir.run_passes(self._ir, self._passes)
+        if not self._proxy_stages:
+            return instructions
+        # Remove the package proxy configuration at the end of each stage that
+        # configured it, as root.
+        teardown = ir.Run(_package_proxy_teardown(self.pkg_manager))
+        result: ty.List[ir.Instruction] = []
+        stage = 0
+        user = "root"
+        for instruction in instructions + [ir.From("")]:
+            if isinstance(instruction, ir.From):
+                if stage in self._proxy_stages:
+                    result.extend(self._as_root(teardown, user))
+                stage += 1
+                user = "root"
+            elif isinstance(instruction, ir.User):
+                user = instruction.user
+            result.append(instruction)
+        # Remove the sentinel that ends the last stage.
+        result.pop()
+        return result
+
+    def _as_root(
+        self, instruction: ir.Instruction, user: str
+    ) -> ty.List[ir.Instruction]:
+        """Return instructions that run `instruction` as root when the current user
+        is `user`.
+        """
+        return [instruction]
+
     @classmethod
     def from_dict(cls, d: ty.Mapping) -> _Renderer:
         """Instantiate a new renderer from a dictionary of instructions."""
         # raise error if invalid
         _validate_renderer(d)
 
-        pkg_manager = d["pkg_manager"]
-        users = d.get("existing_users", None)
-
         # create new renderer object
-        renderer = cls(pkg_manager=pkg_manager, users=users)
-
+        renderer = cls._from_dict_options(d)
         for mapping in d["instructions"]:
-            method_or_template = mapping["name"]
-            kwds = mapping["kwds"]
-            this_instance_method = getattr(renderer, method_or_template, None)
-            # Method exists and is something like 'copy', 'env', 'run', etc.
-            if this_instance_method is not None:
-                try:
-                    this_instance_method(**kwds)
-                except Exception as e:
-                    raise RendererError(
-                        f"Error on step '{method_or_template}'. Please see the"
-                        " traceback above for details."
-                    ) from e
-            # This is actually a template.
-            else:
-                try:
-                    renderer.add_registered_template(method_or_template, **kwds)
-                except TemplateError as e:
-                    raise RendererError(
-                        f"Error on template '{method_or_template}'. Please see"
-                        " the traceback above for details. Was the template registered?"
-                    ) from e
+            renderer._add_instruction(mapping)
+        return renderer
+
+    @classmethod
+    def _from_dict_options(cls, d: ty.Mapping) -> _Renderer:
+        """Instantiate a new renderer with the options of a dictionary but without
+        its instructions. The dictionary is not validated.
+        """
+        return cls(
+            pkg_manager=d["pkg_manager"],
+            users=d.get("existing_users", None),
+            package_proxy=d.get("package_proxy", None),
+            artifacts_dir=d.get("artifacts_dir", None),
+            build_context=d.get("build_context", None),
+            build_jobs=d.get("build_jobs", None),
+            ccache=d.get("ccache", False),
+            template_args=d.get("template_args", None),
+        )
+
+    def _with_class(self, renderer_cls: ty.Type[_Renderer]) -> _Renderer:
+        """Return a renderer of another class with the same options and instructions.
+        This emits instructions for another target without rendering templates again.
+        """
+        renderer = renderer_cls(
+            pkg_manager=self.pkg_manager,
+            users=set(self._users),
+            package_proxy=self.package_proxy,
+            artifacts_dir=self.artifacts_dir,
+            build_context=self.build_context,
+            build_jobs=self.build_jobs,
+            ccache=self.ccache,
+            template_args=self.template_args,
+        )
+        renderer._ir = list(self._ir)
+        renderer._passes = list(self._passes)
+        renderer._stage = self._stage
+        renderer._proxy_stages = set(self._proxy_stages)
         return renderer
 
+    def _add_instruction(self, mapping: ty.Mapping) -> _Renderer:
+        """Add one instruction of a renderer dictionary."""
+        method_or_template = mapping["name"]
+        kwds = mapping["kwds"]
+        this_instance_method = getattr(self, method_or_template, None)
+        # Method exists and is something like 'copy', 'env', 'run', etc.
+        if this_instance_method is not None:
+            try:
+                this_instance_method(**kwds)
+            except Exception as e:
+                raise RendererError(f"Error on step '{method_or_template}': {e}") from e
+        # This is actually a template.
+        else:
+            try:
+                self.add_registered_template(method_or_template, **kwds)
+            except TemplateError as e:
+                raise RendererError(
+                    f"Error on template '{method_or_template}': {e}"
+                ) from e
+        return self
+
     def add_template(
         self, template: Template, method: installation_methods_type
     ) -> _Renderer:
@@ -161,6 +394,57 @@ class _Renderer:
         # invalid.
         template_method.validate_kwds()
 
+        previous_origin = self._origin
+        self._origin = f"{template.name} ({method})"
+        try:
+            self._add_template_method(template_method, method, template.name)
+        finally:
+            self._origin = previous_origin
+        return self
+
+    def _add_template_method(
+        self,
+        template_method: _BaseInstallationTemplate,
+        method: installation_methods_type,
+        name: str,
+    ) -> None:
+
+        # Keyword arguments that are set at build time.
+        select_url = ""
+        if self.template_args:
+            template_method, select_url = self._set_template_args(template_method, name)
+
+        # System packages to install. Build dependencies are removed after the
+        # template's instructions run, unless they were already installed.
+        dependencies = template_method.dependencies(self.pkg_manager)
+        build_dependencies = [
+            pkg
+            for pkg in template_method.dependencies(self.pkg_manager, build=True)
+            if pkg not in dependencies
+        ]
+        if method == "source" and self.ccache and "ccache" not in dependencies:
+            if "ccache" not in build_dependencies:
+                build_dependencies.append("ccache")
+        # debs are only installed with apt, together with other apt packages.
+        debs: ty.List[str] = []
+        if self.pkg_manager == "apt" and (dependencies or build_dependencies):
+            debs = template_method.dependencies("debs")
+
+        # Mount artifacts into the container instead of downloading them.
+        mounts: ty.List[ir.Mount] = []
+        if self.artifacts_dir is not None and template_method.instructions:
+            # Do not modify the URLs of the template that was passed in.
+            template_method = copy.deepcopy(template_method)
+            if isinstance(template_method, _BinariesTemplate):
+                version = getattr(template_method, "version", None)
+                if version in template_method.urls:
+                    urls = template_method.template["urls"]
+                    mounts.append(self._vendor_artifact(urls[version]))
+                    urls[version] = f"file://{mounts[-1].target}"
+            deb_mounts = [self._vendor_artifact(url) for url in debs]
+            debs = [f"file://{mount.target}" for mount in deb_mounts]
+            mounts.extend(deb_mounts)
+
         # If we keep the `self.VAR` syntax of the template, then we need to pass
         # `self=template_method` to the renderer function. But that function is an
         # instance method, so passing `self` will override the `self` argument.
@@ -180,22 +464,131 @@ class _Renderer:
         # Add installation instructions (render any jinja templates).
         if template_method.instructions:
             command = ""
-            dependencies = template_method.dependencies(self.pkg_manager)
-            if dependencies:
+            if build_dependencies:
+                command += (
+                    _find_missing_packages(build_dependencies, self.pkg_manager) + "\n"
+                )
+            if dependencies or build_dependencies:
                 # TODO: how can we pass in arguments here?
-                command += _install(pkgs=dependencies, pkg_manager=self.pkg_manager)
+                command += self._install_command(
+                    pkgs=dependencies + build_dependencies
+                )
                 # Install debs if we are using apt and debs are requested.
-                if self.pkg_manager == "apt":
-                    debs = template_method.dependencies("debs")
-                    if debs:
-                        command += "\n" + _apt_install_debs(debs)
+                if debs:
+                    command += "\n" + _apt_install_debs(debs)
                 command += "\n"
+            if method == "source":
+                command += self._source_build_environment()
+            command += select_url
             command += _render_string_from_template(
                 template_method.instructions, template_method
             )
-            self.run(command)
+            if build_dependencies:
+                command += "\n" + _remove_missing_packages(self.pkg_manager)
+            if method == "source":
+                self._run_source_build(command, mounts)
+            else:
+                self._add(ir.Run(command, mounts=tuple(mounts)))
 
-        return self
+    def _set_template_args(
+        self, template_method: _BaseInstallationTemplate, name: str
+    ) -> ty.Tuple[_BaseInstallationTemplate, str]:
+        """Add build arguments for the keyword arguments of a template that are in
+        `template_args`.
+
+        Returns a copy of the template whose keyword arguments refer to the build
+        arguments, and a command that selects the URL of the version at build time.
+        """
+        kwds = [k for k in self.template_args if k in template_method._kwds]
+        if not kwds:
+            return template_method, ""
+        # The keyword arguments are replaced by build arguments before the template
+        # is rendered, so Jinja must only print them.
+        sources = [template_method.instructions or ""]
+        for k, v in (template_method.env or {}).items():
+            sources.extend((k, v))
+        computed = set().union(
+            *(
+                _jinja_computed_kwds(
+                    source, kwds, isinstance(template_method, _BinariesTemplate)
+                )
+                for source in sources
+            )
+        )
+        if computed:
+            raise RendererError(
+                f"Cannot set '{sorted(computed)[0]}' of template '{name}' at build"
+                " time, because the template uses its value in a Jinja expression"
+                " (e.g., a condition) instead of only printing it."
+            )
+        prefix = re.sub(r"[^A-Z0-9]+", "_", name.upper()).strip("_")
+        # Do not modify the template that was passed in.
+        template_method = copy.deepcopy(template_method)
+        command = ""
+        for kwd in kwds:
+            key = "{}_{}".format(prefix, re.sub(r"[^A-Z0-9]+", "_", kwd.upper()))
+            self.arg(key, template_method._kwds[kwd])
+            setattr(template_method, kwd, f"${{{key}}}")
+            if kwd != "version" or not isinstance(template_method, _BinariesTemplate):
+                continue
+            if self.artifacts_dir is not None:
+                raise RendererError(
+                    f"Cannot mount artifacts of template '{name}' from the artifact"
+                    " cache if its version is set at build time."
+                )
+            urls = template_method.template["urls"]
+            url = f"{prefix}_URL"
+            cases = " ".join(f'"{v}") {url}="{u}" ;;' for v, u in urls.items())
+            command += (
+                f'case "${{{key}}}" in {cases} *) echo "Unknown version of {name}:'
+                f' ${{{key}}}" >&2; exit 1 ;; esac\n'
+            )
+            urls[f"${{{key}}}"] = f"${{{url}}}"
+        return template_method, command
+
+    def _source_build_environment(self) -> str:
+        """Return commands that set up parallel and cached builds from source."""
+        s = ""
+        if self.build_jobs is not None:
+            jobs = "$(nproc)" if self.build_jobs == "auto" else self.build_jobs
+            s += f'export MAKEFLAGS="-j{jobs}" CMAKE_BUILD_PARALLEL_LEVEL="{jobs}"\n'
+        if self.ccache:
+            s += (
+                'export PATH="/usr/lib/ccache:/usr/lib64/ccache:$PATH"'
+                f' CCACHE_DIR="{_CCACHE_DIR}"'
+                " CMAKE_C_COMPILER_LAUNCHER=ccache"
+                " CMAKE_CXX_COMPILER_LAUNCHER=ccache\n"
+            )
+        return s
+
+    def _run_source_build(
+        self, command: str, mounts: ty.Sequence[ir.Mount] = ()
+    ) -> _Renderer:
+        """Add a command that installs a template from source."""
+        mounts = list(mounts)
+        if self.ccache:
+            # Keep the compiler cache across builds, but out of the image. The mount
+            # is owned by root, so let users other than root write to it.
+            mounts.append(ir.Mount("cache", _CCACHE_DIR, options=(("mode", "0777"),)))
+        return self._add(ir.Run(command, mounts=tuple(mounts)))
+
+    def _vendor_artifact(self, url: str) -> ir.Mount:
+        """Return a bind mount of the cached artifact for `url`."""
+        assert self.artifacts_dir is not None
+        cache_dir = os.path.join(self.build_context or os.curdir, self.artifacts_dir)
+        path = _fetch.cached_path(url, cache_dir)
+        if path is None:
+            raise RendererError(
+                f"Artifact not found in '{cache_dir}': {url}. Download it"
+                " with `reproenv fetch` first."
+            )
+        # Keep the file name, because some tools infer the file type from it.
+        name = posixpath.basename(urllib.parse.urlsplit(url).path) or "artifact"
+        return ir.Mount(
+            "bind",
+            target=f"/tmp/reproenv-{path.name}-{name}",
+            source=f"{self.artifacts_dir}/sha256/{path.name}",
+        )
 
     def add_registered_template(
         self,
@@ -232,60 +625,124 @@ class _Renderer:
         self.add_template(template=template, method=method)
         return self
 
-    def arg(self, key: str, value: str = None):
-        raise NotImplementedError()
+    def _install_command(self, pkgs: ty.List[str], opts: str = None) -> str:
+        """Return command to install system packages.
+
+        If a package proxy is set and has not been configured yet, the command is
+        prefixed with the proxy configuration.
+        """
+        command = _install(pkgs, pkg_manager=self.pkg_manager, opts=opts)
+        if self.package_proxy is not None and self._stage not in self._proxy_stages:
+            setup = _package_proxy_setup(self.package_proxy, self.pkg_manager)
+            command = f"{setup}\n{command}"
+            self._proxy_stages.add(self._stage)
+        return command
+
+    def arg(self, key: str, value: str = None) -> _Renderer:
+        """Add a build argument."""
+        return self._add(ir.Arg(key, value))
 
     def copy(
         self,
         source: ty.Union[ty.List[os.PathLike], os.PathLike],
         destination: os.PathLike,
+        from_: str = None,
+        chown: str = None,
     ) -> _Renderer:
-        raise NotImplementedError()
+        """Copy files into the container."""
+        if not isinstance(source, (list, tuple)):
+            source = [source]
+        sources = tuple(str(src) for src in source)
+        return self._add(ir.Copy(sources, str(destination), from_=from_, chown=chown))
 
     def env(self, **kwds: ty.Mapping[str, str]) -> _Renderer:
-        raise NotImplementedError()
+        """Set environment variables."""
+        return self._add(ir.Env(tuple(kwds.items())))  # type: ignore
 
-    def from_(self, base_image: str) -> _Renderer:
-        raise NotImplementedError()
+    def from_(self, base_image: str, as_: str = None) -> _Renderer:
+        """Set the base image."""
+        self._add(ir.From(base_image, as_=as_))
+        self._stage += 1
+        return self
 
     def install(self, pkgs: ty.List[str], opts=None) -> _Renderer:
-        raise NotImplementedError()
+        """Install system packages."""
+        return self.run(self._install_command(pkgs, opts=opts))
 
     def label(self, **kwds: ty.Mapping[str, str]) -> _Renderer:
-        raise NotImplementedError()
+        """Add labels."""
+        return self._add(ir.Label(tuple(kwds.items())))  # type: ignore
 
     def run(self, command: str) -> _Renderer:
-        raise NotImplementedError()
+        """Run a shell command."""
+        return self._add(ir.Run(command))
 
     def run_bash(self, command: str) -> _Renderer:
         command = f"bash -c '{command}'"
         return self.run(command)
 
     def user(self, user: str) -> _Renderer:
-        raise NotImplementedError()
+        """Switch to a user. If the user is not in `self.users`, then a command that
+        creates the user is added first.
+        """
+        if user not in self._users:
+            self.run(
+                f'test "$(getent passwd {user})" \\\n|| useradd'
+                f" --no-user-group --create-home --shell /bin/bash {user}\n"
+            )
+            self._users.add(user)
+        return self._add(ir.User(user))
 
     def workdir(self, path: os.PathLike) -> _Renderer:
-        raise NotImplementedError()
+        """Set the working directory."""
+        return self._add(ir.Workdir(str(path)))
 
 
 class DockerRenderer(_Renderer):
     def __init__(
-        self, pkg_manager: pkg_managers_type, users: ty.Set[str] = None
+        self,
+        pkg_manager: pkg_managers_type,
+        users: ty.Set[str] = None,
+        package_proxy: str = None,
+        artifacts_dir: str = None,
+        build_context: str = None,
+        build_jobs: ty.Union[int, str] = None,
+        ccache: bool = False,
+        template_args: ty.Sequence[str] = None,
     ) -> None:
-        super().__init__(pkg_manager=pkg_manager, users=users)
-        self._parts: ty.List[str] = []
+        super().__init__(
+            pkg_manager=pkg_manager,
+            users=users,
+            package_proxy=package_proxy,
+            artifacts_dir=artifacts_dir,
+            build_context=build_context,
+            build_jobs=build_jobs,
+            ccache=ccache,
+            template_args=template_args,
+        )
 
     def __str__(self) -> str:
         """Return an un-rendered version of the Dockerfile.
 
         Use `.render()` to fill in Jinja template.
         """
-        return "\n".join(self._parts)
+        return "\n".join(map(_docker_instruction, self._final_ir()))
+
+    @property
+    def _parts(self) -> ty.List[str]:
+        """Dockerfile instructions added so far, before passes."""
+        return [_docker_instruction(instruction) for instruction in self._ir]
+
+    def _as_root(
+        self, instruction: ir.Instruction, user: str
+    ) -> ty.List[ir.Instruction]:
+        if user == "root":
+            return [instruction]
+        return [ir.User("root"), instruction, ir.User(user)]
 
     def arg(self, key: str, value: str = None) -> DockerRenderer:
         """Add a Dockerfile `ARG` instruction."""
-        s = f"ARG {key}" if value is None else f"ARG {key}={value}"
-        self._parts.append(s)
+        super().arg(key, value)
         return self
 
     def copy(
@@ -296,56 +753,32 @@ class DockerRenderer(_Renderer):
         chown: str = None,
     ) -> DockerRenderer:
         """Add a Dockerfile `COPY` instruction."""
-        if not isinstance(source, (list, tuple)):
-            source = [source]
-        source.append(destination)
-        files = '["{}"]'.format('", \\\n      "'.join(map(str, source)))
-        s = "COPY "
-        if from_ is not None:
-            s += f"--from={from_} "
-        if chown is not None:
-            s += f"--chown={chown} "
-        s += files
-        self._parts.append(s)
+        super().copy(source, destination, from_=from_, chown=chown)
         return self
 
     def env(self, **kwds: ty.Mapping[str, str]) -> DockerRenderer:
         """Add a Dockerfile `ENV` instruction."""
-        s = "ENV " + " \\\n    ".join(f'{k}="{v}"' for k, v in kwds.items())
-        self._parts.append(s)
+        super().env(**kwds)
         return self
 
     def from_(self, base_image: str, as_: str = None) -> DockerRenderer:
         """Add a Dockerfile `FROM` instruction."""
-        if as_ is None:
-            s = "FROM " + base_image
-        else:
-            s = f"FROM {base_image} AS {as_}"
-        self._parts.append(s)
+        super().from_(base_image, as_=as_)
         return self
 
     def install(self, pkgs: ty.List[str], opts=None) -> DockerRenderer:
         """Install system packages."""
-        command = _install(pkgs, pkg_manager=self.pkg_manager, opts=opts)
-        command = _indent_run_instruction(command)
-        self.run(command)
+        super().install(pkgs, opts=opts)
         return self
 
     def label(self, **kwds: ty.Mapping[str, str]) -> DockerRenderer:
         """Add a Dockerfile `LABEL` instruction."""
-        s = "LABEL " + " \\\n      ".join(f'{k}="{v}"' for k, v in kwds.items())
-        self._parts.append(s)
+        super().label(**kwds)
         return self
 
     def run(self, command: str) -> DockerRenderer:
         """Add a Dockerfile `RUN` instruction."""
-        # TODO: should the command be quoted?
-        # s = shlex.quote(command)
-        # if s.startswith("'"):
-        #     s = s[1:-1]  # Remove quotes on either end of the string.
-        s = command
-        s = _indent_run_instruction(f"RUN {s}")
-        self._parts.append(s)
+        super().run(command)
         return self
 
     def user(self, user: str) -> DockerRenderer:
@@ -353,148 +786,598 @@ class DockerRenderer(_Renderer):
         `self.users`, then a `RUN` instruction that creates the user
         will also be added.
         """
-        s = ""
-        if user not in self._users:
-            s = (
-                f'RUN test "$(getent passwd {user})" \\\n    || useradd '
-                f"--no-user-group --create-home --shell /bin/bash {user}"
-            )
-            self._parts.append(s)
-            self._users.add(user)
-        self._parts.append(f"USER {user}")
+        super().user(user)
         return self
 
     def workdir(self, path: os.PathLike) -> DockerRenderer:
         """Add a Dockerfile `WORKDIR` instruction."""
-        self._parts.append("WORKDIR " + str(path))
+        super().workdir(path)
         return self
 
+    def reorder_for_cache(self) -> ty.List[CacheMove]:
+        """Move volatile instructions after expensive ones to improve layer caching.
+
+        `LABEL`, `ARG`, and `COPY` instructions that copy files from the build
+        context tend to change more often than the instructions that follow them, and
+        every change invalidates the cache of all later layers. This pass moves these
+        instructions later in their build stage, past instructions that do not depend
+        on them, judged by the environment variables, paths, and working directories
+        they refer to. `ARG` and `COPY` are never moved past `RUN`, because commands
+        get build arguments as environment variables and can use copied files without
+        naming them.
+
+        The moves are made by a pass (see `add_pass`), so they also apply to
+        instructions added later. Returns a list of `CacheMove` that describe the
+        instructions added so far that move and why.
+        """
+        _, moves = _reorder_for_cache(ir.run_passes(self._ir, self._passes))
+        self.add_pass(_reorder_for_cache_pass)
+        return moves
+
+
+def _docker_instruction(instruction: ir.Instruction) -> str:
+    """Return the Dockerfile instruction for an instruction."""
+    if isinstance(instruction, ir.Arg):
+        if instruction.value is None:
+            return f"ARG {instruction.key}"
+        return f"ARG {instruction.key}={instruction.value}"
+    elif isinstance(instruction, ir.Copy):
+        paths = instruction.source + (instruction.destination,)
+        s = "COPY "
+        if instruction.from_ is not None:
+            s += f"--from={instruction.from_} "
+        if instruction.chown is not None:
+            s += f"--chown={instruction.chown} "
+        return s + '["{}"]'.format('", \\\n      "'.join(paths))
+    elif isinstance(instruction, ir.Env):
+        return "ENV " + " \\\n    ".join(f'{k}="{v}"' for k, v in instruction.env)
+    elif isinstance(instruction, ir.From):
+        if instruction.as_ is None:
+            return "FROM " + instruction.base_image
+        return f"FROM {instruction.base_image} AS {instruction.as_}"
+    elif isinstance(instruction, ir.Label):
+        return "LABEL " + " \\\n      ".join(
+            f'{k}="{v}"' for k, v in instruction.labels
+        )
+    elif isinstance(instruction, ir.Run):
+        # TODO: should the command be quoted?
+        mounts = "".join(f"--mount={_docker_mount(m)} " for m in instruction.mounts)
+        return _indent_run_instruction(f"RUN {mounts}{instruction.command}")
+    elif isinstance(instruction, ir.User):
+        return f"USER {instruction.user}"
+    elif isinstance(instruction, ir.Workdir):
+        return "WORKDIR " + instruction.path
+    raise RendererError(f"Unknown instruction: {instruction!r}")
+
+
+def _docker_mount(mount: ir.Mount) -> str:
+    """Return the value of the `--mount` option of a `RUN` instruction."""
+    options = [("type", mount.type)]
+    if mount.source is not None:
+        options.append(("source", mount.source))
+    options.append(("target", mount.target))
+    options.extend(mount.options)
+    return ",".join(f"{k}={v}" for k, v in options)
+
 
 class SingularityRenderer(_Renderer):
     def __init__(
-        self, pkg_manager: pkg_managers_type, users: ty.Optional[ty.Set[str]] = None
+        self,
+        pkg_manager: pkg_managers_type,
+        users: ty.Optional[ty.Set[str]] = None,
+        package_proxy: ty.Optional[str] = None,
+        artifacts_dir: ty.Optional[str] = None,
+        build_context: ty.Optional[str] = None,
+        build_jobs: ty.Union[int, str, None] = None,
+        ccache: bool = False,
+        template_args: ty.Optional[ty.Sequence[str]] = None,
     ) -> None:
-        super().__init__(pkg_manager=pkg_manager, users=users)
-
-        self._header: _SingularityHeaderType = {}
-        # The '%setup' section is intentionally ommitted.
-        self._files: ty.List[str] = []
-        self._environment: ty.List[ty.Tuple[str, str]] = []
-        self._post: ty.List[str] = []
+        super().__init__(
+            pkg_manager=pkg_manager,
+            users=users,
+            package_proxy=package_proxy,
+            artifacts_dir=artifacts_dir,
+            build_context=build_context,
+            build_jobs=build_jobs,
+            ccache=ccache,
+            template_args=template_args,
+        )
         self._runscript = ""
-        # TODO: is it OK to use a dict here? Labels could be overwritten.
-        self._labels: ty.Dict[str, str] = {}
 
     def __str__(self) -> str:
+        sections = self._sections(self._final_ir())
         s = ""
         # Create header.
-        if self._header:
-            s += (
-                f"Bootstrap: {self._header['bootstrap']}\nFrom: {self._header['from_']}"
-            )
+        header = sections["header"]
+        if header:
+            s += f"Bootstrap: {header['bootstrap']}\nFrom: {header['from_']}"
 
         # Add files.
-        if self._files:
+        if sections["files"]:
             s += "\n\n%files\n"
-            s += "\n".join(self._files)
+            s += "\n".join(sections["files"])
 
         # Add environment.
-        if self._environment:
+        if sections["environment"]:
             s += "\n\n%environment"
-            for k, v in self._environment:
+            for k, v in sections["environment"]:
                 s += f'\nexport {k}="{v}"'
 
         # Add post.
-        if self._post:
+        if sections["post"]:
             s += "\n\n%post\n"
-            s += "\n\n".join(self._post)
-            # for instruction in self._post:
+            s += "\n\n".join(sections["post"])
 
         # Add runscript.
-        if self._runscript:
+        if sections["runscript"]:
             s += "\n\n%runscript\n"
-            s += self._runscript
+            s += sections["runscript"]
 
         # Add labels.
-        if self._labels:
+        if sections["labels"]:
             s += "\n\n%labels\n"
-            for kv in self._labels.items():
+            for kv in sections["labels"].items():
                 s += " ".join(kv)
 
         return s
 
+    def _sections(self, instructions: ty.List[ir.Instruction]) -> ty.Dict[str, ty.Any]:
+        """Return the sections of the recipe for a list of instructions."""
+        header: _SingularityHeaderType = {}
+        # The '%setup' section is intentionally ommitted.
+        files: ty.List[str] = []
+        environment: ty.List[ty.Tuple[str, str]] = []
+        post: ty.List[str] = []
+        # TODO: is it OK to use a dict here? Labels could be overwritten.
+        labels: ty.Dict[str, str] = {}
+        # Build arguments only exist in `%post`, so the environment uses their values.
+        args: ty.Dict[str, str] = {}
+        for instruction in instructions:
+            if isinstance(instruction, ir.Arg) and instruction.value is not None:
+                args[instruction.key] = instruction.value
+            # Instructions may come from a renderer of another class.
+            _check_singularity_instruction(instruction)
+            if isinstance(instruction, ir.From):
+                bootstrap, image = _singularity_bootstrap(instruction.base_image)
+                header = {"bootstrap": bootstrap, "from_": image}
+            elif isinstance(instruction, ir.Copy):
+                dest = instruction.destination
+                files.extend(f"{src} {dest}" for src in instruction.source)
+            elif isinstance(instruction, ir.Env):
+                environment.extend(
+                    (k, _expand_args(v, args)) for k, v in instruction.env
+                )
+            elif isinstance(instruction, ir.Label):
+                labels.update(instruction.labels)
+            else:
+                if isinstance(instruction, ir.Run):
+                    files.extend(
+                        f"{mount.source} {mount.target}"
+                        for mount in instruction.mounts
+                        if mount.type == "bind"
+                    )
+                post.append(_singularity_post(instruction))
+        return {
+            "header": header,
+            "files": files,
+            "environment": environment,
+            "post": post,
+            "runscript": self._runscript,
+            "labels": labels,
+        }
+
+    def _add(self, instruction: ir.Instruction) -> SingularityRenderer:
+        # Raise an error for instructions that cannot be rendered now rather than
+        # when rendering.
+        _check_singularity_instruction(instruction)
+        super()._add(instruction)
+        return self
+
+    def _run_source_build(
+        self, command: str, mounts: ty.Sequence[ir.Mount] = ()
+    ) -> SingularityRenderer:
+        # `%post` is one script, so run the build in a subshell. Otherwise its
+        # environment (e.g., the ccache compiler launchers, although ccache is removed
+        # with the build dependencies) applies to all later commands.
+        if self._source_build_environment():
+            command = f"(\n{command}\n)"
+        super()._run_source_build(command, mounts)
+        return self
+
     def arg(self, key: str, value: str = None) -> SingularityRenderer:
         # TODO: look into whether singularity has something like ARG, like passing in
         # environment variables.
-        s = f"{key}" if value is None else f"{key}={value}"
-        self._post.append(s)
+        super().arg(key, value)
         return self
 
     def copy(
         self,
         source: ty.Union[ty.List[os.PathLike], os.PathLike],
         destination: os.PathLike,
+        from_: str = None,
+        chown: str = None,
     ) -> SingularityRenderer:
-        if not isinstance(source, (list, tuple)):
-            source = [source]
-        files = [f"{src} {destination}" for src in source]
-        self._files.extend(files)
+        super().copy(source, destination, from_=from_, chown=chown)
         return self
 
     def env(self, **kwds: ty.Mapping[str, str]) -> SingularityRenderer:
-        # TODO: why does this raise a type error?
-        self._environment.extend(kwds.items())  # type: ignore
+        super().env(**kwds)
         return self
 
-    def from_(self, base_image: str) -> SingularityRenderer:
-        if "://" not in base_image:
-            bootstrap = "docker"
-            image = base_image
-        elif base_image.startswith("docker://"):
-            bootstrap = "docker"
-            image = base_image[9:]
-        elif base_image.startswith("library://"):
-            bootstrap = "library"
-            image = base_image[10:]
-        else:
-            raise RendererError("Unknown singularity bootstrap agent.")
-
-        self._header = {"bootstrap": bootstrap, "from_": image}
+    def from_(self, base_image: str, as_: str = None) -> SingularityRenderer:
+        super().from_(base_image, as_=as_)
         return self
 
     def install(self, pkgs: ty.List[str], opts=None) -> SingularityRenderer:
         """Install system packages."""
-        command = _install(pkgs, pkg_manager=self.pkg_manager, opts=opts)
-        self.run(command)
+        super().install(pkgs, opts=opts)
         return self
 
     def label(self, **kwds: ty.Mapping[str, str]) -> SingularityRenderer:
-        # TODO: why are we getting this error?
-        # Argument 1 to "update" of "dict" has incompatible type
-        # "Dict[str, Mapping[str, str]]"; expected "Mapping[str, str]"
-        self._labels.update(kwds)  # type: ignore
+        super().label(**kwds)
         return self
 
     def run(self, command: str) -> SingularityRenderer:
-        self._post.append(command)
+        super().run(command)
         return self
 
     def user(self, user: str) -> SingularityRenderer:
-        if user not in self._users:
-            post = (
-                f'test "$(getent passwd {user})" \\\n|| useradd '
-                f"--no-user-group --create-home --shell /bin/bash {user}\n"
-            )
-            self._users.add(user)
-            self._post.append(post)
-        self._post.append(f"su - {user}")
+        super().user(user)
         return self
 
     def workdir(self, path: os.PathLike) -> SingularityRenderer:
-        self._post.append(f"mkdir -p {path}\ncd {path}")
+        super().workdir(path)
         return self
 
 
+def _singularity_bootstrap(base_image: str) -> ty.Tuple[str, str]:
+    """Return the bootstrap agent and image of a base image."""
+    if "://" not in base_image:
+        return "docker", base_image
+    elif base_image.startswith("docker://"):
+        return "docker", base_image[9:]
+    elif base_image.startswith("library://"):
+        return "library", base_image[10:]
+    raise RendererError("Unknown singularity bootstrap agent.")
+
+
+def _check_singularity_instruction(instruction: ir.Instruction) -> None:
+    """Raise `RendererError` if an instruction uses options of Dockerfiles that
+    Singularity recipes do not have.
+    """
+    if isinstance(instruction, ir.From):
+        if instruction.as_ is not None:
+            raise RendererError(
+                "Singularity recipes do not have named build stages:"
+                f" '{instruction.as_}'."
+            )
+        _singularity_bootstrap(instruction.base_image)
+    elif isinstance(instruction, ir.Copy):
+        if instruction.from_ is not None:
+            raise RendererError(
+                "Singularity recipes cannot copy files from other build"
+                f" stages or images: '{instruction.from_}'."
+            )
+        if instruction.chown is not None:
+            raise RendererError(
+                "Singularity recipes cannot set the owner of copied files:"
+                f" '{instruction.chown}'."
+            )
+
+
+def _expand_args(s: str, args: ty.Mapping[str, str]) -> str:
+    """Replace `${KEY}` with the values of build arguments."""
+    return re.sub(r"\$\{([A-Za-z_][A-Za-z0-9_]*)\}", lambda m: args.get(m[1], m[0]), s)
+
+
+def _singularity_post(instruction: ir.Instruction) -> str:
+    """Return the `%post` section for an instruction."""
+    if isinstance(instruction, ir.Arg):
+        if instruction.value is None:
+            return instruction.key
+        return f"{instruction.key}={instruction.value}"
+    elif isinstance(instruction, ir.Run):
+        # Singularity has no build-time mounts. Files that are bind mounts in Docker
+        # are copied in `%files`, and cache mounts are directories in the container,
+        # so remove both when the command is done to keep them out of the image.
+        command = instruction.command
+        binds = [mount.target for mount in instruction.mounts if mount.type == "bind"]
+        if binds:
+            command += "\nrm -f " + " ".join(binds)
+        caches = [mount.target for mount in instruction.mounts if mount.type == "cache"]
+        if caches:
+            command += "\nrm -rf " + " ".join(caches)
+        return command
+    elif isinstance(instruction, ir.User):
+        return f"su - {instruction.user}"
+    elif isinstance(instruction, ir.Workdir):
+        return f"mkdir -p {instruction.path}\ncd {instruction.path}"
+    raise RendererError(f"Unknown instruction: {instruction!r}")
+
+
+# Renderer classes by target name.
+_renderer_classes: ty.Dict[str, ty.Type[_Renderer]] = {
+    "docker": DockerRenderer,
+    "singularity": SingularityRenderer,
+}
+
+
+def render(
+    d: ty.Mapping, targets: ty.Iterable[str] = ("docker", "singularity")
+) -> ty.Dict[str, str]:
+    """Render a renderer dictionary as several container specifications.
+
+    The dictionary is validated and its templates are rendered once. The resulting
+    instructions are then emitted for each target.
+
+    Parameters
+    ----------
+    d : dict
+        Renderer dictionary, as accepted by `_Renderer.from_dict`.
+    targets : iterable of str
+        Names of the targets to render. Options are "docker" and "singularity".
+
+    Returns
+    -------
+    Dictionary of container specifications by target name.
+    """
+    targets = list(targets)
+    for target in targets:
+        if target not in _renderer_classes:
+            raise RendererError(
+                "Unknown target '{}'. Options are '{}'.".format(
+                    target, "', '".join(_renderer_classes)
+                )
+            )
+    builder = _Renderer.from_dict(d)
+    return {
+        target: str(builder._with_class(_renderer_classes[target]))
+        for target in targets
+    }
+
+
+# Compiler cache directory used when building templates from source with ccache.
+_CCACHE_DIR = "/var/cache/ccache"
+
+
+class CacheMove(ty.NamedTuple):
+    """Instruction moved by `DockerRenderer.reorder_for_cache`."""
+
+    # First line of the instruction.
+    instruction: str
+    # Index of the instruction before and after the move.
+    old_index: int
+    new_index: int
+    reason: str
+
+
+# Instructions that are moved by `_reorder_for_cache`, with the reason to move them.
+_volatile_reasons = {
+    ir.Arg: "build arguments invalidate the cache where they are declared",
+    ir.Copy: "files in the build context change often",
+    ir.Label: "labels change often (e.g., build numbers)",
+}
+
+_docker_keywords = {
+    ir.Arg: "ARG",
+    ir.Copy: "COPY",
+    ir.Env: "ENV",
+    ir.From: "FROM",
+    ir.Label: "LABEL",
+    ir.Run: "RUN",
+    ir.User: "USER",
+    ir.Workdir: "WORKDIR",
+}
+
+
+def _strings(instruction: ir.Instruction) -> ty.List[str]:
+    """Return the strings in the fields of an instruction, except its origin."""
+    strings: ty.List[str] = []
+
+    def collect(value: ty.Any) -> None:
+        if isinstance(value, str):
+            strings.append(value)
+        elif isinstance(value, tuple):
+            for item in value:
+                collect(item)
+
+    for field in instruction._fields:
+        if field != "origin":
+            collect(getattr(instruction, field))
+    return strings
+
+
+def _defined_vars(instruction: ir.Instruction) -> ty.Set[str]:
+    """Return names of variables set by an `ARG` or `ENV` instruction."""
+    if isinstance(instruction, ir.Arg):
+        return {instruction.key}
+    if isinstance(instruction, ir.Env):
+        return {k for k, _ in instruction.env}
+    return set()
+
+
+def _referenced_vars(instruction: ir.Instruction) -> ty.Set[str]:
+    if isinstance(instruction, ir.Arg):
+        strings = [] if instruction.value is None else [instruction.value]
+    elif isinstance(instruction, ir.Env):
+        strings = [v for _, v in instruction.env]
+    else:
+        strings = _strings(instruction)
+    return {name for s in strings for name in re.findall(r"\$\{?(\w+)", s)}
+
+
+def _resolve_path(path: str, cwd: ty.Optional[str]) -> ty.Optional[str]:
+    """Return the absolute path of `path` in the working directory `cwd`, or `None`
+    if it is not known (e.g., because it contains variables).
+    """
+    if "$" in path or (cwd is None and not path.startswith("/")):
+        return None
+    return posixpath.normpath(posixpath.join(cwd or "/", path))
+
+
+def _is_within(path: str, directory: str) -> bool:
+    return path == directory or path.startswith(directory.rstrip("/") + "/")
+
+
+def _working_directories(
+    instructions: ty.List[ir.Instruction],
+) -> ty.List[ty.Optional[str]]:
+    """Return the working directory in which each instruction runs, or `None` if it
+    is not known.
+
+    Base images are assumed to start in `/`, except build stages of the same
+    Dockerfile, which start in the working directory their stage ended in.
+    """
+    cwds: ty.List[ty.Optional[str]] = []
+    stages: ty.Dict[str, ty.Optional[str]] = {}
+    cwd: ty.Optional[str] = "/"
+    stage: ty.Optional[str] = None
+    for instruction in instructions:
+        if isinstance(instruction, ir.From):
+            if stage is not None:
+                stages[stage] = cwd
+            cwd = stages.get(instruction.base_image, "/")
+            stage = instruction.as_
+        cwds.append(cwd)
+        if isinstance(instruction, ir.Workdir):
+            cwd = _resolve_path(instruction.path, cwd)
+    return cwds
+
+
+def _cache_conflict(
+    moving: ir.Instruction,
+    moving_cwd: ty.Optional[str],
+    other: ir.Instruction,
+    other_cwd: ty.Optional[str],
+) -> ty.Optional[str]:
+    """Return the reason `moving` cannot be moved after `other`, or `None` if the
+    two instructions are independent. `moving_cwd` and `other_cwd` are the working
+    directories the instructions run in.
+    """
+    other_keyword = _docker_keywords[type(other)]
+    defined = _defined_vars(moving)
+    if defined & (_referenced_vars(other) | _defined_vars(other)):
+        return f"{other_keyword} uses variable '{sorted(defined)[0]}'"
+    referenced = _referenced_vars(moving) & _defined_vars(other)
+    if referenced:
+        return f"{other_keyword} sets variable '{sorted(referenced)[0]}'"
+    if isinstance(moving, ir.Arg) and isinstance(other, ir.Run):
+        # Build arguments are in the environment of every later command, whether or
+        # not the command refers to them (e.g., DEBIAN_FRONTEND).
+        return "RUN gets build arguments as environment variables"
+    if isinstance(moving, ir.Copy):
+        if isinstance(other, ir.Run):
+            # Commands can use copied files without naming them, e.g., scripts in a
+            # copied directory or on the PATH.
+            return "RUN may use the copied files"
+        if isinstance(other, ir.Workdir) and not moving.destination.startswith("/"):
+            return "the destination is relative to the working directory"
+        destination = _resolve_path(moving.destination, moving_cwd)
+        if isinstance(other, ir.Workdir):
+            # Commands after the `WORKDIR` run in the copied files.
+            workdir = _resolve_path(other.path, other_cwd)
+            if destination is None or workdir is None:
+                return "WORKDIR may be in the destination"
+            if _is_within(workdir, destination):
+                return f"WORKDIR is in the destination '{destination}'"
+        if isinstance(other, ir.Copy):
+            other_destination = _resolve_path(other.destination, other_cwd)
+            if destination is None or other_destination is None:
+                return "COPY may write to the same directory"
+            if _is_within(other_destination, destination) or _is_within(
+                destination, other_destination
+            ):
+                return "COPY writes to the same directory"
+    if isinstance(moving, ir.Label) and isinstance(other, ir.Label):
+        return "labels may override each other"
+    return None
+
+
+def _reorder_for_cache(
+    instructions: ty.List[ir.Instruction],
+) -> ty.Tuple[ty.List[int], ty.List[CacheMove]]:
+    """Return the new order of instructions, as indices into `instructions`, and the
+    moves that were made.
+    """
+    cwds = _working_directories(instructions)
+
+    def conflict(moving: int, other: int) -> ty.Optional[str]:
+        return _cache_conflict(
+            instructions[moving], cwds[moving], instructions[other], cwds[other]
+        )
+
+    # Indices into `instructions` in the new order.
+    order: ty.List[int] = []
+    # Reasons that stopped deferred instructions, by index.
+    stopped: ty.Dict[int, str] = {}
+    deferred: ty.List[int] = []
+    volatile: ty.Set[int] = set()
+
+    seen_from = False
+    for index, instruction in enumerate(instructions):
+        if isinstance(instruction, ir.From):
+            # Do not move instructions across build stages.
+            order.extend(deferred)
+            deferred.clear()
+            order.append(index)
+            seen_from = True
+            continue
+        # Deferred instructions that must come before this one: those this
+        # instruction depends on, and earlier ones that those depend on.
+        flush: ty.Set[int] = set()
+        for deferred_index in reversed(deferred):
+            reason = conflict(deferred_index, index)
+            if reason is None:
+                for later in flush:
+                    reason = conflict(deferred_index, later)
+                    if reason is not None:
+                        break
+            if reason is not None:
+                stopped[deferred_index] = reason
+                flush.add(deferred_index)
+        order.extend(sorted(flush))
+        deferred = [i for i in deferred if i not in flush]
+        is_volatile = type(instruction) in _volatile_reasons and not (
+            isinstance(instruction, ir.Copy) and instruction.from_ is not None
+        )
+        if seen_from and is_volatile:
+            deferred.append(index)
+            volatile.add(index)
+        else:
+            order.append(index)
+    order.extend(deferred)
+
+    moves: ty.List[CacheMove] = []
+    for new_index, old_index in enumerate(order):
+        # Only report instructions that now follow an instruction they preceded.
+        if old_index not in volatile or not any(
+            other > old_index for other in order[:new_index]
+        ):
+            continue
+        instruction = instructions[old_index]
+        reason = _volatile_reasons[type(instruction)]
+        if old_index in stopped:
+            reason += f"; not moved further because {stopped[old_index]}"
+        moves.append(
+            CacheMove(
+                instruction=re.sub(
+                    r"\s*\\\n\s*", " ", _docker_instruction(instruction)
+                ),
+                old_index=old_index,
+                new_index=new_index,
+                reason=reason,
+            )
+        )
+    return order, moves
+
+
+def _reorder_for_cache_pass(
+    instructions: ty.List[ir.Instruction],
+) -> ty.List[ir.Instruction]:
+    order, _ = _reorder_for_cache(instructions)
+    return [instructions[i] for i in order]
+
+
 def _indent_run_instruction(string: str, indent=4) -> str:
     """Return indented string for Dockerfile `RUN` command."""
     out = []
@@ -528,6 +1411,72 @@ def _install(pkgs: ty.List[str], pkg_manager: str, opts: str = None) -> str:
         raise RendererError(f"Unknown package manager '{pkg_manager}'.")
 
 
+# Name of the apt configuration file that holds the package proxy.
+_APT_PROXY_CONF = "/etc/apt/apt.conf.d/00reproenv-proxy"
+
+
+# Comment that precedes the proxy setting added to /etc/yum.conf.
+_YUM_PROXY_MARKER = "# reproenv package proxy"
+
+
+def _package_proxy_setup(proxy: str, pkg_manager: str) -> str:
+    """Return command that configures the package manager to use a proxy."""
+    if pkg_manager == "apt":
+        return (
+            f"printf 'Acquire::http::Proxy \"%s\";\\n' {shlex.quote(proxy)}"
+            f" > {_APT_PROXY_CONF}"
+        )
+    elif pkg_manager == "yum":
+        setting = shlex.quote(f"proxy={proxy}")
+        return f"printf '%s\\n' '{_YUM_PROXY_MARKER}' {setting} >> /etc/yum.conf"
+    else:
+        raise RendererError(f"Unknown package manager '{pkg_manager}'.")
+
+
+def _package_proxy_teardown(pkg_manager: str) -> str:
+    """Return command that removes the package proxy configuration."""
+    if pkg_manager == "apt":
+        return f"rm -f {_APT_PROXY_CONF}"
+    elif pkg_manager == "yum":
+        # Remove the marker and the setting after it, so the URL does not have to be
+        # escaped in a regular expression. /etc/yum.conf is a symlink to
+        # /etc/dnf/dnf.conf in newer distributions.
+        return f"sed -i --follow-symlinks '/^{_YUM_PROXY_MARKER}$/,+1d' /etc/yum.conf"
+    else:
+        raise RendererError(f"Unknown package manager '{pkg_manager}'.")
+
+
+def _find_missing_packages(pkgs: ty.List[str], pkg_manager: str) -> str:
+    """Return command that stores the packages of `pkgs` that are not installed in
+    the shell variable `_reproenv_build_deps`.
+    """
+    if pkg_manager == "apt":
+        check = 'dpkg -s "$p" >/dev/null 2>&1'
+    elif pkg_manager == "yum":
+        check = 'rpm -q --whatprovides "$p" >/dev/null 2>&1'
+    else:
+        raise RendererError(f"Unknown package manager '{pkg_manager}'.")
+    pkgs_str = " ".join(sorted(pkgs))
+    return (
+        f'_reproenv_build_deps="$(for p in {pkgs_str}; do {check} || echo "$p";'
+        ' done)"'
+    )
+
+
+def _remove_missing_packages(pkg_manager: str) -> str:
+    """Return command that removes the packages found by `_find_missing_packages`,
+    along with dependencies that are no longer needed.
+    """
+    if pkg_manager == "apt":
+        remove = "apt-get purge -y -q --autoremove"
+    elif pkg_manager == "yum":
+        remove = "yum autoremove -y -q"
+    else:
+        raise RendererError(f"Unknown package manager '{pkg_manager}'.")
+    # Braces keep `||` from swallowing errors of previous commands in a `&&` chain.
+    return f'{{ test -z "$_reproenv_build_deps" || {remove} $_reproenv_build_deps; }}'
+
+
 def _apt_install(pkgs: ty.List[str], opts: str = None, sort=True) -> str:
     """Return command to install deb packages with `apt-get` (Debian-based distros).
 
@@ -587,3 +1536,111 @@ rm -rf /var/cache/yum/*
         opts=opts, pkgs=" \\\n    ".join(pkgs)
     )
     return s.strip()
+
+
+def _shell_quote(s: str) -> str:
+    """Quote a string for the shell, but keep variables like `${FOO_URL}` (e.g., from
+    `template_args`) so that they expand.
+    """
+    if not re.search(r"\$\{\w+\}", s):
+        return shlex.quote(s)
+    return '"{}"'.format(re.sub(r'(["\\`]|\$(?!\{\w+\}))', r"\\\1", s))
+
+
+# tar flags for archive types that can be extracted by `_download`.
+_tar_compression_flags = {
+    "tar": "",
+    "tar.gz": "z",
+    "tgz": "z",
+    "tar.bz2": "j",
+    "tar.xz": "J",
+}
+
+
+def _download(
+    url: str,
+    destination: str,
+    sha256: str = None,
+    extract: str = None,
+    strip_components: int = 0,
+    segments: int = 1,
+) -> str:
+    """Return command to download a file and optionally extract it.
+
+    This function is available in template instructions as `download`, for example
+    `{{ download(self.urls[self.version], "/opt/foo", extract="tar.gz") }}`. Shell
+    variables like `${FOO_URL}` in the URL and destination expand, so templates that
+    use it can set their version at build time (see `template_args`).
+
+    Archives without a checksum are extracted as they are downloaded. Otherwise the
+    file is downloaded to a temporary directory (resuming and retrying on failure),
+    verified, and then extracted. If `segments` is greater than one and `aria2c` is
+    available in the container, the file is downloaded over that many connections.
+
+    Parameters
+    ----------
+    url : str
+        URL to download.
+    destination : str
+        Path of the downloaded file, or directory to extract the archive into.
+    sha256 : str
+        Expected SHA256 checksum of the file.
+    extract : str
+        Archive type, one of 'tar', 'tar.gz', 'tgz', 'tar.bz2', 'tar.xz'. If omitted,
+        the file is not extracted.
+    strip_components : int
+        Number of leading path components to remove when extracting.
+    segments : int
+        Number of connections to use to download the file.
+    """
+    if extract is not None and extract not in _tar_compression_flags:
+        raise RendererError(
+            "extract must be one of '{}' but got '{}'.".format(
+                "', '".join(_tar_compression_flags), extract
+            )
+        )
+    q_url = _shell_quote(url)
+    q_dest = _shell_quote(destination)
+    curl = "curl -fsSL --retry 5 --retry-delay 2 --retry-connrefused"
+
+    def untar(src: str) -> str:
+        assert extract is not None
+        s = f"tar -x{_tar_compression_flags[extract]}f {src} -C {q_dest}"
+        if strip_components:
+            s += f" --strip-components {strip_components}"
+        return s
+
+    # Stream the archive straight into tar.
+    if extract is not None and sha256 is None and segments <= 1:
+        return f"mkdir -p {q_dest}\n{curl} {q_url} | {untar('-')}"
+
+    if extract is None:
+        tmpdir = _shell_quote(posixpath.dirname(destination) or ".")
+        filename = _shell_quote(posixpath.basename(destination))
+        path = q_dest
+        lines = [f"mkdir -p {tmpdir}"]
+    else:
+        tmpdir = '"$_reproenv_tmpdir"'
+        filename = "archive"
+        path = '"$_reproenv_tmpdir/archive"'
+        lines = ['_reproenv_tmpdir="$(mktemp -d)"']
+    get = f"{curl} -C - -o {path} {q_url}"
+    # aria2c cannot read local files.
+    if segments > 1 and not url.startswith("file://"):
+        get = (
+            "{ { command -v aria2c >/dev/null 2>&1"
+            f" && aria2c -q -x {segments} -s {segments} -c -m 5 --retry-wait=2"
+            f" -d {tmpdir} -o {filename} {q_url}; }} || {get}; }}"
+        )
+    lines.append(get)
+    if sha256 is not None:
+        checksum = shlex.quote(sha256)
+        lines.append(f"printf '%s  %s\\n' {checksum} {path} | sha256sum -c -")
+    if extract is not None:
+        lines.append(f"mkdir -p {q_dest}")
+        lines.append(untar(path))
+        lines.append('rm -rf "$_reproenv_tmpdir"')
+    return "\n".join(lines)
+
+
+_jinja_env.globals["download"] = _download
@@ -0,0 +1,425 @@
+"""Render container specifications in a long-running local server.
+
+Every call of the `reproenv` command pays for starting Python, importing modules,
+registering templates, and compiling template strings. `reproenv serve` pays for
+these once and renders renderer dictionaries sent over HTTP, on a Unix socket or on
+a local TCP port. Requests are handled concurrently in threads.
+
+Endpoints:
+
+- `POST /render` with a JSON body `{"spec": <renderer dictionary>, "targets":
+  ["docker", "singularity"], "template_path": [<directories>]}`. Returns
+  `{"rendered": {<target>: <specification>}}`, or status 400 and `{"error":
+  <message>}` if the dictionary cannot be rendered. If `template_path` is given and
+  is not the template path of the server, returns status 409, because the server
+  would render with different templates.
+- `GET /templates` returns `{"template_path": [<directories>], "templates":
+  [<names>]}`.
+- `GET /health` returns the status of the server, the number of registered
+  templates, counts and timings of requests, and statistics of the render cache.
+
+The templates in the template path are registered again when their content changes,
+so edited templates take effect without restarting the server. Rendered
+specifications are cached (see `reproenv.cache.RenderCache`), and concurrent
+requests of the same renderer dictionary are rendered once.
+
+When a server socket of the current user exists in a directory that only the
+current user can access (see `is_trusted_socket`), the `reproenv generate` commands
+send their renderer dictionaries to it instead of rendering them.
+"""
+
+import http.client
+import http.server
+import json
+import hashlib
+import os
+from pathlib import Path
+import socket
+import socketserver
+import stat
+import sys
+import tempfile
+import threading
+import time
+import typing as ty
+
+from reproenv.cache import RenderCache
+from reproenv.exceptions import RendererError
+from reproenv.exceptions import ReproEnvError
+from reproenv.state import active_registry
+from reproenv.state import TemplateRegistry
+from reproenv.state import use_registry
+
+
+class ServerUnavailable(ReproEnvError):
+    """No server is listening, or it cannot render a request with the same
+    templates as the client.
+    """
+
+
+def default_socket() -> Path:
+    """Return the path of the server socket.
+
+    This is `$REPROENV_SOCKET` if set, and otherwise `reproenv.sock` in
+    `$XDG_RUNTIME_DIR` or, if that is not set, in the directory `reproenv-<uid>` of
+    the temporary directory, which the server creates with mode 0700.
+    """
+    path = os.environ.get("REPROENV_SOCKET")
+    if path:
+        return Path(path)
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return Path(runtime_dir) / "reproenv.sock"
+    return Path(tempfile.gettempdir()) / f"reproenv-{os.getuid()}" / "reproenv.sock"
+
+
+def is_trusted_socket(path: ty.Union[str, os.PathLike]) -> bool:
+    """Return true if `path` is a socket of the current user in a directory that
+    only the current user can access.
+
+    Other users could otherwise create the socket first (e.g., in a shared temporary
+    directory) and answer requests with specifications of their choice.
+    """
+    path = Path(path)
+    uid = os.getuid()
+    try:
+        socket_stat = path.lstat()
+        directory_stat = path.parent.stat()
+    except OSError:
+        return False
+    return (
+        stat.S_ISSOCK(socket_stat.st_mode)
+        and socket_stat.st_uid == uid
+        and directory_stat.st_uid == uid
+        and not directory_stat.st_mode & 0o077
+    )
+
+
+def _normalize_template_path(template_path: ty.Iterable[str]) -> ty.List[str]:
+    return sorted({str(Path(p).resolve()) for p in template_path})
+
+
+def _template_files(template_path: ty.Iterable[str]) -> ty.List[Path]:
+    """Return the YAML templates in the directories of a template path."""
+    paths: ty.List[Path] = []
+    for p in template_path:
+        for pattern in ("*.yaml", "*.yml"):
+            paths.extend(sorted(Path(p).glob(pattern)))
+    return paths
+
+
+class _Templates:
+    """Registry of a server, with the templates of its template path registered
+    again when the content of the files changes.
+    """
+
+    def __init__(self, base: TemplateRegistry, template_path: ty.Iterable[str]):
+        self.template_path = _normalize_template_path(template_path)
+        self._base = base
+        self._lock = threading.Lock()
+        self._digests: ty.Optional[ty.Dict[str, str]] = None
+        self._registry = base
+
+    def _file_digests(self) -> ty.Dict[str, str]:
+        digests = {}
+        for path in _template_files(self.template_path):
+            try:
+                digests[str(path)] = hashlib.sha256(path.read_bytes()).hexdigest()
+            except FileNotFoundError:
+                pass  # removed since the directory was listed
+        return digests
+
+    def registry(self) -> TemplateRegistry:
+        """Return the registry, registering the templates again if they changed."""
+        digests = self._file_digests()
+        with self._lock:
+            if digests != self._digests:
+                registry = self._base.copy()
+                registry.register_many(list(digests))
+                self._registry, self._digests = registry, digests
+            return self._registry
+
+
+class _Stats:
+    """Counts and timings of requests, shared by all handler threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.render_seconds = 0.0
+
+    def record(self, seconds: float, error: bool) -> None:
+        with self._lock:
+            self.requests += 1
+            self.errors += error
+            self.render_seconds += seconds
+
+    def as_dict(self) -> ty.Dict[str, ty.Any]:
+        with self._lock:
+            return {
+                "uptime_seconds": time.time() - self.started,
+                "requests": self.requests,
+                "errors": self.errors,
+                "render_seconds": self.render_seconds,
+            }
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    server_version = "reproenv"
+    # Keep connections open for clients that send several requests.
+    protocol_version = "HTTP/1.1"
+
+    def _send_json(self, status: int, d: ty.Mapping) -> None:
+        body = json.dumps(d).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path not in {"/health", "/templates"}:
+            self._send_json(404, {"error": f"not found: {self.path}"})
+            return
+        templates = self.server.templates  # type: ignore
+        try:
+            registry = templates.registry()
+        except ReproEnvError as e:
+            self._send_json(500, {"status": "error", "error": str(e)})
+            return
+        if self.path == "/templates":
+            names = sorted(registry.keys())
+            d = {"template_path": templates.template_path, "templates": names}
+            self._send_json(200, d)
+            return
+        health = {"status": "ok", "templates": len(registry.keys())}
+        health.update(self.server.stats.as_dict())  # type: ignore
+        health["cache"] = self.server.cache.stats()._asdict()  # type: ignore
+        self._send_json(200, health)
+
+    def do_POST(self):
+        if self.path != "/render":
+            self._send_json(404, {"error": f"not found: {self.path}"})
+            return
+        start = time.perf_counter()
+        status, response = self._render()
+        error = status != 200
+        self.server.stats.record(time.perf_counter() - start, error)  # type: ignore
+        self._send_json(status, response)
+
+    def _render(self) -> ty.Tuple[int, ty.Dict[str, ty.Any]]:
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            if length < 0:
+                raise ValueError("negative Content-Length")
+            request = json.loads(self.rfile.read(length))
+            spec = request["spec"]
+            targets = request.get("targets", ["docker", "singularity"])
+        except (ValueError, TypeError, KeyError) as e:
+            return 400, {"error": f"invalid request: {e}"}
+        template_path = request.get("template_path")
+        templates = self.server.templates  # type: ignore
+        if template_path is not None:
+            if _normalize_template_path(template_path) != templates.template_path:
+                return 409, {"error": "server uses a different template path"}
+        try:
+            registry = templates.registry()
+        except ReproEnvError as e:
+            return 500, {"error": f"cannot register templates: {e}"}
+        try:
+            # The cache keys include the digests of the templates, so specifications
+            # rendered with templates that changed since are not reused.
+            with use_registry(registry):
+                rendered = self.server.cache.render(  # type: ignore
+                    spec, targets=targets
+                )
+            return 200, {"rendered": rendered}
+        except (ReproEnvError, ValueError) as e:
+            return 400, {"error": str(e)}
+
+    def log_message(self, format, *args):
+        if self.server.verbose:  # type: ignore
+            super().log_message(format, *args)
+
+    def address_string(self) -> str:
+        # Clients of Unix sockets do not have an address.
+        return str(self.client_address[0]) if self.client_address else "local"
+
+
+class _ServerMixin:
+    daemon_threads = True
+    # Many clients can connect at the same time, e.g., in parallel builds.
+    request_queue_size = 128
+    cache: RenderCache
+    stats: _Stats
+    templates: _Templates
+    verbose: bool
+
+    def handle_error(self, request, client_address):
+        # Clients that disconnect are not an error of the server.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)  # type: ignore
+
+
+class _TCPServer(_ServerMixin, http.server.ThreadingHTTPServer):
+    pass
+
+
+class _UnixServer(
+    _ServerMixin, socketserver.ThreadingMixIn, socketserver.UnixStreamServer
+):
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ("local", 0)
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except FileNotFoundError:
+            pass
+
+
+def make_server(
+    socket_path: ty.Union[str, os.PathLike, None] = None,
+    port: ty.Optional[int] = None,
+    host: str = "127.0.0.1",
+    template_path: ty.Iterable[str] = (),
+    verbose: bool = False,
+    cache_size: int = 1024,
+    cache_ttl: ty.Optional[float] = None,
+) -> socketserver.BaseServer:
+    """Return a server that renders with the registered templates and the templates
+    in `template_path`.
+
+    Call `.serve_forever()` on the server to start it, and `.server_close()` to
+    remove its socket.
+
+    Parameters
+    ----------
+    socket_path : str or Path-like
+        Listen on this Unix socket. A stale socket file is replaced. The directory of
+        the default socket is created with mode 0700.
+    port : int
+        Listen on this TCP port of `host` instead of a Unix socket.
+    host : str
+        Address to listen on with `port`.
+    template_path : iterable of str
+        Directories of templates to register. They are registered again when their
+        content changes. Requests that use other directories are refused.
+    verbose : bool
+        Log every request on stderr.
+    cache_size : int
+        Maximum number of cached renderings. If 0, renderings are not cached.
+    cache_ttl : float
+        Seconds after which cached renderings expire. Default is to never expire.
+    """
+    cache = RenderCache(maxsize=cache_size, ttl=cache_ttl)
+    templates = _Templates(active_registry().copy(), template_path)
+    # Raise errors in templates now rather than on the first request.
+    templates.registry()
+    server: _ServerMixin
+    if port is not None:
+        server = _TCPServer((host, port), _Handler)
+    else:
+        if socket_path is None:
+            path = default_socket()
+            path.parent.mkdir(mode=0o700, exist_ok=True)
+        else:
+            path = Path(socket_path)
+        if path.is_socket():
+            # Do not take over the socket of a server that is still running.
+            try:
+                with socket.socket(socket.AF_UNIX) as s:
+                    s.connect(str(path))
+            except OSError:
+                path.unlink()
+            else:
+                raise ReproEnvError(f"A server is already listening on '{path}'.")
+        server = _UnixServer(str(path), _Handler)
+    server.cache = cache
+    server.stats = _Stats()
+    server.templates = templates
+    server.verbose = verbose
+    return ty.cast(socketserver.BaseServer, server)
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: float):
+        super().__init__("localhost", timeout=timeout)
+        self._path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self._path)
+
+
+def _request(
+    method: str,
+    url: str,
+    socket_path: ty.Union[str, os.PathLike, None],
+    body: ty.Optional[ty.Mapping],
+    timeout: float,
+) -> ty.Tuple[int, ty.Dict[str, ty.Any]]:
+    path = str(socket_path if socket_path is not None else default_socket())
+    connection = _UnixHTTPConnection(path, timeout=timeout)
+    try:
+        if body is None:
+            connection.request(method, url)
+        else:
+            connection.request(
+                method,
+                url,
+                body=json.dumps(body),
+                headers={"Content-Type": "application/json"},
+            )
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    except (OSError, http.client.HTTPException, ValueError) as e:
+        raise ServerUnavailable(f"Cannot reach server on '{path}': {e}") from e
+    finally:
+        connection.close()
+
+
+def request_templates(
+    socket_path: ty.Union[str, os.PathLike, None] = None,
+    template_path: ty.Iterable[str] = (),
+    timeout: float = 60.0,
+) -> ty.List[str]:
+    """Return the names of the templates of the server on `socket_path`.
+
+    Raises `ServerUnavailable` if no server is listening or if the server uses
+    another template path.
+    """
+    status, body = _request("GET", "/templates", socket_path, None, timeout)
+    if status != 200:
+        raise ServerUnavailable(body["error"])
+    if body["template_path"] != _normalize_template_path(template_path):
+        raise ServerUnavailable("server uses a different template path")
+    return body["templates"]
+
+
+def request_render(
+    d: ty.Mapping,
+    targets: ty.Iterable[str] = ("docker", "singularity"),
+    socket_path: ty.Union[str, os.PathLike, None] = None,
+    template_path: ty.Optional[ty.Iterable[str]] = None,
+    timeout: float = 60.0,
+) -> ty.Dict[str, str]:
+    """Render a renderer dictionary with the server on `socket_path`.
+
+    Raises `ServerUnavailable` if no server is listening or if the server uses other
+    templates, and `RendererError` if the server cannot render the dictionary.
+    """
+    request: ty.Dict[str, ty.Any] = {"spec": d, "targets": list(targets)}
+    if template_path is not None:
+        request["template_path"] = list(template_path)
+    status, body = _request("POST", "/render", socket_path, request, timeout)
+    if status in {409, 500}:
+        raise ServerUnavailable(body["error"])
+    if status != 200:
+        raise RendererError(body["error"])
+    return body["rendered"]
@@ -1,12 +1,15 @@
 """Stateful objects in reproenv runtime."""
 
+import contextlib
+import contextvars
 import copy
+import functools
 import json
 import os
 from pathlib import Path
+import threading
 import typing as ty
 
-import jsonschema
 import yaml
 
 # The [C]SafeLoader will only load a subset of YAML, but that is fine for the
@@ -21,22 +24,54 @@ from reproenv.exceptions import TemplateError
 from reproenv.exceptions import TemplateNotFound
 from reproenv.types import TemplateType
 
+if ty.TYPE_CHECKING:  # pragma: no cover
+    import jsonschema
+
 _schemas_path = Path(__file__).parent / "schemas"
 
-with (_schemas_path / "template.json").open("r") as f:
-    _TEMPLATE_SCHEMA: ty.Dict = json.load(f)
 
-with (_schemas_path / "renderer.json").open("r") as f:
-    _RENDERER_SCHEMA: ty.Dict = json.load(f)
+@functools.lru_cache(maxsize=None)
+def _load_schema(name: str) -> ty.Dict:
+    """Return a JSON schema in `_schemas_path`. Schemas are loaded on first use, and
+    the same dictionary is returned every time, so it must not be modified.
+    """
+    with (_schemas_path / name).open("r") as f:
+        return json.load(f)
+
+
+def _make_validator(schema: ty.Dict):
+    """Return a validator of a JSON schema.
+
+    Unlike `jsonschema.validate`, the validator does not check the schema every time
+    it validates, which is most of the cost of validating small documents.
+    """
+    import jsonschema
+
+    cls = jsonschema.validators.validator_for(schema)
+    cls.check_schema(schema)
+    return cls(schema)
+
+
+def _validate(
+    validator, instance
+) -> "ty.Optional[jsonschema.exceptions.ValidationError]":
+    """Return the error that `jsonschema.validate` would raise, or `None`."""
+    import jsonschema
+
+    return jsonschema.exceptions.best_match(validator.iter_errors(instance))
+
+
+@functools.lru_cache(maxsize=None)
+def _schema_validator(name: str):
+    return _make_validator(_load_schema(name))
 
 
 def _validate_template(template: TemplateType):
     """Validate template against JSON schema. Raise exception if invalid."""
     # TODO: should reproenv have a custom exception for invalid templates? probably
-    try:
-        jsonschema.validate(template, schema=_TEMPLATE_SCHEMA)
-    except jsonschema.exceptions.ValidationError as e:
-        raise TemplateError(f"Invalid template: {e.message}.") from e
+    error = _validate(_schema_validator("template.json"), template)
+    if error is not None:
+        raise TemplateError(f"Invalid template: {error.message}.") from error
 
     # TODO: Check that all variables in the instructions are listed in arguments.
     # something like https://stackoverflow.com/a/8284419/5666087
@@ -48,25 +83,98 @@ def _validate_template(template: TemplateType):
 
 def _validate_renderer(d):
     """Validate renderer dictionary against JSON schema. Raise exception if invalid."""
-    try:
-        jsonschema.validate(d, schema=_RENDERER_SCHEMA)
-    except jsonschema.exceptions.ValidationError as e:
-        raise RendererError(f"Invalid renderer dictionary: {e.message}.") from e
+    error = _validate(active_registry()._renderer_validator(), d)
+    if error is not None:
+        raise RendererError(f"Invalid renderer dictionary: {error.message}.") from error
+
+
+def _load_template(
+    path_or_template: ty.Union[str, os.PathLike, TemplateType], name: str = None
+) -> ty.Tuple[str, TemplateType, str, ty.Dict]:
+    """Return the name, the validated template, and the key and definition of the
+    template in the renderer schema (see `TemplateRegistry.register`).
+    """
+    if isinstance(path_or_template, dict):
+        if name is None:
+            raise ValueError("`name` required when template is not a file")
+        name = str(name)
+        template = copy.deepcopy(path_or_template)
+    else:
+        path_or_template = Path(path_or_template)
+        if not path_or_template.is_file():
+            raise ValueError("template is not path to a file or a dictionary")
+        with path_or_template.open() as f:
+            template = yaml.load(f, Loader=SafeLoader)
+
+    _validate_template(template)
+    if name is None:
+        name = str(template["name"])
+
+    # Add the template name as an optional key to the renderer schema. This is
+    # so that the dictionary passed to the `Renderer.from_dict()` method can
+    # contain names of registered templates. These templates are not known when the
+    # renderer schema is created.
+    # However, this schema is lax because the kwds just has to be an object. Keys
+    # and values in kwds are validated in the renderer.
+    key = f"template_{name.replace(' ', '_')}"
+    definition = {
+        "required": ["name", "kwds"],
+        "properties": {
+            "name": {"enum": [name]},
+            "kwds": {
+                "type": "object",
+            },
+        },
+        "additionalProperties": False,
+    }
+    return name, template, key, definition
 
 
-class _TemplateRegistry:
-    """Object to hold templates in memory."""
+class _Snapshot(ty.NamedTuple):
+    """Contents of a `TemplateRegistry`. Snapshots are never modified, so they can
+    be read without a lock while another thread registers templates.
+    """
 
-    _templates: ty.Dict[str, TemplateType] = {}
+    # Templates by lower-case name.
+    templates: ty.Dict[str, TemplateType]
+    # Definitions of the registered templates in the renderer schema, by key.
+    definitions: ty.Dict[str, ty.Dict]
 
-    @classmethod
-    def _reset(cls):
-        """Clear all templates."""
-        cls._templates = {}
 
-    @classmethod
+class TemplateRegistry:
+    """Templates, and the renderer schema that accepts them.
+
+    The module-level registry functions (e.g., `reproenv.register_template`) use the
+    active registry, which is the default registry unless another one is activated
+    with `use_registry`. Registering is thread-safe. Reading does not lock, because
+    registering replaces the contents instead of modifying them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = _Snapshot(templates={}, definitions={})
+        # Definitions, and the renderer schema and its validator derived from them.
+        self._schema: ty.Tuple[ty.Optional[ty.Dict], ty.Dict, ty.Any] = (None, {}, None)
+
+    @property
+    def _templates(self) -> ty.Dict[str, TemplateType]:
+        return self._snapshot.templates
+
+    def copy(self) -> "TemplateRegistry":
+        """Return a registry with the same templates, e.g., to register more
+        templates for one tenant of a service.
+        """
+        registry = TemplateRegistry()
+        registry._snapshot = self._snapshot
+        return registry
+
+    def _reset(self):
+        """Clear all templates, and restore the pristine renderer schema."""
+        with self._lock:
+            self._snapshot = _Snapshot(templates={}, definitions={})
+
     def register(
-        cls,
+        self,
         path_or_template: ty.Union[str, os.PathLike, TemplateType],
         name: str = None,
     ):
@@ -87,51 +195,105 @@ class _TemplateRegistry:
             can be omitted and instead comes from `template["name"]`. If
             `path_or_template` is a `dict`, then `name` is required.
         """
-        if isinstance(path_or_template, dict):
-            if name is None:
-                raise ValueError("`name` required when template is not a file")
-            name = str(name)
-            template = copy.deepcopy(path_or_template)
+        self._add([_load_template(path_or_template, name=name)])
+
+    def register_many(
+        self,
+        templates: ty.Union[
+            ty.Iterable[ty.Union[str, os.PathLike]], ty.Mapping[str, TemplateType]
+        ],
+    ):
+        """Register several templates at once. Use this instead of calling `register`
+        for each template, which copies all registered templates every time.
+
+        Templates are only registered if all of them are valid.
+
+        Parameters
+        ----------
+        templates : iterable of str or Path-like, or mapping of str to TemplateType
+            Paths to YAML files that define the templates, or templates by name.
+        """
+        if isinstance(templates, ty.Mapping):
+            loaded = [_load_template(t, name=n) for n, t in templates.items()]
         else:
-            path_or_template = Path(path_or_template)
-            if not path_or_template.is_file():
-                raise ValueError("template is not path to a file or a dictionary")
-            with path_or_template.open() as f:
-                template = yaml.load(f, Loader=SafeLoader)
+            loaded = [_load_template(path) for path in templates]
+        self._add(loaded)
 
-        _validate_template(template)
-        if name is None:
-            name = str(template["name"])
-
-        # Add the template name as an optional key to the renderer schema. This is
-        # so that the dictionary passed to the `Renderer.from_dict()` method can
-        # contain names of registered templates. These templates are not known when the
-        # renderer schema is created.
-        # However, this schema is lax because the kwds just has to be an object. Keys
-        # and values in kwds are validated in the renderer.
-        key = f"template_{name.replace(' ', '_')}"
-        _RENDERER_SCHEMA["definitions"][key] = {
-            "required": ["name", "kwds"],
+    def _add(self, loaded: ty.Iterable[ty.Tuple[str, TemplateType, str, ty.Dict]]):
+        # Add templates to registry.
+        # TODO: should we log a message if overwriting a key-value pair?
+        with self._lock:
+            snapshot = self._snapshot
+            templates = dict(snapshot.templates)
+            definitions = dict(snapshot.definitions)
+            for name, template, key, definition in loaded:
+                templates[name.lower()] = template
+                definitions[key] = definition
+            self._snapshot = _Snapshot(templates=templates, definitions=definitions)
+
+    def unregister(self, name: str):
+        """Remove a template, and its definition in the renderer schema.
+
+        Raises `TemplateNotFound` if no template with this name is registered.
+        """
+        name = name.lower()
+        with self._lock:
+            snapshot = self._snapshot
+            if name not in snapshot.templates:
+                known = "', '".join(snapshot.templates.keys())
+                raise TemplateNotFound(
+                    f"Unknown template '{name}'. Registered templates are '{known}'."
+                )
+            templates = dict(snapshot.templates)
+            del templates[name]
+            # A template can have several definitions if it was registered with
+            # names that only differ in case.
+            definitions = {
+                key: definition
+                for key, definition in snapshot.definitions.items()
+                if definition["properties"]["name"]["enum"][0].lower() != name
+            }
+            self._snapshot = _Snapshot(templates=templates, definitions=definitions)
+
+    def renderer_schema(self) -> ty.Dict:
+        """Return the renderer schema with the registered templates. The schema must
+        not be modified.
+        """
+        return self._derive_schema()[1]
+
+    def _renderer_validator(self):
+        return self._derive_schema()[2]
+
+    def _derive_schema(self) -> ty.Tuple[ty.Dict, ty.Dict, ty.Any]:
+        definitions = self._snapshot.definitions
+        derived = self._schema
+        if derived[0] is definitions:
+            return derived  # type: ignore
+        # Only copy the parts of the pristine schema that change.
+        pristine = _load_schema("renderer.json")
+        instructions = pristine["properties"]["instructions"]
+        schema = {
+            **pristine,
+            "definitions": {**pristine["definitions"], **definitions},
             "properties": {
-                "name": {"enum": [name]},
-                "kwds": {
-                    "type": "object",
+                **pristine["properties"],
+                "instructions": {
+                    **instructions,
+                    "items": {
+                        "oneOf": instructions["items"]["oneOf"]
+                        + [{"$ref": f"#/definitions/{key}"} for key in definitions]
+                    },
                 },
             },
-            "additionalProperties": False,
         }
-        # Do not add template to `instructions` properties if it has already been added.
-        template_ref = {"$ref": f"#/definitions/{key}"}
-        oneof = _RENDERER_SCHEMA["properties"]["instructions"]["items"]["oneOf"]
-        if template_ref not in oneof:
-            oneof.append(template_ref)
-
-        # Add template to registry.
-        # TODO: should we log a message if overwriting a key-value pair?
-        cls._templates[name.lower()] = template
+        # The pristine schema is checked once. The definitions of templates are
+        # always valid, so the derived schema is not checked again.
+        validator = type(_schema_validator("renderer.json"))(schema)
+        derived = (definitions, schema, validator)
+        self._schema = derived
+        return derived  # type: ignore
 
-    @classmethod
-    def get(cls, name: str) -> TemplateType:
+    def get(self, name: str) -> TemplateType:
         """Return a Template object from the registry given a template name.
 
         Parameters
@@ -143,19 +305,100 @@ class _TemplateRegistry:
         `register`.
         """
         name = name.lower()
+        templates = self._snapshot.templates
         try:
-            return cls._templates[name]
+            return templates[name]
         except KeyError:
-            known = "', '".join(cls._templates.keys())
+            known = "', '".join(templates.keys())
             raise TemplateNotFound(
                 f"Unknown template '{name}'. Registered templates are '{known}'."
             )
 
-    @classmethod
-    def keys(cls) -> ty.KeysView[str]:
+    def keys(self) -> ty.KeysView[str]:
+        """Return names of registered templates."""
+        return self._snapshot.templates.keys()
+
+    def items(self) -> ty.ItemsView[str, TemplateType]:
+        return self._snapshot.templates.items()
+
+
+_default_registry = TemplateRegistry()
+_active_registry: "contextvars.ContextVar[TemplateRegistry]" = contextvars.ContextVar(
+    "reproenv_registry", default=_default_registry
+)
+
+
+def active_registry() -> TemplateRegistry:
+    """Return the registry of the current thread or task."""
+    return _active_registry.get()
+
+
+@contextlib.contextmanager
+def use_registry(registry: TemplateRegistry) -> ty.Iterator[TemplateRegistry]:
+    """Activate a registry in the current thread or asyncio task.
+
+    Registries are context variables, so other threads and tasks keep using their own
+    registry. New threads use the default registry.
+    """
+    token = _active_registry.set(registry)
+    try:
+        yield registry
+    finally:
+        _active_registry.reset(token)
+
+
+class _ActiveRegistryMeta(type):
+    @property
+    def _templates(cls) -> ty.Dict[str, TemplateType]:
+        return active_registry()._templates
+
+
+class _TemplateRegistry(metaclass=_ActiveRegistryMeta):
+    """Functions of the active registry (see `TemplateRegistry`)."""
+
+    @staticmethod
+    def _reset():
+        """Clear all templates, and restore the pristine renderer schema."""
+        active_registry()._reset()
+
+    @staticmethod
+    def register(
+        path_or_template: ty.Union[str, os.PathLike, TemplateType],
+        name: str = None,
+    ):
+        """Register a template in the active registry. See
+        `TemplateRegistry.register`.
+        """
+        active_registry().register(path_or_template, name=name)
+
+    @staticmethod
+    def register_many(
+        templates: ty.Union[
+            ty.Iterable[ty.Union[str, os.PathLike]], ty.Mapping[str, TemplateType]
+        ],
+    ):
+        """Register several templates in the active registry. See
+        `TemplateRegistry.register_many`.
+        """
+        active_registry().register_many(templates)
+
+    @staticmethod
+    def unregister(name: str):
+        """Remove a template from the active registry. See
+        `TemplateRegistry.unregister`.
+        """
+        active_registry().unregister(name)
+
+    @staticmethod
+    def get(name: str) -> TemplateType:
+        """Return a template of the active registry given a template name."""
+        return active_registry().get(name)
+
+    @staticmethod
+    def keys() -> ty.KeysView[str]:
         """Return names of registered templates."""
-        return cls._templates.keys()
+        return active_registry().keys()
 
-    @classmethod
-    def items(cls) -> ty.ItemsView[str, TemplateType]:
-        return cls._templates.items()
+    @staticmethod
+    def items() -> ty.ItemsView[str, TemplateType]:
+        return active_registry().items()
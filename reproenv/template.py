@@ -187,8 +187,14 @@ class _BaseInstallationTemplate:
     def versions(self) -> ty.Set[str]:
         raise NotImplementedError()
 
-    def dependencies(self, pkg_manager: str) -> ty.List[str]:
+    def dependencies(self, pkg_manager: str, build: bool = False) -> ty.List[str]:
+        """Return system packages to install with `pkg_manager`. If `build` is true,
+        return packages that are only required to install the software and can be
+        removed afterwards.
+        """
         deps_dict = self._template.get("dependencies", {})
+        if build:
+            deps_dict = deps_dict.get("build", {})  # type: ignore
         # TODO: not sure why the following line raises a type error in mypy.
         return deps_dict.get(pkg_manager, [])  # type: ignore
 
@@ -0,0 +1,60 @@
+import pytest
+
+from reproenv.state import _TemplateRegistry
+
+
+@pytest.fixture
+def foo_template():
+    """Register only the template "foo", which has the versions 1.0 and 2.0."""
+    _TemplateRegistry._reset()
+    _TemplateRegistry.register(
+        {
+            "name": "foo",
+            "binaries": {
+                "urls": {"1.0": "foo-1.0", "2.0": "foo-2.0"},
+                "instructions": "install {{ self.urls[self.version] }}",
+                "arguments": {"required": ["version"]},
+            },
+        },
+        name="foo",
+    )
+
+
+@pytest.fixture
+def foo_specs():
+    """Renderer dictionaries that install "foo" in several base images."""
+    return [
+        {
+            "pkg_manager": "apt",
+            "instructions": [
+                {"name": "from_", "kwds": {"base_image": base_image}},
+                {"name": "foo", "kwds": {"version": version}},
+            ],
+        }
+        for base_image in ("debian", "ubuntu")
+        for version in ("1.0", "2.0")
+    ]
+
+
+@pytest.fixture
+def foo_matrix():
+    """Matrix of two base images and two versions of "foo"."""
+    return {
+        "pkg_manager": "apt",
+        "axes": [
+            [
+                {"name": "from_", "kwds": {"base_image": "debian:buster"}},
+                {"name": "from_", "kwds": {"base_image": "ubuntu:focal"}},
+            ],
+            [
+                [
+                    {"name": "arg", "kwds": {"key": "FOO", "value": "1"}},
+                    {"name": "install", "kwds": {"pkgs": ["git"]}},
+                ]
+            ],
+            [
+                {"name": "foo", "kwds": {"version": "1.0"}},
+                {"name": "foo", "kwds": {"version": "2.0"}},
+            ],
+        ],
+    }
@@ -0,0 +1,77 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from reproenv import bake
+from reproenv import batch
+from reproenv import matrix
+from reproenv.exceptions import RendererError
+
+
+@pytest.mark.usefixtures("foo_template")
+def test_bake_for_matrix(foo_matrix):
+    result = matrix.render_matrix(foo_matrix)
+    d = bake.bake_for_matrix(result, dockerfile="Dockerfile.matrix")
+    assert list(d["target"]) == [
+        "debian-buster-foo-1_0",
+        "debian-buster-foo-2_0",
+        "ubuntu-focal-foo-1_0",
+        "ubuntu-focal-foo-2_0",
+    ]
+    assert d["target"]["debian-buster-foo-1_0"] == {
+        "context": ".",
+        "dockerfile": "Dockerfile.matrix",
+        "target": "debian-buster-foo-1.0",
+        "tags": ["reproenv:debian-buster-foo-1.0"],
+        "cache-from": ["reproenv:debian-buster-foo-1.0"],
+        "cache-to": ["type=inline"],
+    }
+    assert d["group"] == {
+        "default": {"targets": list(d["target"])},
+        "shared-1": {"targets": ["debian-buster-foo-1_0", "debian-buster-foo-2_0"]},
+        "shared-2": {"targets": ["ubuntu-focal-foo-1_0", "ubuntu-focal-foo-2_0"]},
+    }
+
+    d = bake.bake_for_matrix(result, repository="r/img", cache="r/cache")
+    target = d["target"]["ubuntu-focal-foo-2_0"]
+    assert target["tags"] == ["r/img:ubuntu-focal-foo-2.0"]
+    assert target["cache-from"] == ["type=registry,ref=r/cache:ubuntu-focal-foo-2.0"]
+    assert target["cache-to"] == [
+        "type=registry,ref=r/cache:ubuntu-focal-foo-2.0,mode=max"
+    ]
+
+
+@pytest.mark.usefixtures("foo_template")
+def test_bake_for_batch(tmp_path: Path, monkeypatch, foo_matrix):
+    monkeypatch.chdir(tmp_path)
+    specs = matrix.expand_matrix(foo_matrix)[:2]
+    specs.append(specs[0])
+    specs.append({"pkg_manager": "apt", "instructions": [{"name": "foo"}]})
+    results = batch.render_many(specs, output_dir="out", targets=["docker"], jobs=1)
+    d = bake.bake_for_batch(specs, results, repository="r/img")
+    # Failed specs are skipped, and duplicate names are made unique.
+    assert d["group"]["default"]["targets"] == [
+        "debian-buster-foo-1_0",
+        "debian-buster-foo-2_0",
+        "debian-buster-foo-1_0-2",
+    ]
+    target = d["target"]["debian-buster-foo-1_0-2"]
+    assert target["dockerfile"] == str(Path("out", "2", "Dockerfile"))
+    assert target["tags"] == ["r/img:debian-buster-foo-1.0-2"]
+
+    bake.write_bake(d, "docker-bake.json")
+    assert json.loads(Path("docker-bake.json").read_text()) == d
+
+    with pytest.raises(RendererError, match="No Dockerfiles"):
+        bake.bake_for_batch(specs, results[3:])
+
+
+def test_validate_bake():
+    bake.validate_bake({"target": {"a": {"context": ".", "tags": ["a:b"]}}})
+    with pytest.raises(RendererError, match="Invalid bake file"):
+        bake.validate_bake({"target": {"a b": {}}})
+    with pytest.raises(RendererError, match="Invalid bake file"):
+        bake.validate_bake({"target": {"a": {"tags": ["Not A Tag"]}}})
+    with pytest.raises(RendererError, match="Invalid bake file"):
+        bake.validate_bake({"target": {"a": {"unknown": "value"}}})
@@ -0,0 +1,93 @@
+import json
+
+import pytest
+
+from reproenv import batch
+from reproenv.renderers import render
+
+
+def test_spec_digest():
+    d = {"pkg_manager": "apt", "instructions": []}
+    assert batch.spec_digest(d) == batch.spec_digest(dict(reversed(d.items())))
+    assert batch.spec_digest(d) != batch.spec_digest({**d, "pkg_manager": "yum"})
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+@pytest.mark.usefixtures("foo_template")
+def test_render_many(tmp_path, jobs, foo_specs):
+    specs = foo_specs
+    specs.append({"pkg_manager": "apt", "instructions": [{"name": "bar", "kwds": {}}]})
+
+    results = batch.render_many(specs, jobs=jobs)
+    assert [r.position for r in results] == list(range(5))
+    for spec, result in zip(specs[:4], results):
+        assert result.error is None
+        assert result.rendered == render(spec)
+        assert result.digest == batch.spec_digest(spec)
+        assert result.seconds > 0
+    assert "RendererError" in results[4].error
+
+    results = batch.render_many(
+        specs[:4], output_dir=tmp_path, targets=["docker"], jobs=jobs
+    )
+    assert results[3].rendered == {}
+    assert results[3].paths == {"docker": str(tmp_path / "3" / "Dockerfile")}
+    assert (tmp_path / "3" / "Dockerfile").read_text().startswith("FROM ubuntu")
+    assert not (tmp_path / "3" / "Singularity").exists()
+
+    batch.write_manifest(results, tmp_path / "results.jsonl")
+    lines = (tmp_path / "results.jsonl").read_text().splitlines()
+    assert json.loads(lines[3])["paths"] == results[3].paths
+
+
+def test_load_manifest(tmp_path, foo_specs):
+    specs = foo_specs
+    path = tmp_path / "specs.jsonl"
+    path.write_text("\n".join(json.dumps(spec) for spec in specs) + "\n\n")
+    assert batch.load_manifest(path) == specs
+    path = tmp_path / "specs.json"
+    path.write_text(json.dumps(specs))
+    assert batch.load_manifest(path) == specs
+    path.write_text(json.dumps(specs[0]))
+    with pytest.raises(ValueError):
+        batch.load_manifest(path)
+
+
+@pytest.mark.usefixtures("foo_template")
+def test_shards(tmp_path, foo_specs):
+    specs = foo_specs * 2 + [{"pkg_manager": "apt", "instructions": []}]
+    digests = [batch.spec_digest(spec) for spec in specs]
+    for count in (1, 2, 3):
+        shards = [(index, count) for index in range(1, count + 1)]
+        # Every spec is in exactly one shard.
+        for digest in digests:
+            assert sum(batch.in_shard(digest, shard) for shard in shards) == 1
+    with pytest.raises(ValueError):
+        batch.in_shard(digests[0], (0, 2))
+
+    results = [batch.render_many(specs, shard=(i, 3), jobs=1) for i in (1, 2, 3)]
+    assert sum(map(len, results)) == len(specs)
+    # Positions refer to the unsharded specs.
+    for result in results[0]:
+        assert result.digest == digests[result.position]
+
+    merged, coverage = batch.merge_results(results[0] + results[1] + results[2], specs)
+    assert coverage.complete
+    assert [r.position for r in merged] == list(range(len(specs)))
+
+    # Read results back.
+    batch.write_manifest(results[1], tmp_path / "results.jsonl")
+    assert batch.read_manifest(tmp_path / "results.jsonl") == [
+        r._replace(rendered={}) for r in results[1]
+    ]
+
+    merged, coverage = batch.merge_results(results[0] + results[0], specs)
+    assert not coverage.complete
+    assert coverage.missing == sorted(r.position for r in results[1] + results[2])
+    assert coverage.duplicated == [r.position for r in results[0]]
+    assert coverage.mismatched == []
+
+    # The manifest changed after rendering.
+    changed = specs[:-1] + [{"pkg_manager": "yum", "instructions": []}]
+    _, coverage = batch.merge_results(results[0] + results[1] + results[2], changed)
+    assert coverage.mismatched == [len(specs) - 1]
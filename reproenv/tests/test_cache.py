@@ -0,0 +1,229 @@
+import os
+import threading
+import time
+
+import pytest
+
+from reproenv import cache
+from reproenv.exceptions import ReproEnvError
+from reproenv.renderers import render
+from reproenv.state import _TemplateRegistry
+
+
+class _CountingRender:
+    def __init__(self, delay=0.0):
+        self.calls = 0
+        self.delay = delay
+        self._lock = threading.Lock()
+
+    def __call__(self, d, targets):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.delay)
+        return render(d, targets=targets)
+
+
+@pytest.mark.usefixtures("foo_template")
+def test_render_key(foo_specs):
+    d = foo_specs[0]
+    key = cache.render_key(d, ["docker"])
+    assert key == cache.render_key(dict(reversed(list(d.items()))), ["docker"])
+    assert key != cache.render_key(d, ["docker", "singularity"])
+    assert key != cache.render_key(foo_specs[1], ["docker"])
+
+    # The key changes when a template that the spec uses changes.
+    template = _TemplateRegistry.get("foo")
+    template["binaries"]["instructions"] = "install it"
+    _TemplateRegistry.register(template, name="foo")
+    assert key != cache.render_key(d, ["docker"])
+
+
+@pytest.mark.usefixtures("foo_template")
+def test_render_cache(foo_specs):
+    render_fn = _CountingRender()
+    c = cache.RenderCache(maxsize=2, render_fn=render_fn)
+    specs = foo_specs
+    assert c.render(specs[0]) == render(specs[0])
+    assert c.render(specs[0]) == render(specs[0])
+    assert render_fn.calls == 1
+    # Returned values can be changed without changing the cache.
+    c.render(specs[0])["docker"] = ""
+    assert c.render(specs[0]) == render(specs[0])
+
+    c.render(specs[1])
+    c.render(specs[0])
+    # The least recently used entry is evicted.
+    c.render(specs[2])
+    c.render(specs[0])
+    assert render_fn.calls == 3
+    assert c.stats() == cache.CacheStats(
+        hits=5, misses=3, waits=0, evictions=1, expirations=0, size=2
+    )
+
+    c.clear()
+    assert c.stats().size == 0
+
+    with pytest.raises(ValueError):
+        cache.RenderCache(maxsize=-1)
+    with pytest.raises(ValueError):
+        cache.RenderCache(ttl=0)
+
+
+@pytest.mark.usefixtures("foo_template")
+def test_render_cache_ttl(foo_specs):
+    render_fn = _CountingRender()
+    c = cache.RenderCache(ttl=0.05, render_fn=render_fn)
+    c.render(foo_specs[0])
+    c.render(foo_specs[0])
+    time.sleep(0.1)
+    c.render(foo_specs[0])
+    assert render_fn.calls == 2
+    assert c.stats().expirations == 1
+
+
+@pytest.mark.usefixtures("foo_template")
+def test_render_cache_single_flight(foo_specs):
+    render_fn = _CountingRender(delay=0.2)
+    # Nothing is stored, but concurrent requests are still rendered once.
+    c = cache.RenderCache(maxsize=0, render_fn=render_fn)
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(c.render(foo_specs[0])))
+        for _ in range(16)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert render_fn.calls == 1
+    assert results == [render(foo_specs[0])] * 16
+    stats = c.stats()
+    assert (stats.misses, stats.waits, stats.size) == (1, 15, 0)
+
+
+@pytest.mark.usefixtures("foo_template")
+def test_render_cache_errors_are_not_cached():
+    render_fn = _CountingRender(delay=0.2)
+    c = cache.RenderCache(render_fn=render_fn)
+    d = {"pkg_manager": "apt", "instructions": [{"name": "bar", "kwds": {}}]}
+    errors = []
+
+    def request():
+        try:
+            c.render(d)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=request) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 4
+    assert render_fn.calls == 1
+    with pytest.raises(type(errors[0])):
+        c.render(d)
+    assert render_fn.calls == 2
+    assert c.stats().size == 0
+
+
+@pytest.mark.usefixtures("foo_template")
+def test_disk_cache(tmp_path, foo_specs):
+    render_fn = _CountingRender()
+    c = cache.DiskCache(tmp_path)
+    specs = foo_specs
+    assert c.render(specs[0], render_fn=render_fn) == render(specs[0])
+    # Another process reads the same specifications.
+    c = cache.DiskCache(tmp_path)
+    assert c.render(specs[0], render_fn=render_fn) == render(specs[0])
+    assert render_fn.calls == 1
+    # Only missing targets are rendered.
+    next(tmp_path.glob("*/*")).unlink()
+    assert c.render(specs[0], render_fn=render_fn) == render(specs[0])
+    assert render_fn.calls == 2
+    stats = c.stats()
+    assert (stats.entries, stats.hits, stats.misses) == (2, 3, 1)
+
+    # The key changes when a template that the spec uses changes.
+    template = _TemplateRegistry.get("foo")
+    template["binaries"]["instructions"] = "install it"
+    _TemplateRegistry.register(template, name="foo")
+    assert "install it" in c.render(specs[0], targets=["docker"])["docker"]
+    assert c.stats().entries == 3
+
+    assert c.clear() == 3
+    assert c.stats().entries == 0
+
+
+@pytest.mark.usefixtures("foo_template")
+def test_disk_cache_prune(tmp_path, foo_specs, monkeypatch):
+    c = cache.DiskCache(tmp_path, max_size=0)
+    for d in foo_specs:
+        c.render(d, targets=["docker"])
+    assert c.stats().entries == 0
+
+    # The cache is only pruned when it is larger than its maximum size.
+    c = cache.DiskCache(tmp_path)
+    prune = c.prune
+    prunes = []
+    monkeypatch.setattr(c, "prune", lambda: prunes.append(prune()))
+    for d in foo_specs:
+        c.render(d, targets=["docker"])
+    assert not prunes
+    c.max_size = c.stats().size
+    c.render(foo_specs[0])
+    assert len(prunes) == 1
+    assert c.stats().size <= c.max_size
+    c.clear()
+
+    c = cache.DiskCache(tmp_path)
+    sizes = []
+    for i, d in enumerate(foo_specs):
+        c.render(d, targets=["docker"])
+        # Entries are ordered by modification time.
+        for path in tmp_path.glob("*/*"):
+            if path.stat().st_mtime > 100:
+                os.utime(path, (i, i))
+                sizes.append(path.stat().st_size)
+    # Reading an entry makes it the most recently used.
+    c.render(foo_specs[0], targets=["docker"])
+    c.max_size = sizes[0] + sizes[-1]
+    assert c.prune() == 2
+    remaining = {path.read_text() for path in tmp_path.glob("*/*")}
+    assert remaining == {
+        render(foo_specs[i], targets=["docker"])["docker"] for i in (0, 3)
+    }
+
+
+@pytest.mark.usefixtures("foo_template")
+def test_cache_artifacts(tmp_path, foo_specs, monkeypatch):
+    from reproenv import fetch
+
+    # Two build contexts with different artifacts for the same URL.
+    for digest in ("a" * 64, "b" * 64):
+        artifacts = tmp_path / digest[0] / "artifacts"
+        (artifacts / "urls").mkdir(parents=True)
+        (artifacts / "sha256").mkdir()
+        (artifacts / "urls" / fetch._url_key("foo-1.0")).write_text(digest)
+        (artifacts / "sha256" / digest).touch()
+    d = {**foo_specs[0], "artifacts_dir": "artifacts"}
+    disk_cache = cache.DiskCache(tmp_path / "renders")
+    memory_cache = cache.RenderCache()
+    for context in ("a", "b"):
+        monkeypatch.chdir(tmp_path / context)
+        for c in (disk_cache, memory_cache):
+            rendered = c.render(d, targets=["docker"])["docker"]
+            assert f"source=artifacts/sha256/{context * 64}" in rendered
+        # The build context can also be given in the renderer dictionary.
+        monkeypatch.chdir(tmp_path)
+        rendered = disk_cache.render({**d, "build_context": context}, ["docker"])
+        assert f"source=artifacts/sha256/{context * 64}" in rendered["docker"]
+    assert disk_cache.stats().misses == 4
+
+    # Specifications whose artifacts are not known (e.g., invalid ones) are
+    # rendered without the cache.
+    d["pkg_manager"] = "foo"
+    for _ in range(2):
+        with pytest.raises(ReproEnvError):
+            memory_cache.render(d)
+    assert memory_cache.stats().misses == 2
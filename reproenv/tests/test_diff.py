@@ -0,0 +1,90 @@
+from reproenv import diff
+from reproenv.renderers import DockerRenderer
+from reproenv.renderers import SingularityRenderer
+from reproenv.state import _TemplateRegistry
+
+
+def _register_template():
+    _TemplateRegistry._reset()
+    _TemplateRegistry.register(
+        {
+            "name": "foo",
+            "binaries": {
+                "urls": {"1.0": "foo-1.0", "2.0": "foo-2.0"},
+                "env": {"FOO": "{{ self.version }}"},
+                "instructions": "install {{ self.urls[self.version] }}",
+                "arguments": {"required": ["version"]},
+            },
+            "source": {
+                "instructions": "build foo",
+            },
+        },
+        name="foo",
+    )
+
+
+def _renderer_dict(version: str, method: str = "binaries"):
+    return {
+        "pkg_manager": "apt",
+        "instructions": [
+            {"name": "from_", "kwds": {"base_image": "debian"}},
+            {"name": "install", "kwds": {"pkgs": ["curl"]}},
+            {"name": "foo", "kwds": {"version": version, "method": method}},
+            {"name": "run", "kwds": {"command": "echo done"}},
+        ],
+    }
+
+
+def test_diff_docker():
+    _register_template()
+    old = _renderer_dict("1.0")
+
+    result = diff.diff_docker(old, old)
+    assert not result.changed
+    assert result.cost == 0
+    assert len(result.reused) == 5
+
+    result = diff.diff_docker(old, _renderer_dict("2.0"))
+    assert result.changed
+    assert [s.instruction for s in result.reused] == [
+        "FROM debian",
+        "RUN apt-get update -qq \\",
+    ]
+    assert result.rebuilt == [
+        diff.Step('ENV FOO="2.0"', "foo (binaries)", 0),
+        diff.Step("RUN install foo-2.0", "foo (binaries)", 5),
+        diff.Step("RUN echo done", None, 1),
+    ]
+    assert result.cost == 6
+
+    new = _renderer_dict("2.0")
+    new["instructions"].insert(1, {"name": "foo", "kwds": {"method": "source"}})
+    result = diff.diff_docker(old, new)
+    assert [s.instruction for s in result.reused] == ["FROM debian"]
+    assert result.rebuilt[0] == diff.Step("RUN build foo", "foo (source)", 20)
+    assert result.cost == 27
+
+    old_renderer = DockerRenderer.from_dict(old)
+    assert diff.diff_docker(old_renderer, DockerRenderer.from_dict(new)) == result
+
+
+def test_diff_singularity():
+    _register_template()
+    old = _renderer_dict("1.0")
+    result = diff.diff_singularity(old, old)
+    assert not result.changed
+    assert result.cost == 0
+
+    new = _renderer_dict("2.0")
+    new["instructions"].append({"name": "label", "kwds": {"build": "2"}})
+    result = diff.diff_singularity(old, new)
+    assert result.sections == ["%environment", "%labels"]
+    assert result.post_changed == [diff.Step("install foo-2.0", "foo (binaries)", 5)]
+    assert result.post_removed == [diff.Step("install foo-1.0", "foo (binaries)", 5)]
+    # Singularity rebuilds everything.
+    assert result.cost == 7
+
+    result = diff.diff_singularity(
+        SingularityRenderer.from_dict(old), SingularityRenderer.from_dict(new)
+    )
+    assert result.post_changed == [diff.Step("install foo-2.0", "foo (binaries)", 5)]
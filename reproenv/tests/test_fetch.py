@@ -0,0 +1,149 @@
+import functools
+import hashlib
+import http.server
+import threading
+
+import pytest
+
+from reproenv import fetch
+from reproenv.exceptions import FetchError
+from reproenv.state import _TemplateRegistry
+from reproenv import types
+
+
+@pytest.fixture
+def http_server(tmp_path):
+    """Serve files in a temporary directory over HTTP. Yields (root, base_url)."""
+    root = tmp_path / "www"
+    root.mkdir()
+    handler = functools.partial(
+        http.server.SimpleHTTPRequestHandler, directory=str(root)
+    )
+    handler.log_message = lambda *args: None  # type: ignore
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield root, f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def _register_template(base_url: str):
+    template: types.TemplateType = {
+        "name": "foo",
+        "binaries": {
+            "urls": {
+                "1.0": f"{base_url}/foo-1.0.tar.gz",
+                "2.0": f"{base_url}/foo-2.0.tar.gz",
+            },
+            "dependencies": {"debs": [f"{base_url}/libfoo.deb"]},
+            "instructions": "curl {{ self.urls[self.version] }}",
+            "arguments": {"required": ["version"], "optional": []},
+        },
+    }
+    _TemplateRegistry._reset()
+    _TemplateRegistry.register(template, name="foo")
+
+
+def test_urls_for_renderer_dict():
+    _register_template("http://example.com")
+    d = {
+        "pkg_manager": "apt",
+        "instructions": [
+            {"name": "from_", "kwds": {"base_image": "debian"}},
+            {"name": "foo", "kwds": {"version": "1.0"}},
+            {"name": "foo", "kwds": {"version": "2.0", "method": "binaries"}},
+        ],
+    }
+    assert fetch.urls_for_renderer_dict(d) == [
+        "http://example.com/foo-1.0.tar.gz",
+        "http://example.com/libfoo.deb",
+        "http://example.com/foo-2.0.tar.gz",
+    ]
+    # debs are only downloaded with apt.
+    d["pkg_manager"] = "yum"
+    assert fetch.urls_for_renderer_dict(d) == [
+        "http://example.com/foo-1.0.tar.gz",
+        "http://example.com/foo-2.0.tar.gz",
+    ]
+
+    assert fetch.urls_for_template_versions(["foo:2.0"]) == [
+        "http://example.com/foo-2.0.tar.gz",
+        "http://example.com/libfoo.deb",
+    ]
+    with pytest.raises(FetchError):
+        fetch.urls_for_template_versions(["foo"])
+
+
+def test_fetch(http_server, tmp_path):
+    root, base_url = http_server
+    (root / "foo-1.0.tar.gz").write_bytes(b"foo 1.0")
+    (root / "libfoo.deb").write_bytes(b"libfoo")
+    # Same content as another artifact.
+    (root / "copy.tar.gz").write_bytes(b"foo 1.0")
+    cache_dir = tmp_path / "cache"
+
+    urls = [f"{base_url}/{name}" for name in ("foo-1.0.tar.gz", "libfoo.deb")]
+    results = fetch.fetch(urls, cache_dir=cache_dir, jobs=2, retries=0)
+    assert [r.url for r in results] == urls
+    assert not any(r.cached for r in results)
+    assert all(r.error is None for r in results)
+    # Artifacts are addressed by content.
+    assert results[0].path.name == hashlib.sha256(b"foo 1.0").hexdigest()
+    assert results[0].path.read_bytes() == b"foo 1.0"
+    assert fetch.cached_path(urls[0], cache_dir) == results[0].path
+
+    # Second fetch uses the cache.
+    results = fetch.fetch(urls, cache_dir=cache_dir, retries=0)
+    assert all(r.cached for r in results)
+
+    # Identical content is stored once.
+    (result,) = fetch.fetch([f"{base_url}/copy.tar.gz"], cache_dir=cache_dir)
+    assert result.path == fetch.cached_path(urls[0], cache_dir)
+    assert len(list((cache_dir / "sha256").iterdir())) == 2
+
+    # Failed downloads are reported, not raised.
+    (result,) = fetch.fetch([f"{base_url}/missing"], cache_dir=cache_dir, retries=0)
+    assert result.path is None
+    assert "404" in result.error
+    assert fetch.cached_path(f"{base_url}/missing", cache_dir) is None
+
+
+def test_fetch_errors(tmp_path, monkeypatch):
+    requests = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append(self.path)
+            if self.path == "/truncated":
+                self.send_response(200)
+                self.send_header("Content-Length", "10")
+                self.end_headers()
+                self.wfile.write(b"foo")
+            else:
+                self.send_error(403)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(fetch.time, "sleep", lambda seconds: None)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        results = fetch.fetch(
+            [f"{base_url}/truncated", f"{base_url}/forbidden"],
+            cache_dir=tmp_path,
+            retries=2,
+        )
+    finally:
+        server.shutdown()
+        server.server_close()
+    # Truncated responses are retried and reported, not raised.
+    assert results[0].path is None
+    assert "IncompleteRead" in results[0].error
+    assert requests.count("/truncated") == 3
+    # Client errors are not retried.
+    assert "403" in results[1].error
+    assert requests.count("/forbidden") == 1
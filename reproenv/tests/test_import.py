@@ -0,0 +1,55 @@
+import subprocess
+import sys
+
+import pytest
+
+import reproenv
+
+# Modules that are slow to import and are not needed to start the command-line
+# interface. They are imported on first use.
+_deferred = (
+    "jinja2",
+    "jsonschema",
+    "yaml",
+    "reproenv._version",
+    "reproenv.fetch",
+    "reproenv.renderers",
+    "reproenv.state",
+)
+
+
+def _imported_modules(module: str):
+    """Return the names of the modules that are imported when `module` is imported in
+    a new interpreter.
+    """
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        stderr=subprocess.PIPE,
+        check=True,
+        universal_newlines=True,
+    ).stderr
+    modules = set()
+    for line in stderr.splitlines():
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            modules.add(name.strip())
+    return modules
+
+
+@pytest.mark.parametrize("module", ["reproenv", "reproenv.cli.cli"])
+def test_deferred_imports(module: str):
+    modules = _imported_modules(module)
+    assert module in modules
+    assert not set(_deferred).intersection(modules)
+
+
+def test_lazy_attributes():
+    from reproenv.renderers import DockerRenderer
+    from reproenv.state import _TemplateRegistry
+
+    assert reproenv.DockerRenderer is DockerRenderer
+    assert reproenv.register_template == _TemplateRegistry.register
+    assert isinstance(reproenv.__version__, str)
+    assert {"DockerRenderer", "render", "__version__"}.issubset(dir(reproenv))
+    with pytest.raises(AttributeError, match="no attribute 'foo'"):
+        reproenv.foo
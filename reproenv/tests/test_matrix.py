@@ -0,0 +1,119 @@
+import pytest
+
+from reproenv import matrix
+from reproenv.exceptions import RendererError
+from reproenv.renderers import DockerRenderer
+
+
+def _stage_instructions(dockerfile: str):
+    """Return the instructions of each stage, by stage name."""
+    stages = {}
+    for stage in dockerfile.split("\n\n"):
+        lines = stage.splitlines()
+        stages[lines[0].rsplit(None, 1)[1]] = (lines[0], "\n".join(lines[1:]))
+    return stages
+
+
+def test_expand_matrix(foo_matrix):
+    variants = matrix.expand_matrix(foo_matrix)
+    assert len(variants) == 4
+    assert variants[0]["pkg_manager"] == "apt"
+    assert [i["name"] for i in variants[0]["instructions"]] == [
+        "from_",
+        "arg",
+        "install",
+        "foo",
+    ]
+    assert variants[3]["instructions"][3]["kwds"] == {"version": "2.0"}
+
+
+@pytest.mark.usefixtures("foo_template")
+def test_variant_name(foo_matrix):
+    d = matrix.expand_matrix(foo_matrix)[3]
+    assert matrix.variant_name(d) == "ubuntu-focal-foo-2.0"
+    d = {"instructions": [{"name": "from_", "kwds": {"base_image": "1/Foo:9"}}]}
+    assert matrix.variant_name(d) == "variant-1-foo-9"
+
+
+@pytest.mark.usefixtures("foo_template")
+def test_render_matrix(foo_matrix):
+    result = matrix.render_matrix(foo_matrix)
+    assert result.targets == {
+        "debian-buster-foo-1.0": "debian-buster-foo-1.0",
+        "debian-buster-foo-2.0": "debian-buster-foo-2.0",
+        "ubuntu-focal-foo-1.0": "ubuntu-focal-foo-1.0",
+        "ubuntu-focal-foo-2.0": "ubuntu-focal-foo-2.0",
+    }
+    assert result.stages == {
+        "shared-1": None,
+        "debian-buster-foo-1.0": "shared-1",
+        "debian-buster-foo-2.0": "shared-1",
+        "shared-2": None,
+        "ubuntu-focal-foo-1.0": "shared-2",
+        "ubuntu-focal-foo-2.0": "shared-2",
+    }
+    assert (result.n_instructions, result.n_instructions_built) == (16, 10)
+
+    stages = _stage_instructions(result.dockerfile)
+    assert stages["shared-1"][0] == "FROM debian:buster AS shared-1"
+    assert stages["debian-buster-foo-2.0"] == (
+        "FROM shared-1 AS debian-buster-foo-2.0",
+        # Build arguments are declared again.
+        "ARG FOO=1\nRUN install foo-2.0",
+    )
+
+    # Each variant builds the same instructions as its own Dockerfile.
+    for name, d in result.variants.items():
+        stage = result.targets[name]
+        body = []
+        while stage is not None:
+            header, instructions = stages[stage]
+            body.insert(0, instructions)
+            stage = result.stages[stage]
+        dockerfile = str(DockerRenderer.from_dict(d))
+        base_image = d["instructions"][0]["kwds"]["base_image"]
+        expected = dockerfile.replace(f"FROM {base_image}\n", "", 1)
+        assert "\n".join(body).replace("ARG FOO=1\n", "") == expected.replace(
+            "ARG FOO=1\n", ""
+        )
+
+
+@pytest.mark.usefixtures("foo_template")
+def test_render_matrix_variants():
+    base = {
+        "pkg_manager": "apt",
+        "instructions": [
+            {"name": "from_", "kwds": {"base_image": "debian"}},
+            {"name": "run", "kwds": {"command": "echo foo"}},
+        ],
+    }
+    longer = {**base, "instructions": base["instructions"] + [base["instructions"][1]]}
+    # One variant extends the other, and duplicate variants get unique names.
+    result = matrix.render_matrix([longer, base, base])
+    assert result.targets == {
+        "debian": "debian",
+        "debian-2": "debian-2",
+        "debian-3": "debian-2",
+    }
+    assert result.stages == {"debian-2": None, "debian": "debian-2"}
+    assert result.dockerfile == (
+        "FROM debian AS debian-2\nRUN echo foo\n\nFROM debian-2 AS debian\nRUN echo foo"
+    )
+
+    with pytest.raises(RendererError, match="one build stage"):
+        matrix.render_matrix([{**base, "instructions": base["instructions"] * 2}])
+    with pytest.raises(RendererError, match="does not have any variants"):
+        matrix.render_matrix([])
+
+
+@pytest.mark.usefixtures("foo_template")
+def test_render_matrix_shards(foo_matrix):
+    targets = {}
+    for index in (1, 2, 3):
+        try:
+            result = matrix.render_matrix(foo_matrix, shard=(index, 3))
+        except RendererError:
+            continue
+        assert not targets.keys() & result.targets.keys()
+        targets.update(result.targets)
+    assert targets == matrix.render_matrix(foo_matrix).targets
@@ -1,9 +1,18 @@
+import hashlib
+import shutil
+import subprocess
+import tarfile
+
 import pytest
 
+from reproenv import ir
 from reproenv.exceptions import RendererError
+from reproenv.renderers import _download
 from reproenv.renderers import _Renderer
 from reproenv.renderers import DockerRenderer
+from reproenv.renderers import render
 from reproenv.renderers import SingularityRenderer
+from reproenv.template import Template
 
 
 def test_renderer():
@@ -39,25 +48,159 @@ def test_renderer_eq(renderer_cls):
 
 def test_not_implemented_methods():
     r = _Renderer("yum")
+    # Instructions are recorded, but the base class cannot render them.
+    r.from_("baseimage").run_bash("foo").user("nonroot")
+    assert r._ir == [
+        ir.From("baseimage"),
+        ir.Run("bash -c 'foo'"),
+        ir.Run(
+            'test "$(getent passwd nonroot)" \\\n|| useradd --no-user-group'
+            " --create-home --shell /bin/bash nonroot\n"
+        ),
+        ir.User("nonroot"),
+    ]
     with pytest.raises(NotImplementedError):
-        r.arg(key="a", value="b")
-    with pytest.raises(NotImplementedError):
-        r.copy("", "")
-    with pytest.raises(NotImplementedError):
-        r.env(foo="bar")
-    with pytest.raises(NotImplementedError):
-        r.from_("baseimage")
-    with pytest.raises(NotImplementedError):
-        r.label(foo="bar")
-    with pytest.raises(NotImplementedError):
-        r.run("foo")
-    with pytest.raises(NotImplementedError):
-        # This is implemented but calls `.run()`
-        r.run_bash("foo")
-    with pytest.raises(NotImplementedError):
-        r.user("nonroot")
-    with pytest.raises(NotImplementedError):
-        r.workdir("/opt/")
+        str(r)
+
+
+@pytest.mark.parametrize("renderer_cls", [DockerRenderer, SingularityRenderer])
+def test_passes(renderer_cls):
+    def drop_labels(instructions):
+        return [i for i in instructions if not isinstance(i, ir.Label)]
+
+    def add_origin_comment(instructions):
+        return [
+            i._replace(command=f"# {i.origin}\n{i.command}")
+            if isinstance(i, ir.Run) and i.origin
+            else i
+            for i in instructions
+        ]
+
+    d = {"name": "foo", "binaries": {"urls": {"1": "foo"}, "instructions": "echo foo"}}
+    r = renderer_cls("apt").from_("debian").label(build="1")
+    r.add_template(Template(d), method="binaries")
+    assert r._ir[-1] == ir.Run("echo foo", origin="foo (binaries)")
+
+    assert r.add_pass(drop_labels) is r
+    r.add_pass(add_origin_comment)
+    s = str(r)
+    assert "build" not in s
+    assert "# foo (binaries)" in s
+    # Passes do not modify the instructions of the renderer.
+    assert isinstance(r._ir[1], ir.Label)
+
+
+def test_render():
+    d = {
+        "pkg_manager": "apt",
+        "package_proxy": "http://apt-cache:3142",
+        "instructions": [
+            {"name": "from_", "kwds": {"base_image": "debian"}},
+            {"name": "install", "kwds": {"pkgs": ["curl"]}},
+            {"name": "user", "kwds": {"user": "nonroot"}},
+        ],
+    }
+    out = render(d)
+    assert out == {
+        "docker": str(DockerRenderer.from_dict(d)),
+        "singularity": str(SingularityRenderer.from_dict(d)),
+    }
+    assert render(d, targets=["singularity"]) == {"singularity": out["singularity"]}
+    with pytest.raises(RendererError, match="Unknown target"):
+        render(d, targets=["podman"])
+
+    # Docker-only instructions.
+    r = DockerRenderer("apt").from_("debian").copy(["/a"], "/a", from_="builder")
+    with pytest.raises(RendererError, match="cannot copy files from other build"):
+        str(r._with_class(SingularityRenderer))
+    d["instructions"][0]["kwds"]["as_"] = "builder"
+    assert "FROM debian AS builder" in render(d, targets=["docker"])["docker"]
+    with pytest.raises(RendererError, match="do not have named build stages"):
+        render(d, targets=["singularity"])
+    with pytest.raises(RendererError, match="do not have named build stages"):
+        SingularityRenderer("apt").from_("debian", as_="builder")
+    with pytest.raises(RendererError, match="cannot set the owner"):
+        SingularityRenderer("apt").copy(["/a"], "/a", chown="nonroot")
 
 
 # TODO: add many tests for `indent`.
+
+
+def _run_shell(command: str):
+    subprocess.run(["sh", "-ec", command], check=True)
+
+
+@pytest.mark.skipif(shutil.which("curl") is None, reason="curl not available")
+@pytest.mark.parametrize("sha256", [False, True])
+@pytest.mark.parametrize("segments", [1, 4])
+def test_download(tmp_path, sha256, segments):
+    (tmp_path / "src" / "foo-1.0").mkdir(parents=True)
+    (tmp_path / "src" / "foo-1.0" / "foo.txt").write_text("foo")
+    archive = tmp_path / "foo.tar.gz"
+    with tarfile.open(archive, "w:gz") as tar:
+        tar.add(tmp_path / "src" / "foo-1.0", arcname="foo-1.0")
+    checksum = hashlib.sha256(archive.read_bytes()).hexdigest()
+
+    dest = tmp_path / "dest"
+    cmd = _download(
+        archive.as_uri(),
+        str(dest),
+        sha256=checksum if sha256 else None,
+        extract="tar.gz",
+        strip_components=1,
+        segments=segments,
+    )
+    _run_shell(cmd)
+    assert (dest / "foo.txt").read_text() == "foo"
+
+    # Download without extracting.
+    dest = tmp_path / "bin" / "foo.tar.gz"
+    _run_shell(_download(archive.as_uri(), str(dest), segments=segments))
+    assert dest.read_bytes() == archive.read_bytes()
+
+    # Shell variables in the URL and destination expand.
+    dest = tmp_path / "var" / "foo.tar.gz"
+    cmd = _download("${FOO_URL}", str(tmp_path / "${FOO_DIR}" / "foo.tar.gz"))
+    _run_shell(f"FOO_URL={archive.as_uri()} FOO_DIR=var\n{cmd}")
+    assert dest.read_bytes() == archive.read_bytes()
+
+    # Checksum mismatch.
+    cmd = _download(archive.as_uri(), str(tmp_path / "bad"), sha256="0" * 64)
+    with pytest.raises(subprocess.CalledProcessError):
+        _run_shell(cmd)
+
+
+def test_download_in_template():
+    d = {
+        "name": "foo",
+        "binaries": {
+            "urls": {"1.0": "https://example.com/foo-1.0.tar.gz"},
+            "instructions": (
+                '{{ download(self.urls[self.version], "/opt/foo", extract="tar.gz") }}'
+            ),
+            "arguments": {"required": ["version"]},
+        },
+    }
+    r = DockerRenderer("apt").add_template(
+        Template(d, binaries_kwds=dict(version="1.0")), method="binaries"
+    )
+    assert str(r) == (
+        "RUN mkdir -p /opt/foo \\\n"
+        "    && curl -fsSL --retry 5 --retry-delay 2 --retry-connrefused"
+        " https://example.com/foo-1.0.tar.gz | tar -xzf - -C /opt/foo"
+    )
+
+    # The version can be set at build time.
+    r = DockerRenderer("apt", template_args=["version"]).add_template(
+        Template(d, binaries_kwds=dict(version="1.0")), method="binaries"
+    )
+    assert str(r).endswith('--retry-connrefused "${FOO_URL}" | tar -xzf - -C /opt/foo')
+    signature = '{{ download(self.urls[self.version] ~ ".sig", "/opt/foo.sig") }}'
+    d["binaries"]["instructions"] = signature
+    with pytest.raises(RendererError, match="uses its value in a Jinja expression"):
+        DockerRenderer("apt", template_args=["version"]).add_template(
+            Template(d, binaries_kwds=dict(version="1.0")), method="binaries"
+        )
+
+    with pytest.raises(RendererError, match="extract must be one of"):
+        _download("https://example.com/foo.zip", "/opt/foo", extract="zip")
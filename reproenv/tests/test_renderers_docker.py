@@ -286,3 +286,361 @@ USER nonroot
 WORKDIR /opt/foobar
 RUN bash -c 'source activate'"""
     )
+
+
+def test_docker_render_package_proxy():
+    d = DockerRenderer("apt", package_proxy="http://apt-cache:3142")
+    d.from_("debian:buster")
+    d.install(["curl"])
+    d.install(["git"])
+    d.user("nonroot")
+    s = str(d)
+    # The proxy is configured once, before the first install.
+    assert s.count("Acquire::http::Proxy") == 1
+    assert s.index("Acquire::http::Proxy") < s.index("curl")
+    # The proxy is removed at the end of the build, as root.
+    assert s.endswith(
+        """\
+USER root
+RUN rm -f /etc/apt/apt.conf.d/00reproenv-proxy
+USER nonroot"""
+    )
+
+    d = DockerRenderer("yum", package_proxy="http://proxy:3128")
+    d.from_("fedora:33")
+    d.install(["curl"])
+    s = str(d)
+    assert (
+        "printf '%s\\n' '# reproenv package proxy' proxy=http://proxy:3128"
+        " >> /etc/yum.conf" in s
+    )
+    assert s.endswith(
+        "RUN sed -i --follow-symlinks '/^# reproenv package proxy$/,+1d'"
+        " /etc/yum.conf"
+    )
+
+    # The URL is quoted in the shell.
+    d = DockerRenderer("apt", package_proxy="http://proxy:3128/$(id)';")
+    d.from_("debian:buster").install(["curl"])
+    assert "'http://proxy:3128/$(id)'\"'\"';' > /etc/apt" in str(d)
+
+    # No package installs, so no proxy.
+    d = DockerRenderer("apt", package_proxy="http://apt-cache:3142")
+    d.from_("debian:buster").run("echo foobar")
+    assert str(d) == "FROM debian:buster\nRUN echo foobar"
+
+    # Each build stage is configured separately, and the proxy is removed at the end
+    # of each stage, so stages that start from it do not inherit it.
+    d = DockerRenderer("apt", package_proxy="http://apt-cache:3142")
+    d.from_("debian:buster", as_="builder").install(["curl"]).user("nonroot")
+    d.from_("builder").run("echo foobar")
+    s = str(d)
+    assert s.count("Acquire::http::Proxy") == 1
+    assert s.endswith(
+        """\
+USER nonroot
+USER root
+RUN rm -f /etc/apt/apt.conf.d/00reproenv-proxy
+USER nonroot
+FROM builder
+RUN echo foobar"""
+    )
+    d = DockerRenderer("apt", package_proxy="http://apt-cache:3142")
+    d.from_("debian:buster", as_="builder").install(["curl"])
+    d.from_("debian:buster").install(["git"])
+    s = str(d)
+    assert s.count("Acquire::http::Proxy") == 2
+    assert s.count("rm -f /etc/apt/apt.conf.d/00reproenv-proxy") == 2
+
+
+def test_docker_render_install():
+    # Continuation lines are indented like those of other `RUN` instructions.
+    d = DockerRenderer("apt").install(["git", "curl"])
+    assert str(d) == (
+        "RUN apt-get update -qq \\\n"
+        "    && apt-get install -y -q --no-install-recommends \\\n"
+        "           curl \\\n"
+        "           git \\\n"
+        "    && rm -rf /var/lib/apt/lists/*"
+    )
+
+
+def test_docker_render_vendored_artifacts(tmp_path, monkeypatch):
+    from reproenv.fetch import fetch
+
+    artifact = tmp_path / "foo-1.0.tar.gz"
+    artifact.write_text("foo")
+    deb = tmp_path / "libfoo.deb"
+    deb.write_text("libfoo")
+    monkeypatch.chdir(tmp_path)
+    (result,) = fetch([artifact.as_uri()], cache_dir="artifacts")
+    digest = result.path.name
+
+    d = {
+        "name": "foo",
+        "binaries": {
+            "urls": {"1.0": artifact.as_uri()},
+            "dependencies": {"apt": ["curl"], "debs": [deb.as_uri()]},
+            "instructions": "curl -fsSL {{ self.urls[self.version] }} | tar xz",
+            "arguments": {"required": ["version"]},
+        },
+    }
+    t = Template(d, binaries_kwds=dict(version="1.0"))
+
+    # The deb was not fetched.
+    r = DockerRenderer("apt", artifacts_dir="artifacts")
+    with pytest.raises(RendererError, match="Artifact not found"):
+        r.add_template(t, method="binaries")
+
+    # debs are not installed with yum.
+    r = DockerRenderer("yum", artifacts_dir="artifacts")
+    r.add_template(t, method="binaries")
+    local = f"/tmp/reproenv-{digest}-foo-1.0.tar.gz"
+    # Artifacts are mounted, so they do not add layers to the image.
+    assert len(r._parts) == 1
+    assert r._parts[0].startswith(
+        f"RUN --mount=type=bind,source=artifacts/sha256/{digest},target={local} "
+    )
+    assert f"curl -fsSL file://{local} | tar xz" in r._parts[0]
+    assert "rm -f" not in r._parts[0]
+    assert artifact.as_uri() not in str(r)
+
+    # The artifact cache is relative to the build context.
+    monkeypatch.chdir("/")
+    with pytest.raises(RendererError, match="Artifact not found"):
+        DockerRenderer("yum", artifacts_dir="artifacts").add_template(t, "binaries")
+    r = DockerRenderer("yum", artifacts_dir="artifacts", build_context=str(tmp_path))
+    r.add_template(t, method="binaries")
+    assert f"source=artifacts/sha256/{digest}," in str(r)
+
+
+def test_docker_render_source_build_options():
+    d = {
+        "name": "foo",
+        "source": {
+            "dependencies": {"apt": ["make"]},
+            "instructions": "make\nmake install",
+        },
+    }
+
+    r = DockerRenderer("apt", build_jobs=4)
+    r.add_template(Template(d), method="source")
+    assert "&& export MAKEFLAGS=\"-j4\" CMAKE_BUILD_PARALLEL_LEVEL=\"4\" \\\n" in str(r)
+    assert "ccache" not in str(r)
+
+    r = DockerRenderer("apt", build_jobs="auto", ccache=True)
+    r.add_template(Template(d), method="source")
+    s = str(r)
+    # Users other than root can write to the cache.
+    assert s.startswith("RUN --mount=type=cache,target=/var/cache/ccache,mode=0777 ")
+    assert 'MAKEFLAGS="-j$(nproc)"' in s
+    assert "           ccache \\\n           make \\\n" in s
+    assert 'export PATH="/usr/lib/ccache:/usr/lib64/ccache:$PATH"' in s
+    assert s.index("export MAKEFLAGS") < s.index("&& make \\")
+
+    # Binaries are not affected.
+    b = {"name": "foo", "binaries": {"urls": {"1": "x"}, "instructions": "make"}}
+    r = DockerRenderer("apt", build_jobs=4, ccache=True)
+    r.add_template(Template(b), method="binaries")
+    assert str(r) == "RUN make"
+
+    with pytest.raises(RendererError, match="build_jobs must be"):
+        DockerRenderer("apt", build_jobs=0)
+
+
+def test_docker_render_build_dependencies():
+    d = {
+        "name": "foo",
+        "source": {
+            "dependencies": {
+                "apt": ["libfoo", "make"],
+                "build": {"apt": ["gcc", "make"], "yum": ["gcc"]},
+            },
+            "instructions": "make install",
+        },
+    }
+    r = DockerRenderer("apt")
+    r.add_template(Template(d), method="source")
+    assert (
+        str(r)
+        == """\
+RUN _reproenv_build_deps="$(for p in gcc; do dpkg -s "$p" >/dev/null 2>&1 || echo "$p"; done)" \\
+    && apt-get update -qq \\
+    && apt-get install -y -q --no-install-recommends \\
+           gcc \\
+           libfoo \\
+           make \\
+    && rm -rf /var/lib/apt/lists/* \\
+    && make install \\
+    && { test -z "$_reproenv_build_deps" || apt-get purge -y -q --autoremove $_reproenv_build_deps; }"""  # noqa: E501
+    )
+
+    r = DockerRenderer("yum")
+    r.add_template(Template(d), method="source")
+    assert 'rpm -q --whatprovides "$p"' in str(r)
+    assert str(r).endswith(
+        '&& { test -z "$_reproenv_build_deps"'
+        " || yum autoremove -y -q $_reproenv_build_deps; }"
+    )
+
+
+def test_docker_render_template_args():
+    d = {
+        "name": "foo-bar",
+        "binaries": {
+            "urls": {"1.0": "https://foo/1.0", "2.0": "https://foo/2.0"},
+            "env": {"FOO_VERSION": "{{ self.version }}"},
+            "instructions": "curl {{ self.urls[self.version] }} > {{ self.version }}",
+            "arguments": {"required": ["version"]},
+        },
+    }
+    t = Template(d, binaries_kwds=dict(version="1.0"))
+    r = DockerRenderer("apt", template_args=["version"])
+    r.add_template(t, method="binaries")
+    assert str(r) == (
+        "ARG FOO_BAR_VERSION=1.0\n"
+        'ENV FOO_VERSION="${FOO_BAR_VERSION}"\n'
+        'RUN case "${FOO_BAR_VERSION}" in'
+        ' "1.0") FOO_BAR_URL="https://foo/1.0" ;;'
+        ' "2.0") FOO_BAR_URL="https://foo/2.0" ;;'
+        ' *) echo "Unknown version of foo-bar: ${FOO_BAR_VERSION}" >&2; exit 1 ;;'
+        " esac \\\n"
+        "    && curl ${FOO_BAR_URL} > ${FOO_BAR_VERSION}"
+    )
+    # The template that was passed in is not modified.
+    assert t.binaries.version == "1.0"
+    assert set(t.binaries.urls) == {"1.0", "2.0"}
+
+    # Every version renders the same Dockerfile, except for the default.
+    t2 = Template(d, binaries_kwds=dict(version="2.0"))
+    r2 = DockerRenderer("apt", template_args=["version"])
+    r2.add_template(t2, method="binaries")
+    assert str(r2) == str(r).replace("VERSION=1.0", "VERSION=2.0")
+
+    # Templates without the keyword argument are not changed.
+    r = DockerRenderer("apt", template_args=["version"])
+    source = {"name": "foo", "source": {"instructions": "make"}}
+    r.add_template(Template(source), method="source")
+    assert str(r) == "RUN make"
+
+    r = DockerRenderer("apt", artifacts_dir="artifacts", template_args=["version"])
+    with pytest.raises(RendererError, match="set at build time"):
+        r.add_template(t, method="binaries")
+
+    # Jinja would use the build argument instead of the value.
+    d["binaries"]["instructions"] = (
+        '{% if self.version == "1.0" %}legacy {% endif %}curl {{ self.version }}'
+    )
+    r = DockerRenderer("apt", template_args=["version"])
+    with pytest.raises(RendererError, match="uses its value in a Jinja expression"):
+        r.add_template(Template(d, binaries_kwds=dict(version="1.0")), "binaries")
+    d["binaries"]["instructions"] = "curl {{ self.version | replace('.', '') }}"
+    with pytest.raises(RendererError, match="Cannot set 'version' of template"):
+        r.add_template(Template(d, binaries_kwds=dict(version="1.0")), "binaries")
+    assert str(r) == ""
+
+
+def _keywords(d: DockerRenderer):
+    """Return the keywords of the rendered instructions."""
+    return [line.split(None, 1)[0] for line in str(d).splitlines() if line[:1] != " "]
+
+
+def test_docker_reorder_for_cache():
+    d = DockerRenderer("apt", users={"root", "nonroot"})
+    d.arg("BASE", "debian")
+    d.from_("$BASE", as_="builder")
+    d.label(BUILD="123")
+    d.copy(["src"], "/opt/src")
+    d.arg("VERSION", "1.0")
+    d.copy(["notes.txt"], "notes.txt")
+    d.env(CC="gcc")
+    d.workdir("/opt")
+    d.install(["gcc"])
+    d.run("echo $VERSION")
+    d.from_("debian")
+    d.copy(["README"], "/README")
+    d.copy(["/opt/src/bin"], "/usr/bin", from_="builder")
+    d.run("apt-get update")
+    moves = d.reorder_for_cache()
+    assert [m.instruction for m in moves] == [
+        'COPY ["notes.txt", "notes.txt"]',
+        'COPY ["src", "/opt/src"]',
+        "ARG VERSION=1.0",
+        'LABEL BUILD="123"',
+        'COPY ["README", "/README"]',
+    ]
+    assert moves[0].reason.endswith(
+        "not moved further because the destination is relative to the working"
+        " directory"
+    )
+    assert moves[1].reason.endswith("because RUN may use the copied files")
+    assert moves[2].reason.endswith(
+        "because RUN gets build arguments as environment variables"
+    )
+    assert "not moved further" not in moves[3].reason
+    assert _keywords(d) == [
+        "ARG",
+        "FROM",
+        "ENV",
+        "COPY",  # notes.txt
+        "WORKDIR",
+        "COPY",  # src
+        "ARG",
+        "RUN",
+        "RUN",
+        "LABEL",
+        "FROM",
+        "COPY",  # --from is not moved
+        "COPY",  # README
+        "RUN",
+    ]
+    assert str(d).split("\nCOPY ")[2].startswith('["src", \\\n      "/opt/src"]')
+
+    # Nothing to do.
+    d = DockerRenderer("apt").from_("debian").run("echo foo").label(A="b")
+    assert d.reorder_for_cache() == []
+
+    # The pass also moves instructions that are added later.
+    d.label(B="c").run("echo bar")
+    assert str(d).endswith('RUN echo bar\nLABEL B="c"')
+
+
+def test_docker_reorder_for_cache_working_directory():
+    # Commands after a WORKDIR in the destination use the copied files.
+    d = DockerRenderer("apt").from_("debian")
+    d.copy(["src"], "/app").workdir("/app").run("make")
+    assert d.reorder_for_cache() == []
+    assert _keywords(d) == ["FROM", "COPY", "WORKDIR", "RUN"]
+
+    d = DockerRenderer("apt").from_("debian").workdir("/opt")
+    d.copy(["src"], "/opt/app").env(CC="gcc").workdir("app/build")
+    d.run("make")
+    (move,) = d.reorder_for_cache()
+    assert move.reason.endswith("because WORKDIR is in the destination '/opt/app'")
+    assert _keywords(d) == [
+        "FROM",
+        "WORKDIR",
+        "ENV",
+        "COPY",
+        "WORKDIR",
+        "RUN",
+    ]
+
+    # Stages based on another stage start in its working directory.
+    d = DockerRenderer("apt").from_("debian", as_="base").workdir("/app")
+    d.from_("base").copy(["src"], "/app/src").workdir("src")
+    assert d.reorder_for_cache() == []
+
+
+def test_docker_reorder_for_cache_run():
+    # Commands get build arguments as environment variables without naming them.
+    d = DockerRenderer("apt").from_("debian")
+    d.arg("DEBIAN_FRONTEND", "noninteractive").install(["tzdata"])
+    assert d.reorder_for_cache() == []
+    assert _keywords(d) == ["FROM", "ARG", "RUN"]
+
+    # Commands use copied files without naming them, e.g., on the PATH.
+    d = DockerRenderer("apt").from_("debian")
+    d.copy(["scripts/"], "/usr/local/bin/").run("setup.sh")
+    assert d.reorder_for_cache() == []
+    assert _keywords(d) == ["FROM", "COPY", "RUN"]
@@ -292,3 +292,81 @@ bash -c 'source activate'
 %labels
 ORG BAZ"""
     )
+
+
+def test_singularity_render_package_proxy():
+    s = SingularityRenderer("apt", package_proxy="http://apt-cache:3142")
+    s.from_("debian:buster")
+    s.install(["curl"])
+    s.install(["git"])
+    s.run("echo foobar")
+    out = str(s)
+    assert out.count("Acquire::http::Proxy") == 1
+    assert out.index("Acquire::http::Proxy") < out.index("curl")
+    assert out.endswith("echo foobar\n\nrm -f /etc/apt/apt.conf.d/00reproenv-proxy")
+
+
+def test_singularity_render_vendored_artifacts(tmp_path, monkeypatch):
+    from reproenv.fetch import fetch
+
+    artifact = tmp_path / "foo-1.0.tar.gz"
+    artifact.write_text("foo")
+    monkeypatch.chdir(tmp_path)
+    (result,) = fetch([artifact.as_uri()], cache_dir="artifacts")
+    digest = result.path.name
+
+    d = {
+        "name": "foo",
+        "binaries": {
+            "urls": {"1.0": artifact.as_uri()},
+            "instructions": "curl -fsSL {{ self.urls[self.version] }} | tar xz",
+            "arguments": {"required": ["version"]},
+        },
+    }
+    s = SingularityRenderer("apt", artifacts_dir="artifacts")
+    s.add_template(Template(d, binaries_kwds=dict(version="1.0")), method="binaries")
+    local = f"/tmp/reproenv-{digest}-foo-1.0.tar.gz"
+    sections = s._sections(s._ir)
+    assert sections["files"] == [f"artifacts/sha256/{digest} {local}"]
+    assert sections["post"] == [f"curl -fsSL file://{local} | tar xz\nrm -f {local}"]
+
+
+def test_singularity_render_source_build_options():
+    d = {"name": "foo", "source": {"instructions": "make"}}
+    s = SingularityRenderer("yum", build_jobs=2, ccache=True)
+    s.add_template(Template(d), method="source")
+    out = str(s)
+    assert "yum install -y -q \\\n    ccache" in out
+    assert 'export MAKEFLAGS="-j2" CMAKE_BUILD_PARALLEL_LEVEL="2"\n' in out
+    assert "CMAKE_CXX_COMPILER_LAUNCHER=ccache\nmake\n" in out
+    # ccache and its cache are only needed during the build.
+    assert out.endswith(
+        '{ test -z "$_reproenv_build_deps"'
+        " || yum autoremove -y -q $_reproenv_build_deps; }"
+        "\n)"
+        "\nrm -rf /var/cache/ccache"
+    )
+    # The environment of the build does not apply to later commands.
+    s.run("cmake .")
+    post = s._sections(s._ir)["post"]
+    assert post[-2].startswith("(\n") and "export MAKEFLAGS=" in post[-2]
+    assert post[-1] == "cmake ."
+
+
+def test_singularity_render_template_args():
+    d = {
+        "name": "foo",
+        "binaries": {
+            "urls": {"1.0": "https://foo/1.0"},
+            "env": {"FOO_VERSION": "{{ self.version }}"},
+            "instructions": "curl {{ self.urls[self.version] }}",
+            "arguments": {"required": ["version"]},
+        },
+    }
+    s = SingularityRenderer("apt", template_args=["version"])
+    s.add_template(Template(d, binaries_kwds=dict(version="1.0")), method="binaries")
+    sections = s._sections(s._ir)
+    # Build arguments do not exist at runtime.
+    assert sections["environment"] == [("FOO_VERSION", "1.0")]
+    assert sections["post"][0] == "FOO_VERSION=1.0"
+    assert sections["post"][1].endswith("esac\ncurl ${FOO_URL}")
@@ -0,0 +1,215 @@
+import http.client
+import json
+from pathlib import Path
+import threading
+
+from click.testing import CliRunner
+import pytest
+
+from reproenv import serve
+from reproenv.cli.cli import generate
+from reproenv.exceptions import RendererError
+from reproenv.exceptions import ReproEnvError
+from reproenv.state import _TemplateRegistry
+
+_template_path = str(Path(__file__).parent)
+
+_spec = {
+    "pkg_manager": "apt",
+    "instructions": [
+        {"name": "from_", "kwds": {"base_image": "debian"}},
+        {"name": "jq", "kwds": {"version": "1.6"}},
+    ],
+}
+
+
+@pytest.fixture
+def server(tmp_path: Path, monkeypatch):
+    _TemplateRegistry._reset()
+    _TemplateRegistry.register(Path(_template_path) / "sample-template-jq.yaml")
+    socket_path = tmp_path / "reproenv.sock"
+    monkeypatch.setenv("REPROENV_SOCKET", str(socket_path))
+    server = serve.make_server(template_path=[_template_path])
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def _get_health(socket_path: Path):
+    connection = serve._UnixHTTPConnection(str(socket_path), timeout=10)
+    connection.request("GET", "/health")
+    response = connection.getresponse()
+    return response.status, json.loads(response.read())
+
+
+def test_request_render(server):
+    from reproenv.renderers import render
+
+    assert serve.default_socket().is_socket()
+    rendered = serve.request_render(_spec, targets=["docker"])
+    assert rendered == render(_spec, targets=["docker"])
+    rendered = serve.request_render(_spec, template_path=[_template_path + "/"])
+    assert set(rendered) == {"docker", "singularity"}
+
+    with pytest.raises(RendererError, match="'foo'"):
+        serve.request_render({**_spec, "instructions": [{"name": "foo", "kwds": {}}]})
+    with pytest.raises(serve.ServerUnavailable, match="different template path"):
+        serve.request_render(_spec, template_path=[])
+
+    status, health = _get_health(serve.default_socket())
+    assert status == 200
+    assert health["status"] == "ok"
+    assert health["templates"] == 1
+    assert (health["requests"], health["errors"]) == (4, 2)
+    assert health["cache"]["misses"] == 3
+    assert health["cache"]["size"] == 2
+
+    # Another server cannot take over the socket.
+    with pytest.raises(ReproEnvError, match="already listening"):
+        serve.make_server()
+
+
+def test_request_render_concurrent(server):
+    results = []
+
+    def request():
+        results.append(serve.request_render(_spec, targets=["docker"]))
+
+    threads = [threading.Thread(target=request) for _ in range(32)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 32
+    assert all(result == results[0] for result in results)
+
+
+def test_request_render_unavailable(tmp_path: Path):
+    with pytest.raises(serve.ServerUnavailable):
+        serve.request_render(_spec, socket_path=tmp_path / "missing.sock")
+
+
+def test_tcp_server():
+    server = serve.make_server(port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        connection = http.client.HTTPConnection(*server.server_address, timeout=10)
+        connection.request("GET", "/health")
+        assert connection.getresponse().status == 200
+        connection.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def test_server_reloads_changed_templates(tmp_path: Path):
+    template_dir = tmp_path / "templates"
+    template_dir.mkdir()
+    template = Path(_template_path) / "sample-template-jq.yaml"
+    (template_dir / "jq.yaml").write_text(template.read_text())
+    server = serve.make_server(
+        socket_path=tmp_path / "reproenv.sock", template_path=[str(template_dir)]
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        rendered = serve.request_render(
+            _spec, targets=["docker"], socket_path=tmp_path / "reproenv.sock"
+        )
+        assert "chmod +x /usr/local/bin/jq" in rendered["docker"]
+        (template_dir / "jq.yaml").write_text(
+            template.read_text().replace("chmod +x", "chmod 0755")
+        )
+        rendered = serve.request_render(
+            _spec, targets=["docker"], socket_path=tmp_path / "reproenv.sock"
+        )
+        assert "chmod 0755 /usr/local/bin/jq" in rendered["docker"]
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def test_is_trusted_socket(server, tmp_path: Path):
+    assert serve.is_trusted_socket(serve.default_socket())
+    assert not serve.is_trusted_socket(tmp_path / "missing.sock")
+    (tmp_path / "file").touch()
+    assert not serve.is_trusted_socket(tmp_path / "file")
+    # Other users can create sockets in the directory.
+    tmp_path.chmod(0o755)
+    assert not serve.is_trusted_socket(serve.default_socket())
+
+
+def test_cli_forwards_to_server(server, tmp_path: Path):
+    runner = CliRunner()
+    args = ["--template-path", _template_path, "docker", "--spec", "-"]
+    result = runner.invoke(generate, args, input=json.dumps(_spec))
+    assert result.exit_code == 0, result.output
+    assert "jq-1.6/jq-linux64" in result.output
+    assert server.stats.requests == 1
+
+    # Templates are not registered in the client.
+    _TemplateRegistry._reset()
+    args = ["--template-path", _template_path, "docker", "-p", "apt", "-b", "debian"]
+    result = runner.invoke(generate, args + ["--jq", "version=1.6"])
+    assert result.exit_code == 0, result.output
+    assert "jq-1.6/jq-linux64" in result.output
+    assert server.stats.requests == 2
+    assert not _TemplateRegistry.keys()
+
+    # The server is not used if other users can replace its socket.
+    tmp_path.chmod(0o755)
+    result = runner.invoke(generate, args + ["--jq", "version=1.6"])
+    assert result.exit_code == 0, result.output
+    assert server.stats.requests == 2
+    assert _TemplateRegistry.keys() == {"jq"}
+    tmp_path.chmod(0o700)
+    _TemplateRegistry._reset()
+    _TemplateRegistry.register(Path(_template_path) / "sample-template-jq.yaml")
+
+    # The server is not used if it has other templates.
+    result = runner.invoke(generate, args[2:], input=json.dumps(_spec))
+    assert result.exit_code == 0, result.output
+    assert server.stats.requests == 3
+    assert server.stats.errors == 1
+
+
+def test_cli_forwards_build_context(server, tmp_path: Path, monkeypatch):
+    from reproenv import fetch
+
+    # An artifact cache in the build context of the client.
+    urls = [
+        "https://github.com/stedolan/jq/releases/download/jq-1.6/jq-linux64",
+        "http://ftp.us.debian.org/debian/pool/main/r/rust-fd-find/"
+        "fd-find_7.2.0-2_amd64.deb",
+    ]
+    context = tmp_path / "context"
+    (context / "artifacts" / "urls").mkdir(parents=True)
+    (context / "artifacts" / "sha256").mkdir()
+    for i, url in enumerate(urls):
+        digest = str(i) * 64
+        (context / "artifacts" / "urls" / fetch._url_key(url)).write_text(digest)
+        (context / "artifacts" / "sha256" / digest).touch()
+    monkeypatch.chdir(context)
+
+    requests = []
+    request_render = serve.request_render
+
+    def spy(d, **kwds):
+        requests.append(d)
+        return request_render(d, **kwds)
+
+    monkeypatch.setattr(serve, "request_render", spy)
+    args = ["--template-path", _template_path, "docker", "-p", "apt", "-b", "debian"]
+    args += ["--artifacts-dir", "artifacts", "--jq", "version=1.6"]
+    result = CliRunner().invoke(generate, args)
+    assert result.exit_code == 0, result.output
+    assert f"source=artifacts/sha256/{'0' * 64}" in result.output
+    # The server resolves the artifacts in the build context of the client.
+    assert requests[0]["build_context"] == str(context)
+    assert server.stats.requests == 1
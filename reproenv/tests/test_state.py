@@ -1,10 +1,18 @@
+import gc
 from pathlib import Path
+import threading
+import tracemalloc
 
 import pytest
 import yaml
 
 from reproenv import exceptions
 from reproenv.state import _TemplateRegistry, _validate_template
+from reproenv.state import _load_schema
+from reproenv.state import _validate_renderer
+from reproenv.state import active_registry
+from reproenv.state import TemplateRegistry
+from reproenv.state import use_registry
 from reproenv import types
 
 
@@ -361,3 +369,143 @@ def test_keys():
     name = "foo"
     _TemplateRegistry._templates[name] = {}
     assert _TemplateRegistry.keys() == {"foo"}
+
+
+def _template(name: str) -> types.TemplateType:
+    return {
+        "name": name,
+        "binaries": {"urls": {"1.0": "foo.com"}, "instructions": "echo {{ self.foo }}"},
+    }
+
+
+def _renderer_dict(name: str):
+    return {
+        "pkg_manager": "apt",
+        "instructions": [{"name": name, "kwds": {"version": "1.0"}}],
+    }
+
+
+def test_use_registry():
+    _TemplateRegistry._reset()
+    _TemplateRegistry.register(_template("foo"), name="foo")
+    default = active_registry()
+
+    registry = default.copy()
+    registry.register(_template("bar"), name="bar")
+    assert registry.keys() == {"foo", "bar"}
+    # Copies do not change the registry they were made from.
+    assert default.keys() == {"foo"}
+    with pytest.raises(exceptions.RendererError):
+        _validate_renderer(_renderer_dict("bar"))
+
+    with use_registry(registry):
+        assert _TemplateRegistry.keys() == {"foo", "bar"}
+        assert _TemplateRegistry.get("bar") == _template("bar")
+        _validate_renderer(_renderer_dict("bar"))
+        # Other threads use the default registry.
+        keys = []
+        thread = threading.Thread(target=lambda: keys.append(_TemplateRegistry.keys()))
+        thread.start()
+        thread.join()
+        assert keys == [{"foo"}]
+    assert active_registry() is default
+    assert _TemplateRegistry.keys() == {"foo"}
+
+
+def test_register_many(tmp_path: Path):
+    registry = TemplateRegistry()
+    registry.register(_template("base"), name="base")
+    paths = []
+    for name in ("foo", "bar"):
+        path = tmp_path / f"{name}.yaml"
+        path.write_text(yaml.safe_dump(_template(name)))
+        paths.append(path)
+    registry.register_many(paths)
+    registry.register_many({"baz": _template("baz")})
+    assert registry.keys() == {"base", "foo", "bar", "baz"}
+    with use_registry(registry):
+        for name in registry.keys():
+            _validate_renderer(_renderer_dict(name))
+
+    # Nothing is registered if one of the templates is invalid.
+    with pytest.raises(exceptions.TemplateError):
+        registry.register_many({"qux": _template("qux"), "bad": {"name": "bad"}})
+    assert registry.keys() == {"base", "foo", "bar", "baz"}
+
+    with use_registry(registry):
+        _TemplateRegistry.register_many({"qux": _template("qux")})
+    assert "qux" in registry.keys()
+
+
+def test_registry_concurrent_register():
+    registry = TemplateRegistry()
+
+    def register(i: int):
+        with use_registry(registry):
+            for j in range(20):
+                _TemplateRegistry.register(_template("foo"), name=f"t{i}_{j}")
+            _validate_renderer(_renderer_dict(f"t{i}_0"))
+
+    threads = [threading.Thread(target=register, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(registry.keys()) == 8 * 20
+    oneof = registry.renderer_schema()["properties"]["instructions"]["items"]["oneOf"]
+    assert len(oneof) == 10 + 8 * 20
+
+
+def test_unregister():
+    _TemplateRegistry._reset()
+    pristine = _load_schema("renderer.json")
+    assert active_registry().renderer_schema() == pristine
+    _TemplateRegistry.register(_template("foo"), name="foo")
+    _TemplateRegistry.register(_template("foo"), name="FOO")
+    _TemplateRegistry.register(_template("bar"), name="bar")
+    _validate_renderer(_renderer_dict("FOO"))
+
+    _TemplateRegistry.unregister("Foo")
+    assert _TemplateRegistry.keys() == {"bar"}
+    with pytest.raises(exceptions.RendererError):
+        _validate_renderer(_renderer_dict("foo"))
+    with pytest.raises(exceptions.RendererError):
+        _validate_renderer(_renderer_dict("FOO"))
+    _validate_renderer(_renderer_dict("bar"))
+    with pytest.raises(exceptions.TemplateNotFound):
+        _TemplateRegistry.unregister("foo")
+
+    # Resetting restores the pristine schema.
+    _TemplateRegistry._reset()
+    assert active_registry().renderer_schema() == pristine
+    with pytest.raises(exceptions.RendererError):
+        _validate_renderer(_renderer_dict("bar"))
+
+
+def test_register_unregister_soak():
+    # Registering and unregistering templates, e.g., when reloading templates in a
+    # long-running server, must not grow memory or the renderer schema.
+    registry = TemplateRegistry()
+    registry.register(_template("base"), name="base")
+    expected_schema = registry.copy().renderer_schema()
+
+    def cycle(n: int):
+        for i in range(n):
+            registry.register(_template("foo"), name=f"foo{i % 7}")
+            with use_registry(registry):
+                _validate_renderer(_renderer_dict(f"foo{i % 7}"))
+            registry.unregister(f"foo{i % 7}")
+
+    cycle(100)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        cycle(300)
+        gc.collect()
+        growth = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    assert growth < 64 * 1024
+    assert registry.keys() == {"base"}
+    assert registry.renderer_schema() == expected_schema
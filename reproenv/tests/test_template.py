@@ -194,7 +194,20 @@ def test_installation_template_base():
     # TODO: add dpkg
     assert it.dependencies("yum") == d["dependencies"]["yum"]
     assert it.dependencies("foobar") == []
+    assert it.dependencies("apt", build=True) == []
     assert it._kwds == {"name": "foobar", "age": "42", "height": "100"}
     assert it.name == "foobar"
     assert it.age == "42"
     assert it.height == "100"
+
+
+def test_installation_template_build_dependencies():
+    d: types.SourceTemplateType = {
+        "instructions": "make",
+        "dependencies": {"apt": ["libfoo"], "build": {"apt": ["gcc", "make"]}},
+    }
+    template._validate_template({"name": "foo", "source": d})
+    it = template._SourceTemplate(d)
+    assert it.dependencies("apt") == ["libfoo"]
+    assert it.dependencies("apt", build=True) == ["gcc", "make"]
+    assert it.dependencies("yum", build=True) == []
@@ -14,6 +14,15 @@ pkg_managers_type = Literal["apt", "yum"]
 # Cross-reference the dictionary types below with the JSON schemas.
 
 
+class _BuildDependenciesType(TypedDict, total=False):
+    """Dictionary of system dependencies that are only required while installing
+    the software. They are removed after installation.
+    """
+
+    apt: ty.List[str]
+    yum: ty.List[str]
+
+
 class _InstallationDependenciesType(TypedDict, total=False):
     """Dictionary of system dependencies, with package managers as keys. Different
     distributions use different package managers. For example, CentOS and Fedora use
@@ -23,6 +32,7 @@ class _InstallationDependenciesType(TypedDict, total=False):
     apt: ty.List[str]
     debs: ty.List[str]
     yum: ty.List[str]
+    build: _BuildDependenciesType
 
 
 class _TemplateArgumentsType(TypedDict):
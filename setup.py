@@ -9,4 +9,6 @@ import versioneer
 
 version = versioneer.get_version()
 
-setup(version=version)
+# The build commands of versioneer write the version into `reproenv/_version.py` of
+# installed builds, so the version does not have to be computed with git at runtime.
+setup(version=version, cmdclass=versioneer.get_cmdclass())